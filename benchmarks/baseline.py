@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+JSON baselines of benchmark results
+Every benchmark takes --output to save its results with the environment
+they were measured in, and --compare and --tolerance to check them against
+a saved baseline. Results map a key, e.g. a database size or a command, to
+its metrics; a metric more than the tolerance worse than its baseline
+counts as a regression and makes the benchmark exit with 1.
+"""
+
+import json
+import platform
+import sqlite3
+
+
+def get_environment(**extra):
+    """
+    Get the environment results are measured in, plus the given fields
+    """
+    return {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "machine": platform.machine(),
+        **extra,
+    }
+
+
+def save(path, results, environment):
+    """
+    Write the results and their environment to a JSON file
+    """
+    with open(path, "w", encoding="utf-8") as output:
+        json.dump({"environment": environment, "results": results}, output, indent=2)
+
+
+def compare(results, baseline, tolerance, higher_is_better):
+    """
+    Print the change of every metric against the baseline, higher_is_better
+    maps the metric names to their direction. Returns the number of
+    regressions.
+    """
+    regressions = 0
+    for key, metrics in results.items():
+        for name, value in metrics.items():
+            before = baseline["results"].get(key, {}).get(name, None)
+            if not before:
+                continue
+            change = (value - before) / before * 100
+            worse = -change if higher_is_better[name] else change
+            flag = "REGRESSION" if worse > tolerance else ""
+            regressions += 1 if flag else 0
+            print(
+                f"{key:>20} {name:<20} {before:12.2f} {value:12.2f} "
+                f"{change:+8.1f}% {flag}"
+            )
+    return regressions
+
+
+def finish(arguments, results, higher_is_better, **environment):
+    """
+    Save and compare the results as the --output, --compare and --tolerance
+    arguments ask for, returns the exit code
+    """
+    if arguments["--output"]:
+        save(arguments["--output"], results, get_environment(**environment))
+    if arguments["--compare"]:
+        with open(arguments["--compare"], encoding="utf-8") as baseline_file:
+            regressions = compare(
+                results,
+                json.load(baseline_file),
+                float(arguments["--tolerance"]),
+                higher_is_better,
+            )
+        if regressions:
+            print(f"{regressions} regressions")
+            return 1
+    return 0
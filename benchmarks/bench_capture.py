@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Load test the capture engine against a fake local stream server
+
+A local TCP server streams NDJSON tweets in bursts, like the twitter stream
+would. They are read either inline, writing to the database within the read
+loop like the synchronous capture, or through the asynchronous capture queue
+with each of its policies. Slow commits can be simulated with a delay.
+
+Usage:
+  bench_capture.py [--tweets=<n>] [--burst=<n>] [--pause=<s>] [--queue-size=<n>]
+                   [--commit-delay=<s>]
+
+Options:
+  --tweets=<n>        Tweets sent by the server [default: 20000]
+  --burst=<n>         Tweets sent at once before pausing [default: 1000]
+  --pause=<s>         Seconds between bursts [default: 0.01]
+  --queue-size=<n>    Capacity of the capture queue [default: 2000]
+  --commit-delay=<s>  Extra seconds every flush takes [default: 0.1]
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+import sqlalchemy.orm
+from docopt import docopt
+import microblog.capture
+import microblog.db
+import microblog.ingest
+import microblog.source.twitter
+
+
+class SlowWriter(microblog.ingest.BufferedWriter):
+    """
+    Buffered writer whose commits take longer, e.g. due to lock waits
+    """
+
+    commit_delay = 0.0
+
+    def flush(self):
+        if self.buffer:
+            time.sleep(self.commit_delay)
+        super().flush()
+
+
+async def serve_stream(reader, writer, arguments):
+    """
+    Stream fake tweets to one client in bursts, then close the connection
+    """
+    await reader.readline()
+    tweets, burst = int(arguments["--tweets"]), int(arguments["--burst"])
+    for start in range(0, tweets, burst):
+        lines = [
+            json.dumps({"data": {"id": str(idx), "text": f"tweet {idx}"}}) + "\n"
+            for idx in range(start, min(start + burst, tweets))
+        ]
+        writer.write("".join(lines).encode())
+        await writer.drain()
+        await asyncio.sleep(float(arguments["--pause"]))
+    writer.close()
+
+
+async def read_stream(port, handle):
+    """
+    Read the stream line by line, returns the longest gap between two reads
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /stream\n")
+    max_gap, last = 0.0, time.perf_counter()
+    async for line in reader:
+        tweet = json.loads(line)["data"]
+        await handle(json.dumps(tweet), tweet["id"])
+        now = time.perf_counter()
+        max_gap, last = max(max_gap, now - last), now
+    writer.close()
+    return max_gap
+
+
+async def run(arguments, writer, policy):
+    """
+    Capture the fake stream with the given policy, or inline if None
+    """
+    server = await asyncio.start_server(
+        lambda reader, stream: serve_stream(reader, stream, arguments), "127.0.0.1", 0
+    )
+    port = server.sockets[0].getsockname()[1]
+    stats = {}
+    async with server:
+        if policy is None:
+
+            async def handle(data, dedup_key):
+                writer.add(data, dedup_key=dedup_key)
+
+            max_gap = await read_stream(port, handle)
+            writer.close()
+        else:
+            capture_queue = microblog.capture.CaptureQueue(
+                int(arguments["--queue-size"]), policy
+            )
+            writer_task = asyncio.create_task(
+                microblog.capture.run_writer(capture_queue, writer)
+            )
+            max_gap = await read_stream(port, capture_queue.put)
+            await capture_queue.close()
+            await writer_task
+            stats = capture_queue.stats()
+    return max_gap, stats
+
+
+def main(arguments):
+    """
+    Run the load test and print one line per mode
+    """
+    SlowWriter.commit_delay = float(arguments["--commit-delay"])
+    print(
+        f"{'mode':>8} {'seconds':>8} {'max read gap ms':>16} {'written':>8} "
+        f"{'dropped':>8} {'spilled':>8} {'max depth':>10}"
+    )
+    for policy in (None,) + microblog.capture.POLICIES:
+        with tempfile.TemporaryDirectory() as directory:
+            os.environ["MB_CAPTURE_SPILL_PATH"] = os.path.join(directory, "spill")
+            engine = microblog.db.get_engine(
+                f"sqlite:///{os.path.join(directory, 'bench.sqlite')}"
+            )
+            with sqlalchemy.orm.Session(bind=engine) as session:
+                datasource = microblog.source.twitter.get_datasource(session)
+                writer = SlowWriter(session, datasource)
+                start = time.perf_counter()
+                max_gap, stats = asyncio.run(run(arguments, writer, policy))
+                elapsed = time.perf_counter() - start
+                written = writer.stats()["rows_written"]
+            microblog.db.dispose_engines()
+        print(
+            f"{policy or 'inline':>8} {elapsed:8.2f} {max_gap * 1000:16.1f} "
+            f"{written:>8} {stats.get('dropped', 0):>8} "
+            f"{stats.get('spilled', 0):>8} {stats.get('max_depth', 0):>10}"
+        )
+
+
+if __name__ == "__main__":
+    main(docopt(__doc__))
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Load test of the production server: requests per second by worker count
+
+A database of synthetic tweets is served by `cli.py serve` with each of the
+given worker counts in turn, while client processes fire keep-alive requests
+at random pages and random batches for a fixed duration. Requests per second
+should grow with the workers up to the number of cores. Like the other
+benchmarks, results can be saved as a JSON baseline and compared against.
+
+Usage:
+  bench_load.py [--workers=<counts>] [--threads=<n>] [--clients=<n>]
+                [--duration=<s>] [--size=<n>] [--output=<file>]
+                [--compare=<file>] [--tolerance=<pct>]
+
+Options:
+  --workers=<counts>  Comma separated worker counts [default: 1,2,4]
+  --threads=<n>       Threads per worker [default: 1]
+  --clients=<n>       Client processes [default: 8]
+  --duration=<s>      Seconds of load per worker count [default: 10]
+  --size=<n>          Synthetic tweets in the database [default: 10000]
+  --output=<file>     Write the results to this JSON file
+  --compare=<file>    Compare the results against this JSON baseline
+  --tolerance=<pct>   Allowed slowdown in percent [default: 20]
+"""
+
+import http.client
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from docopt import docopt
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+# pylint: disable=C0413
+import baseline
+import bench_suite
+import microblog.db
+
+CLI = os.path.join(os.path.dirname(__file__), "..", "microblog", "cli.py")
+STARTUP_TIMEOUT = 30
+
+
+def free_port():
+    """
+    Get a port nothing listens on right now
+    """
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_until_up(port):
+    """
+    Wait for the server to answer, raises RuntimeError if it doesn't
+    """
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/openapi/v1/openapi.yaml")
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} didn't come up")
+
+
+def client(port, duration, max_id, seed):
+    """
+    Send requests over one keep-alive connection for the duration,
+    returns the number of successful requests
+    """
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    completed = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        if rng.random() < 0.5:
+            url = "/openapi/v1/messages"
+        else:
+            url = f"/openapi/v1/messages?limit=50&after_id={rng.randrange(max_id)}"
+        connection.request("GET", url)
+        response = connection.getresponse()
+        response.read()
+        completed += response.status == 200
+    connection.close()
+    return completed
+
+
+def load(workers, arguments, environment):
+    """
+    Serve with the number of workers and measure requests per second
+    """
+    port = free_port()
+    server = subprocess.Popen(  # pylint: disable=R1732
+        [
+            sys.executable,
+            CLI,
+            "serve",
+            f"--workers={workers}",
+            f"--threads={arguments['--threads']}",
+        ],
+        env=dict(environment, MB_API_BIND=f"127.0.0.1:{port}"),
+    )
+    try:
+        wait_until_up(port)
+        duration = float(arguments["--duration"])
+        clients = int(arguments["--clients"])
+        with multiprocessing.Pool(clients) as pool:
+            completed = pool.starmap(
+                client,
+                [
+                    (port, duration, int(arguments["--size"]), seed)
+                    for seed in range(clients)
+                ],
+            )
+        return sum(completed) / duration
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(arguments):
+    """
+    Fill a database, load test every worker count, save and compare
+    the results as requested
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["SQLITE_PATH"] = os.path.join(directory, "bench.sqlite")
+        bench_suite.bench_capture(int(arguments["--size"]), 0)
+        bench_suite.bench_transfer(int(arguments["--size"]))
+        microblog.db.dispose_engines()
+        for workers in arguments["--workers"].split(","):
+            results[workers] = {"requests_per_s": load(workers, arguments, os.environ)}
+            scaling = (
+                results[workers]["requests_per_s"]
+                / next(iter(results.values()))["requests_per_s"]
+            )
+            print(
+                f"{workers:>3} workers: {results[workers]['requests_per_s']:9.0f} "
+                f"requests/s, {scaling:5.2f}x"
+            )
+    return baseline.finish(
+        arguments, results, {"requests_per_s": True}, cores=os.cpu_count()
+    )
+
+
+if __name__ == "__main__":
+    sys.exit(main(docopt(__doc__)))
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark random message sampling for growing table sizes
+
+Usage:
+  bench_sampling.py [--sizes=<sizes>] [--runs=<runs>] [--legacy-max=<rows>]
+
+Options:
+  --sizes=<sizes>       Comma separated table sizes [default: 10000,100000,1000000,10000000]
+  --runs=<runs>         Sampling calls per table size [default: 50]
+  --legacy-max=<rows>   Largest table size to also time ORDER BY random() [default: 1000000]
+"""
+
+import os
+import random
+import statistics
+import tempfile
+import time
+import sqlalchemy
+from docopt import docopt
+import microblog.db
+import microblog.model
+
+
+def grow_table(engine, current, target):
+    """
+    Insert messages until the table holds the target number of rows
+    """
+    connection = engine.raw_connection()
+    try:
+        connection.execute(
+            "INSERT OR IGNORE INTO datasource (id, name) VALUES (1, 'x')"
+        )
+        connection.executemany(
+            "INSERT INTO messageentity (datasource_id, message) VALUES (1, ?)",
+            ((f"benchmark message {idx}",) for idx in range(current, target)),
+        )
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def legacy_sample(session):
+    """
+    The previous full table sort, kept as reference
+    """
+    return session.scalars(
+        sqlalchemy.select(microblog.model.MessageEntity)
+        .order_by(sqlalchemy.func.random())
+        .limit(random.randint(10, 50))
+    ).all()
+
+
+def measure(session, sampler, runs):
+    """
+    Get the median latency in milliseconds of the given sampler
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        sampler(session)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main(arguments):
+    """
+    Run the benchmark and print one line per table size
+    """
+    sizes = [int(size) for size in arguments["--sizes"].split(",")]
+    runs = int(arguments["--runs"])
+    legacy_max = int(arguments["--legacy-max"])
+    with tempfile.TemporaryDirectory() as directory:
+        engine = microblog.db.get_engine(
+            f"sqlite:///{os.path.join(directory, 'bench.sqlite')}"
+        )
+        current = 0
+        print(f"{'rows':>10} {'probing ms':>12} {'order by random() ms':>22}")
+        for size in sorted(sizes):
+            grow_table(engine, current, size)
+            current = size
+            with sqlalchemy.orm.Session(bind=engine) as session:
+                probing = measure(
+                    session, microblog.model.MessageEntity.get_a_lot, runs
+                )
+                legacy = (
+                    f"{measure(session, legacy_sample, runs):22.3f}"
+                    if size <= legacy_max
+                    else f"{'skipped':>22}"
+                )
+            print(f"{size:>10} {probing:12.3f} {legacy}")
+        microblog.db.dispose_engines()
+
+
+if __name__ == "__main__":
+    main(docopt(__doc__))
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Serialization cost of a messages response per 1000 messages
+
+Compares building dicts and encoding them with the standard json module, as
+jsonify did, encoding the same dicts with orjson (if installed) and joining
+the pre-rendered fragments stored with the messages. Rows are synthetic
+tweets, no database involved. Like the other benchmarks, results can be
+saved as a JSON baseline and compared against.
+
+Usage:
+  bench_serialize.py [--runs=<n>] [--output=<file>] [--compare=<file>]
+                     [--tolerance=<pct>]
+
+Options:
+  --runs=<n>         Runs per method, the fastest counts [default: 200]
+  --output=<file>    Write the results to this JSON file
+  --compare=<file>   Compare the results against this JSON baseline
+  --tolerance=<pct>  Allowed slowdown in percent [default: 20]
+"""
+
+import collections
+import json
+import sys
+import time
+from docopt import docopt
+from synthetic import TweetGenerator
+import baseline
+
+# pylint: disable=C0413
+import microblog.schema
+
+MESSAGES = 1000
+Row = collections.namedtuple("Row", ["id", "datasource_name", "message", "fragment"])
+
+
+def get_rows(with_fragments):
+    """
+    Get synthetic message rows, with their fragments or without
+    """
+    generator = TweetGenerator()
+    rows = []
+    for row_id in range(1, MESSAGES + 1):
+        text = generator.text()
+        fragment = None
+        if with_fragments:
+            fragment = microblog.schema.render_message(row_id, "twitter", text)
+        rows.append(Row(row_id, "twitter", text, fragment))
+    return rows
+
+
+def to_dicts(rows, cursor):
+    """
+    Build the response as dicts, as the API did before fragments
+    """
+    return {
+        "messages": [
+            {
+                "id": row.id,
+                "datasource_name": row.datasource_name,
+                "message": row.message,
+            }
+            for row in rows
+        ],
+        "cursor": cursor,
+    }
+
+
+def stdlib(rows):
+    """
+    Dicts encoded with the json module, like jsonify
+    """
+    return json.dumps(to_dicts(rows, "cursor")).encode()
+
+
+def orjson_dicts(rows):
+    """
+    Dicts encoded with orjson
+    """
+    return microblog.schema.orjson.dumps(  # pylint: disable=E1101
+        to_dicts(rows, "cursor")
+    )
+
+
+def fragments(rows):
+    """
+    Stored fragments joined
+    """
+    return microblog.schema.render_messages(rows, "cursor")
+
+
+def measure(method, rows, runs):
+    """
+    Get the fastest of the runs in microseconds
+    """
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        method(rows)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000000
+
+
+def main(arguments):
+    """
+    Measure every method, save and compare the results as requested
+    """
+    runs = int(arguments["--runs"])
+    plain_rows, fragment_rows = get_rows(False), get_rows(True)
+    methods = {"json": (stdlib, plain_rows)}
+    if microblog.schema.orjson is not None:
+        methods["orjson"] = (orjson_dicts, plain_rows)
+    methods["fragments"] = (fragments, fragment_rows)
+    results = {}
+    for name, (method, rows) in methods.items():
+        results[name] = {"us_per_1k": measure(method, rows, runs)}
+        print(f"{name:<10} {results[name]['us_per_1k']:9.1f} us per 1k messages")
+    return baseline.finish(arguments, results, {"us_per_1k": False})
+
+
+if __name__ == "__main__":
+    sys.exit(main(docopt(__doc__)))
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Measure CLI startup: import time and wall time per command
+
+Every command runs in a fresh interpreter with -X importtime against an
+empty database, the import time being the sum of all top level imports.
+The fastest of a few runs counts. Like bench_suite.py, results can be saved
+as a JSON baseline and later runs compared against it.
+
+Usage:
+  bench_startup.py [--runs=<n>] [--output=<file>] [--compare=<file>]
+                   [--tolerance=<pct>]
+
+Options:
+  --runs=<n>         Runs per command [default: 5]
+  --output=<file>    Write the results to this JSON file
+  --compare=<file>   Compare the results against this JSON baseline
+  --tolerance=<pct>  Allowed slowdown in percent [default: 20]
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from docopt import docopt
+import baseline
+
+COMMANDS = (
+    ("openapi",),
+    ("transfer", "twitter"),
+    ("reindex",),
+)
+CLI = os.path.join(os.path.dirname(__file__), "..", "microblog", "cli.py")
+
+
+def import_seconds(stderr):
+    """
+    Sum up the cumulative import time of all top level imports
+    """
+    total = 0
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _self, cumulative, name = line.split(":", 1)[1].split("|")
+        # Nested imports are indented, top level ones have a single space
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            total += int(cumulative)
+    return total / 1000000
+
+
+def run_command(command, environment):
+    """
+    Run a CLI command once, returns its import and wall seconds
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", CLI, *command],
+        env=environment,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return import_seconds(result.stderr), time.perf_counter() - start
+
+
+def main(arguments):
+    """
+    Measure all commands, save and compare the results as requested
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        environment = dict(
+            os.environ,
+            SQLITE_PATH=os.path.join(directory, "bench.sqlite"),
+            LOG_LEVEL="WARNING",
+        )
+        for command in COMMANDS:
+            runs = [
+                run_command(command, environment)
+                for _ in range(int(arguments["--runs"]))
+            ]
+            name = " ".join(command)
+            results[name] = {
+                "import_ms": min(run[0] for run in runs) * 1000,
+                "wall_ms": min(run[1] for run in runs) * 1000,
+            }
+            print(
+                f"{name:<20} imports {results[name]['import_ms']:8.1f} ms, "
+                f"wall {results[name]['wall_ms']:8.1f} ms"
+            )
+    return baseline.finish(arguments, results, {"import_ms": False, "wall_ms": False})
+
+
+if __name__ == "__main__":
+    sys.exit(main(docopt(__doc__)))
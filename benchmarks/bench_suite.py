@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark of capture, transfer and serve
+
+For every database size synthetic tweets are fed to the capture's
+StreamingClient.on_tweet, transferred into messages and then served through
+the Flask test client, no network involved. Results can be saved as a JSON
+baseline and later runs compared against it; a metric more than the
+tolerance worse than its baseline counts as a regression.
+
+Usage:
+  bench_suite.py [--sizes=<sizes>] [--requests=<n>] [--seed=<n>]
+                 [--output=<file>] [--compare=<file>] [--tolerance=<pct>]
+
+Options:
+  --sizes=<sizes>    Comma separated numbers of tweets [default: 1000,10000,100000]
+  --requests=<n>     Requests per served endpoint [default: 200]
+  --seed=<n>         Seed of the tweet generator [default: 0]
+  --output=<file>    Write the results to this JSON file
+  --compare=<file>   Compare the results against this JSON baseline
+  --tolerance=<pct>  Allowed slowdown in percent [default: 20]
+"""
+
+import os
+import statistics
+import sys
+import tempfile
+import time
+from docopt import docopt
+from synthetic import TweetGenerator
+import baseline
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+# pylint: disable=C0413
+import microblog.api
+import microblog.db
+import microblog.source.twitter
+import microblog.source.twitter_stream
+
+# Metric name and whether higher values are better
+METRICS = {
+    "capture_rows_per_s": True,
+    "transfer_rows_per_s": True,
+    "messages_p50_ms": False,
+    "messages_p99_ms": False,
+    "page_p50_ms": False,
+    "page_p99_ms": False,
+}
+
+
+def bench_capture(size, seed):
+    """
+    Feed synthetic tweets to the streaming client, returns rows per second
+    """
+    client = microblog.source.twitter_stream.StreamingClient("synthetic")
+    tweets = list(TweetGenerator(seed).tweets(size))
+    with microblog.db.get_session() as session:
+        client.mb_writer = microblog.source.twitter.get_writer(session)
+        start = time.perf_counter()
+        for tweet in tweets:
+            client.on_tweet(tweet)
+        client.mb_writer.close()
+        elapsed = time.perf_counter() - start
+    return size / elapsed
+
+
+def bench_transfer(size):
+    """
+    Transfer all captured tweets, returns rows per second
+    """
+    start = time.perf_counter()
+    microblog.source.twitter.transfer(chunk_size=1000)
+    return size / (time.perf_counter() - start)
+
+
+def percentiles(timings):
+    """
+    Get the p50 and p99 of timings in milliseconds
+    """
+    cuts = statistics.quantiles(timings, n=100)
+    return cuts[49] * 1000, cuts[98] * 1000
+
+
+def bench_serve(requests):
+    """
+    Time random batches and a paged walk, returns p50 and p99 of both
+    """
+    client = microblog.api.get_app().test_client()
+    timings = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        client.get("/openapi/v1/messages")
+        timings.append(time.perf_counter() - start)
+    page_timings = []
+    url = "/openapi/v1/messages?limit=50"
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = client.get(url)
+        page_timings.append(time.perf_counter() - start)
+        if response.json["messages"]:
+            url = f"/openapi/v1/messages?limit=50&cursor={response.json['cursor']}"
+        else:
+            url = "/openapi/v1/messages?limit=50&after_id=0"
+    return percentiles(timings) + percentiles(page_timings)
+
+
+def run(sizes, requests, seed):
+    """
+    Run all benchmarks on a fresh database per size
+    """
+    results = {}
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            os.environ["SQLITE_PATH"] = os.path.join(directory, "bench.sqlite")
+            capture = bench_capture(size, seed)
+            transfer = bench_transfer(size)
+            serve = bench_serve(requests)
+            microblog.db.dispose_engines()
+        results[str(size)] = dict(
+            zip(METRICS, (capture, transfer) + serve),
+        )
+        print(
+            f"{size:>8} tweets: capture {capture:9.0f} rows/s, "
+            f"transfer {transfer:9.0f} rows/s, /messages p50 {serve[0]:6.2f} ms "
+            f"p99 {serve[1]:6.2f} ms, paged p50 {serve[2]:6.2f} ms p99 {serve[3]:6.2f} ms"
+        )
+    return results
+
+
+def main(arguments):
+    """
+    Run the suite, save and compare the results as requested
+    """
+    sizes = [int(size) for size in arguments["--sizes"].split(",")]
+    results = run(sizes, int(arguments["--requests"]), int(arguments["--seed"]))
+    return baseline.finish(arguments, results, METRICS)
+
+
+if __name__ == "__main__":
+    sys.exit(main(docopt(__doc__)))
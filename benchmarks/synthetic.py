@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Deterministic synthetic tweets
+The same seed always yields the same tweets, so benchmark runs are
+comparable. Words follow a Zipf-like distribution with the odd hashtag
+and mention mixed in, which is roughly what real tweets look like to
+compression and full-text search.
+"""
+
+import json
+import random
+import tweepy
+
+WORDS = (
+    "the to a and of in is you that it for on my this be with have not at are "
+    "just me so but we like all your what was can get out no do if now one "
+    "love when up about good time they day new people go today know how more "
+    "lol see will back great think really want from been going night still "
+    "happy make would life work need much come home got last right well"
+).split()
+FIRST_ID = 1500000000000000000
+
+
+class TweetGenerator:
+    """
+    Generator of tweepy Tweet objects with increasing ids
+    """
+
+    def __init__(self, seed=0, duplicate_rate=0.0):
+        """
+        Initialize the generator, duplicate_rate is the share of tweets
+        repeating an earlier one, like a stream does after a reconnect
+        """
+        self.random = random.Random(seed)
+        self.duplicate_rate = duplicate_rate
+        self.next_id = FIRST_ID
+        self.recent = []
+        self.weights = [1.0 / rank for rank in range(1, len(WORDS) + 1)]
+
+    def text(self):
+        """
+        Get the text of a new tweet
+        """
+        words = self.random.choices(
+            WORDS, weights=self.weights, k=self.random.randint(4, 30)
+        )
+        if self.random.random() < 0.3:
+            words.append(f"#{self.random.choice(WORDS)}")
+        if self.random.random() < 0.2:
+            words.insert(0, f"@user{self.random.randint(1, 10000)}")
+        return " ".join(words)
+
+    def data(self):
+        """
+        Get the payload of the next tweet as a dict
+        """
+        if self.recent and self.random.random() < self.duplicate_rate:
+            return self.random.choice(self.recent)
+        self.next_id += self.random.randint(1, 1000)
+        data = {
+            "edit_history_tweet_ids": [str(self.next_id)],
+            "id": str(self.next_id),
+            "text": self.text(),
+        }
+        self.recent = (self.recent + [data])[-100:]
+        return data
+
+    def tweets(self, count):
+        """
+        Yield count tweepy Tweet objects
+        """
+        for _ in range(count):
+            yield tweepy.Tweet(self.data())
+
+    def payloads(self, count):
+        """
+        Yield count raw tweet payloads as stored by the capture
+        """
+        for _ in range(count):
+            yield json.dumps(self.data())
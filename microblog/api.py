@@ -4,22 +4,60 @@
 Flask API
 """
 
+import functools
+import hashlib
 import logging
+import time
 import yaml
-from flask import Flask, g, make_response, jsonify
-from openapi_core.contrib.flask.decorators import FlaskOpenAPIViewDecorator
+from flask import Flask, Response, current_app, g, make_response, jsonify, request
+import microblog.cache
 import microblog.db
+import microblog.export
 import microblog.schema
 import microblog.logconf
+import microblog.metrics
 import microblog.model
+import microblog.validation
 
-# Initializes openapi decorator
-openapi = FlaskOpenAPIViewDecorator.from_spec(microblog.schema.SPEC_V1)
+PAGE_PARAMETERS = ("after_id", "limit", "datasource", "cursor")
+DEFAULT_PAGE_LIMIT = 50
+DEFAULT_SEARCH_LIMIT = 20
+DEFAULT_STATS_GRANULARITY = "hour"
+DEFAULT_STATS_LIMIT = 100
+# Requests without any of these are random batches, which aren't cached
+CACHE_PARAMETERS = PAGE_PARAMETERS + ("q",)
 
 
-def get_app():
+def cached(view):
     """
-    Initialize the Flask app and attach routes and handlers
+    Serve paged responses from the app's cache for as long as the data
+    version they were made with is current. The random batch is never cached.
+    """
+
+    @functools.wraps(view)
+    def wrapper():
+        if not any(name in request.args for name in CACHE_PARAMETERS):
+            return view()
+        with current_app.get_db() as session:
+            version = microblog.model.DataVersion.get(session)
+        current_app.response_cache.set_version(version)
+        key = (request.path, request.query_string, version)
+        body = current_app.response_cache.get(key)
+        if body is None:
+            response = make_response(view())
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            current_app.response_cache.set(key, body)
+        return _conditional_response(body, "application/json")
+
+    return wrapper
+
+
+def get_app(read_only=False):  # pylint: disable=R0915
+    """
+    Initialize the Flask app and attach routes and handlers,
+    with read_only its sessions can't write to the database
     """
     app = Flask(__name__)
     microblog.logconf.set_logging(microblog.logconf.LogConfig.CLI)
@@ -29,36 +67,209 @@ def get_app():
         Candy to set session in Flask's request global state
         """
         if "database" not in g:
-            g.database = microblog.db.get_session()
+            g.database = microblog.db.get_session(read_only=read_only)
         return g.database
 
     app.get_db = get_session
+    # Compiles the schema's validators once for all requests
+    validate = microblog.validation.Validator()
+    app.response_cache = microblog.cache.LRUCache()
+    openapi_yaml = yaml.dump(microblog.schema.SCHEMA_V1).encode()
 
     @app.teardown_appcontext
     def close_connection(_exception):
         """
-        On shutdown it's necessary to close an open database connection.
+        On shutdown it's necessary to return the connection to the pool.
         """
         if "database" in g:
             try:
-                g.database().remove()
+                g.database.close()
             except Exception as err:  # pylint: disable=W0703
                 logging.debug("Unexpected error when closing database: %s", err)
 
+    if microblog.metrics.is_enabled():
+        # Only hooked up when enabled, so disabled metrics cost nothing per request
+        @app.before_request
+        def start_timer():
+            g.request_start = time.perf_counter()
+
+        @app.after_request
+        def observe_request(response):
+            endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+            microblog.metrics.REQUEST_SECONDS.observe(
+                time.perf_counter() - g.request_start, endpoint=endpoint
+            )
+            microblog.metrics.REQUESTS.inc(
+                endpoint=endpoint, status=response.status_code
+            )
+            return response
+
+    @app.route("/metrics")
+    def metrics():
+        """
+        All metrics in the Prometheus text format
+        """
+        if not microblog.metrics.is_enabled():
+            return make_response(
+                jsonify(microblog.schema.BasicError("Metrics are disabled", 404)), 404
+            )
+        with app.get_db() as session:
+            for name, count in microblog.model.DataSource.get_backlog(session).items():
+                microblog.metrics.BACKLOG.set(count, datasource=name)
+        return Response(
+            microblog.metrics.REGISTRY.render(),
+            content_type=microblog.metrics.CONTENT_TYPE,
+        )
+
     @app.route("/openapi/v1/openapi.yaml")
     def openapi_schema():
-        response = make_response(yaml.dump(microblog.schema.SCHEMA_V1))
-        response.mimetype = "application/yaml"
-        return response
+        return _conditional_response(openapi_yaml, "application/yaml")
 
     @app.route("/openapi/v1/messages")
-    @openapi
+    @cached
+    @validate
     def messages():
         """
-        Trivial API call to fetch a random batch of messages
+        Fetch a random batch of messages or, if any paging parameter
+        is given, a page of messages in id order
         """
+        query = g.query
         with app.get_db() as session:
-            messages = microblog.model.MessageEntity.get_a_lot(session)
-            return jsonify(microblog.schema.generate_messages(messages))
+            if not any(name in query for name in PAGE_PARAMETERS):
+                with microblog.metrics.QUERY_SECONDS.time(query="get_a_lot"):
+                    messages = microblog.model.MessageEntity.get_a_lot(session)
+                return _json_response(microblog.schema.render_messages(messages))
+            after_id = query.get("after_id", 0)
+            datasource_name = query.get("datasource", None)
+            if "cursor" in query:
+                try:
+                    after_id, datasource_name = microblog.schema.decode_cursor(
+                        query["cursor"]
+                    )
+                except ValueError as err:
+                    return make_response(
+                        jsonify(microblog.schema.BasicError(str(err), 400)), 400
+                    )
+            with microblog.metrics.QUERY_SECONDS.time(query="get_page"):
+                messages = microblog.model.MessageEntity.get_page(
+                    session,
+                    after_id=after_id,
+                    limit=query.get("limit", DEFAULT_PAGE_LIMIT),
+                    datasource_name=datasource_name,
+                )
+            if messages:
+                after_id = messages[-1].id
+            cursor = microblog.schema.encode_cursor(after_id, datasource_name)
+            return _json_response(microblog.schema.render_messages(messages, cursor))
+
+    @app.route("/openapi/v1/messages/search")
+    @cached
+    @validate
+    def search():
+        """
+        Search messages by words, best match first
+        """
+        query = g.query
+        offset = 0
+        if "cursor" in query:
+            try:
+                offset = microblog.schema.decode_search_cursor(query["cursor"])
+            except ValueError as err:
+                return make_response(
+                    jsonify(microblog.schema.BasicError(str(err), 400)), 400
+                )
+        limit = query.get("limit", DEFAULT_SEARCH_LIMIT)
+        snippet = query.get("snippet", False)
+        with app.get_db() as session, microblog.metrics.QUERY_SECONDS.time(
+            query="search"
+        ):
+            results = microblog.model.MessageEntity.search(
+                session,
+                query["q"].split(),
+                limit=limit,
+                offset=offset,
+                datasource_name=query.get("datasource", None),
+                snippet=snippet,
+            )
+        cursor = None
+        if len(results) == limit:
+            cursor = microblog.schema.encode_search_cursor(offset + limit)
+        return _json_response(
+            microblog.schema.dumps(
+                microblog.schema.generate_search_results(results, snippet, cursor)
+            )
+        )
+
+    @app.route("/openapi/v1/stats")
+    @validate
+    def stats():
+        """
+        Rollups of the latest buckets and the backlog, read from tables
+        maintained by the writers, so it takes as long as there are buckets
+        """
+        query = g.query
+        granularity = query.get("granularity", DEFAULT_STATS_GRANULARITY)
+        with app.get_db() as session, microblog.metrics.QUERY_SECONDS.time(
+            query="stats"
+        ):
+            backlog = microblog.model.DataSource.get_backlog(session)
+            buckets = microblog.model.Rollup.get_buckets(
+                session,
+                granularity,
+                datasource_name=query.get("datasource", None),
+                since=query.get("since", None),
+                limit=query.get("limit", DEFAULT_STATS_LIMIT),
+            )
+        return _json_response(
+            microblog.schema.dumps(
+                microblog.schema.generate_stats(granularity, backlog, buckets)
+            )
+        )
+
+    @app.route("/openapi/v1/export")
+    @validate
+    def export():
+        """
+        Stream all messages as NDJSON, optionally gzip compressed.
+        Only the request is validated, the stream is never buffered.
+        """
+        query = g.query
+        filters = {
+            "datasource_name": query.get("datasource", None),
+            "min_id": query.get("min_id", None),
+            "max_id": query.get("max_id", None),
+        }
+        gzip = query.get("gzip", False)
+
+        def generate():
+            # The response outlives the request context, so it gets its own session
+            with microblog.db.get_session(read_only=read_only) as session:
+                chunks = microblog.export.generate_ndjson(session, **filters)
+                if gzip:
+                    chunks = microblog.export.gzip_chunks(chunks)
+                yield from chunks
+
+        response = Response(generate(), mimetype=microblog.export.MIMETYPE)
+        if gzip:
+            response.headers["Content-Encoding"] = "gzip"
+        return response
 
     return app
+
+
+def _json_response(body):
+    """
+    Create a response for an already encoded JSON body
+    """
+    return Response(body, mimetype="application/json")
+
+
+def _conditional_response(body, mimetype):
+    """
+    Create a response with an ETag for the body, which is turned
+    into a 304 if the client already has it
+    """
+    response = make_response(body)
+    response.mimetype = mimetype
+    response.set_etag(hashlib.blake2b(body, digest_size=16).hexdigest())
+    return response.make_conditional(request)
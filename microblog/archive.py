@@ -0,0 +1,371 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Archival of processed raw data
+Raw data which has been transferred is only kept for audit. Once older than
+the retention window it's moved out of SQLite into compressed columnar
+files, partitioned by datasource and day:
+
+    <directory>/datasource=<name>/date=<YYYY-MM-DD>/<first id>-<last id>.mbc
+
+A file starts with a magic line and a length prefixed JSON header which
+lists the columns. Every column is stored on its own and zlib compressed:
+integer columns as deltas of little endian int64 values, string columns as
+an int64 length column (-1 for NULL) followed by the UTF-8 bytes. Similar
+values next to each other is what makes it compress well.
+"""
+
+import collections
+import datetime
+import json
+import logging
+import os
+import struct
+import zlib
+import sqlalchemy
+import microblog.model
+
+MAGIC = b"MBARC1\n"
+HEADER_LENGTH = struct.Struct("<I")
+SUFFIX = ".mbc"
+COMPRESSION_LEVEL = 9
+DEFAULT_RETENTION_DAYS = 30
+DEFAULT_BATCH_SIZE = 10000
+INCREMENTAL_VACUUM = 2
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Column name and kind, in file order
+COLUMNS = [
+    ("id", "int"),
+    ("entity_id", "int"),
+    ("timestamp", "int"),
+    ("dedup_key", "str"),
+    ("data", "str"),
+]
+
+
+def get_retention_days():
+    """
+    Days processed raw data is kept in the database
+    """
+    return int(os.environ.get("MB_ARCHIVE_RETENTION_DAYS", DEFAULT_RETENTION_DAYS))
+
+
+def get_archive_directory():
+    """
+    Directory the archive files are written to
+    """
+    directory = os.environ.get("MB_ARCHIVE_PATH", None)
+    if directory is None or directory == "":
+        raise ValueError("No archive directory in config found!")
+    return directory
+
+
+def _pack_ints(values):
+    """
+    Encode integers as deltas to their predecessor
+    """
+    deltas = [current - previous for previous, current in zip([0] + values, values)]
+    return struct.pack(f"<{len(deltas)}q", *deltas)
+
+
+def _unpack_ints(data, count):
+    """
+    Decode integers encoded with _pack_ints
+    """
+    values, total = [], 0
+    for delta in struct.unpack(f"<{count}q", data):
+        total += delta
+        values.append(total)
+    return values
+
+
+def _pack_strings(values):
+    """
+    Encode strings as their lengths followed by their concatenated bytes
+    """
+    encoded = [None if value is None else value.encode() for value in values]
+    lengths = [-1 if value is None else len(value) for value in encoded]
+    return struct.pack(f"<{len(lengths)}q", *lengths) + b"".join(
+        value for value in encoded if value is not None
+    )
+
+
+def _unpack_strings(data, count):
+    """
+    Decode strings encoded with _pack_strings
+    """
+    lengths = struct.unpack_from(f"<{count}q", data)
+    values, offset = [], 8 * count
+    for length in lengths:
+        if length < 0:
+            values.append(None)
+        else:
+            values.append(data[offset : offset + length].decode())
+            offset += length
+    return values
+
+
+def _to_micros(timestamp):
+    """
+    Get a naive timestamp as microseconds since the epoch
+    """
+    return (timestamp - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def write_file(path, datasource_name, rows):
+    """
+    Write (id, entity_id, timestamp, dedup_key, data) rows to an archive
+    file, atomically and synced to disk before returning
+    """
+    columns = {
+        name: [row[index] for row in rows]
+        for index, (name, _kind) in enumerate(COLUMNS)
+    }
+    columns["timestamp"] = [_to_micros(value) for value in columns["timestamp"]]
+    blocks, header_columns = [], []
+    for name, kind in COLUMNS:
+        packed = (_pack_ints if kind == "int" else _pack_strings)(columns[name])
+        block = zlib.compress(packed, COMPRESSION_LEVEL)
+        blocks.append(block)
+        header_columns.append({"name": name, "kind": kind, "length": len(block)})
+    header = json.dumps(
+        {"datasource": datasource_name, "rows": len(rows), "columns": header_columns}
+    ).encode()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as archive_file:
+        archive_file.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+        for block in blocks:
+            archive_file.write(block)
+        archive_file.flush()
+        os.fsync(archive_file.fileno())
+    os.replace(temporary_path, path)
+    return os.path.getsize(path)
+
+
+def read_file(path):
+    """
+    Read an archive file, returns the datasource name and a list of
+    (id, entity_id, timestamp, dedup_key, data) rows
+    """
+    with open(path, "rb") as archive_file:
+        if archive_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"Not an archive file: {path}")
+        (length,) = HEADER_LENGTH.unpack(archive_file.read(HEADER_LENGTH.size))
+        header = json.loads(archive_file.read(length))
+        count = header["rows"]
+        columns = {}
+        for column in header["columns"]:
+            packed = zlib.decompress(archive_file.read(column["length"]))
+            unpack = _unpack_ints if column["kind"] == "int" else _unpack_strings
+            columns[column["name"]] = unpack(packed, count)
+    columns["timestamp"] = [
+        EPOCH + datetime.timedelta(microseconds=value) for value in columns["timestamp"]
+    ]
+    rows = list(zip(*(columns[name] for name, _kind in COLUMNS)))
+    return header["datasource"], rows
+
+
+def find_files(paths):
+    """
+    Get all archive files in the given files and directories, sorted
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _directories, files in os.walk(path):
+                found.extend(
+                    os.path.join(root, name) for name in files if name.endswith(SUFFIX)
+                )
+        else:
+            found.append(path)
+    return sorted(found)
+
+
+def get_partition_path(directory, datasource_name, rows):
+    """
+    Get the path of the archive file for rows of one datasource and day
+    """
+    return os.path.join(
+        directory,
+        f"datasource={datasource_name}",
+        f"date={rows[0][2].date().isoformat()}",
+        f"{rows[0][0]}-{rows[-1][0]}{SUFFIX}",
+    )
+
+
+def _select_batch(cutoff, last_id, batch_size):
+    """
+    Select the next batch of processed raw data older than the cutoff
+    """
+    raw = microblog.model.RawSourceData
+    return (
+        sqlalchemy.select(
+            raw.id,
+            raw.entity_id,
+            raw.timestamp,
+            raw.dedup_key,
+            raw.data,
+            microblog.model.DataSource.name.label("datasource_name"),
+        )
+        .join(
+            microblog.model.DataSource,
+            raw.datasource_id == microblog.model.DataSource.id,
+        )
+        .where(raw.id > last_id)
+        .where(raw.entity_id != None)  # pylint: disable=C0121
+        .where(raw.timestamp < cutoff)
+        .order_by(raw.id)
+        .limit(batch_size)
+    )
+
+
+def incremental_vacuum(session):
+    """
+    Return all free pages to the file system
+    """
+    # Executed as a statement the pragma only frees a single page per step,
+    # executescript steps it to the end
+    session.connection().connection.driver_connection.executescript(
+        "PRAGMA incremental_vacuum;"
+    )
+    session.commit()
+
+
+def archive(session, directory, retention_days, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Move processed raw data older than the retention window to archive
+    files, one transaction per batch. Files are synced before their rows
+    are deleted; should the deletion fail, the next run archives the rows
+    again and replay ignores the duplicates.
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+    incremental = (
+        session.execute(sqlalchemy.text("PRAGMA auto_vacuum")).scalar()
+        == INCREMENTAL_VACUUM
+    )
+    if not incremental:
+        logging.warning(
+            "Incremental vacuum is off, run VACUUM once to enable it and free space"
+        )
+    counters = {"rows": 0, "files": 0, "bytes": 0}
+    last_id = 0
+    while True:
+        rows = session.execute(_select_batch(cutoff, last_id, batch_size)).all()
+        if not rows:
+            break
+        partitions = collections.defaultdict(list)
+        for row in rows:
+            partitions[(row.datasource_name, row.timestamp.date())].append(
+                tuple(row[:5])
+            )
+        for (datasource_name, _day), partition in partitions.items():
+            path = get_partition_path(directory, datasource_name, partition)
+            counters["bytes"] += write_file(path, datasource_name, partition)
+            counters["files"] += 1
+        session.execute(
+            sqlalchemy.delete(microblog.model.RawSourceData).where(
+                microblog.model.RawSourceData.id.in_([row.id for row in rows])
+            )
+        )
+        session.commit()
+        if incremental:
+            incremental_vacuum(session)
+        last_id = rows[-1].id
+        counters["rows"] += len(rows)
+        logging.info(
+            "Archived %s raw data sets into %s files, %s bytes",
+            counters["rows"],
+            counters["files"],
+            counters["bytes"],
+        )
+    return counters
+
+
+def _get_taken_ids(session, datasource_id, rows):
+    """
+    Get the ids of archived rows which other raw data took in the meantime:
+    ids aren't reserved, new captures reuse the ids of archived rows if
+    they were the latest ones
+    """
+    raw = microblog.model.RawSourceData
+    archived = {row[0]: row for row in rows}
+    taken = set()
+    ids = list(archived)
+    for start in range(0, len(ids), DEFAULT_BATCH_SIZE):
+        stored = session.execute(
+            sqlalchemy.select(
+                raw.id, raw.datasource_id, raw.timestamp, raw.dedup_key
+            ).where(raw.id.in_(ids[start : start + DEFAULT_BATCH_SIZE]))
+        ).all()
+        for row_id, stored_datasource_id, timestamp, dedup_key in stored:
+            _, _, archived_timestamp, archived_dedup_key, _ = archived[row_id]
+            if (stored_datasource_id, timestamp, dedup_key) != (
+                datasource_id,
+                archived_timestamp,
+                archived_dedup_key,
+            ):
+                taken.add(row_id)
+    return taken
+
+
+def _is_restored(session, datasource_id, row):
+    """
+    Whether an archived row was restored with a new id before
+    """
+    raw = microblog.model.RawSourceData
+    _, _, timestamp, dedup_key, data = row
+    stored = session.scalars(
+        sqlalchemy.select(raw.data)
+        .where(raw.datasource_id == datasource_id)
+        .where(raw.timestamp == timestamp)
+        .where(raw.dedup_key.is_not_distinct_from(dedup_key))
+    ).all()
+    return data in stored
+
+
+def replay(session, paths):
+    """
+    Restore archived raw data into the database, rows still present are
+    kept. Rows whose id was taken by other raw data are restored with a new
+    id. Returns the number of rows actually restored. Only processed raw
+    data is archived, so the backlog stays as it is.
+    """
+    insert = sqlalchemy.insert(microblog.model.RawSourceData).prefix_with("OR IGNORE")
+    restored = 0
+    for path in find_files(paths):
+        datasource_name, rows = read_file(path)
+        datasource = microblog.model.DataSource.get_or_create(session, datasource_name)
+        taken = _get_taken_ids(session, datasource.id, rows)
+        values = [
+            {
+                "id": row_id,
+                "datasource_id": datasource.id,
+                "entity_id": entity_id,
+                "timestamp": timestamp,
+                "dedup_key": dedup_key,
+                "data": data,
+            }
+            for row_id, entity_id, timestamp, dedup_key, data in rows
+        ]
+        kept = [value for value in values if value["id"] not in taken]
+        moved = [
+            {name: item for name, item in value.items() if name != "id"}
+            for row, value in zip(rows, values)
+            if value["id"] in taken and not _is_restored(session, datasource.id, row)
+        ]
+        count = 0
+        if kept:
+            count += session.connection().execute(insert, kept).rowcount
+        if moved:
+            logging.warning(
+                "Ids of %s raw data sets from %s are taken, restoring them with new ids",
+                len(moved),
+                path,
+            )
+            count += session.connection().execute(insert, moved).rowcount
+        session.commit()
+        restored += count
+        logging.info("Replayed %s of %s raw data sets from %s", count, len(rows), path)
+    return restored
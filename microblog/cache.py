@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+In-memory response cache
+A bounded LRU mapping with a time to live per entry, safe to share
+between the threads of the API server.
+"""
+
+import collections
+import os
+import threading
+import time
+
+DEFAULT_SIZE = 1024
+DEFAULT_TTL = 60.0
+
+
+def get_cache_size():
+    """
+    Maximum number of cached entries, 0 disables the cache
+    """
+    return int(os.environ.get("MB_CACHE_SIZE", DEFAULT_SIZE))
+
+
+def get_cache_ttl():
+    """
+    Maximum number of seconds an entry is served from the cache
+    """
+    return float(os.environ.get("MB_CACHE_TTL", DEFAULT_TTL))
+
+
+class LRUCache:
+    """
+    Least recently used cache with expiring entries
+    """
+
+    def __init__(self, size=None, ttl=None):
+        """
+        Initialize an empty cache
+        """
+        self.size = get_cache_size() if size is None else size
+        self.ttl = get_cache_ttl() if ttl is None else ttl
+        self.entries = collections.OrderedDict()
+        self.version = None
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        """
+        Get the cached value or None if it is missing or expired
+        """
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.counters["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """
+        Cache the value, evicting the least recently used entry if full
+        """
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def set_version(self, version):
+        """
+        Drop all entries if the version of the underlying data changed,
+        entries of older versions would otherwise only ever be evicted
+        """
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+
+    def clear(self):
+        """
+        Drop all entries
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Get counters for hits, misses and evictions
+        """
+        with self.lock:
+            return {**self.counters, "entries": len(self.entries)}
@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Asynchronous capture engine
+Network I/O and persistence are decoupled: sources put received payloads
+into a bounded asyncio queue and a dedicated writer task drains it, handing
+batches to a BufferedWriter in its own thread, so a slow commit never stalls
+reading the stream. When the queue is full the policy decides: block the
+reader (backpressure), drop the payload or spill it to a file, which is
+written once the queue has drained again.
+"""
+
+import asyncio
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import tempfile
+
+POLICIES = ("block", "drop", "spill")
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_POLICY = "block"
+
+
+def get_queue_size():
+    """
+    Maximum number of received payloads waiting for the writer
+    """
+    return int(os.environ.get("MB_CAPTURE_QUEUE_SIZE", DEFAULT_QUEUE_SIZE))
+
+
+def get_policy():
+    """
+    What to do with payloads received while the queue is full
+    """
+    policy = os.environ.get("MB_CAPTURE_POLICY", DEFAULT_POLICY)
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown capture queue policy: {policy}")
+    return policy
+
+
+def get_spill_path():
+    """
+    File for payloads spilled from a full queue
+    """
+    spill_path = os.environ.get("MB_CAPTURE_SPILL_PATH", None)
+    if spill_path is None or spill_path == "":
+        spill_path = os.path.join(tempfile.gettempdir(), "microblog-capture.spill")
+    return spill_path
+
+
+class CaptureQueue:
+    """
+    Bounded queue between the stream reader and the writer task
+    """
+
+    def __init__(self, size=None, policy=None, spill_path=None):
+        """
+        Initialize an empty queue, payloads a previous run left
+        in the spill file are written once the queue runs empty
+        """
+        self.queue = asyncio.Queue(get_queue_size() if size is None else size)
+        self.policy = get_policy() if policy is None else policy
+        if self.policy not in POLICIES:
+            raise ValueError(f"Unknown capture queue policy: {self.policy}")
+        self.spill_path = get_spill_path() if spill_path is None else spill_path
+        self.spill_file = None
+        self.counters = {"received": 0, "dropped": 0, "spilled": 0, "max_depth": 0}
+
+    async def put(self, data, dedup_key=None):
+        """
+        Queue a received payload, waits for free space with the block policy
+        """
+        item = (data, datetime.datetime.now(), dedup_key)
+        self.counters["received"] += 1
+        if self.policy == "block":
+            await self.queue.put(item)
+        else:
+            try:
+                self.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                if self.policy == "drop":
+                    self.counters["dropped"] += 1
+                    logging.debug("Capture queue full, dropping payload")
+                else:
+                    self.spill(item)
+        self.counters["max_depth"] = max(self.counters["max_depth"], self.queue.qsize())
+
+    def spill(self, item):
+        """
+        Append a payload to the spill file
+        """
+        if self.spill_file is None:
+            # pylint: disable-next=R1732
+            self.spill_file = open(self.spill_path, "a", encoding="utf-8")
+        data, timestamp, dedup_key = item
+        self.spill_file.write(
+            json.dumps([data, timestamp.isoformat(), dedup_key]) + "\n"
+        )
+        self.counters["spilled"] += 1
+
+    def take_spilled(self):
+        """
+        Hand over the spill file for replay, returns its new path or None.
+        Further payloads are spilled into a new file.
+        """
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        replay_path = f"{self.spill_path}.replay"
+        if os.path.exists(replay_path):
+            # Left over by an interrupted replay, duplicates are dropped anyway
+            return replay_path
+        if not os.path.exists(self.spill_path):
+            return None
+        os.replace(self.spill_path, replay_path)
+        return replay_path
+
+    async def close(self):
+        """
+        Tell the writer task that no more payloads will follow
+        """
+        await self.queue.put(None)
+
+    def stats(self):
+        """
+        Get counters for received, dropped and spilled payloads and queue depth
+        """
+        return {**self.counters, "depth": self.queue.qsize()}
+
+
+def write_batch(writer, batch):
+    """
+    Hand a batch of queued payloads to the writer, runs in the writer thread
+    """
+    for data, timestamp, dedup_key in batch:
+        writer.add(data, timestamp, dedup_key)
+    writer.flush_if_due()
+
+
+def replay(writer, replay_path):
+    """
+    Write all payloads of a spill file and remove it, runs in the writer thread
+    """
+    count = 0
+    with open(replay_path, encoding="utf-8") as replay_file:
+        for line in replay_file:
+            data, timestamp, dedup_key = json.loads(line)
+            writer.add(data, datetime.datetime.fromisoformat(timestamp), dedup_key)
+            count += 1
+    writer.flush()
+    os.remove(replay_path)
+    logging.info("Replayed %s spilled payloads", count)
+
+
+async def run_writer(capture_queue, writer):
+    """
+    Drain the queue into the writer until the queue is closed, the writer
+    only ever runs in one dedicated thread
+    """
+    loop = asyncio.get_running_loop()
+    queue = capture_queue.queue
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="capture-writer"
+    ) as executor:
+        done = False
+        while not done:
+            try:
+                item = await asyncio.wait_for(
+                    queue.get(), timeout=max(writer.flush_interval, 0.01)
+                )
+            except asyncio.TimeoutError:
+                await loop.run_in_executor(executor, writer.flush_if_due)
+                continue
+            batch = [item]
+            while len(batch) < writer.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            done = batch[-1] is None
+            batch = [item for item in batch if item is not None]
+            await loop.run_in_executor(executor, write_batch, writer, batch)
+            if done or queue.empty():
+                replay_path = capture_queue.take_spilled()
+                if replay_path is not None:
+                    await loop.run_in_executor(executor, replay, writer, replay_path)
+        await loop.run_in_executor(executor, writer.close)
+    logging.info("Capture queue statistics: %s", capture_queue.stats())
@@ -2,60 +2,157 @@
 # -*- coding: utf-8 -*-
 """
 MicroBlog Aggregator demo pipeline CLI
+Modules with heavy dependencies like Flask, openapi_core, SQLAlchemy or the
+sources' client libraries are imported by the commands which need them,
+so e.g. printing the schema doesn't pay for all of them.
 """
 
+# Function level imports rebind the microblog package name, which is harmless
+# pylint: disable=C0415,W0621
 import sys
 import os
 import logging
-import yaml
 from docopt import docopt
 import microblog.logconf
-import microblog.api
-import microblog.source.twitter
+import microblog.metrics
+import microblog.registry
 
 DOCOPT = """
 MicroBlog Aggregator CLI
 
 Usage:
   cli.py (-h | --help)
-  cli.py serve
+  cli.py serve [--workers=<n>] [--threads=<n>]
   cli.py openapi
-  cli.py capture <source>
-  cli.py transfer <source>
+  cli.py capture <source> [--async]
+  cli.py transfer <source> [--workers=<n>] [--chunk-size=<n>] [--sql]
+  cli.py transfer <source> --follow [--chunk-size=<n>]
+  cli.py reindex
+  cli.py recompress [--codec=<codec>] [--train] [--batch-size=<n>]
+  cli.py archive [--retention-days=<n>] [--directory=<dir>] [--batch-size=<n>]
+  cli.py replay <path>...
+  cli.py export <file> [--datasource=<name>] [--min-id=<id>] [--max-id=<id>] [--gzip]
 
 Commands:
   serve           Run the server daemon
   openapi         Print the OpenAPI schema
   capture         Start capturing data for the given source
   transfer        Process and transfer raw captured data from the given source 
+  reindex         Rebuild the full-text search index of all messages, recount
+                  the stats and render missing message fragments
+  recompress      Rewrite stored raw data with another codec
+  archive         Move processed raw data out of the database into archive files
+  replay          Restore raw data from archive files or directories
+  export          Write all messages to the given file as NDJSON
 
 Options:
-  -h --help     Show this screen.
+  -h --help            Show this screen.
+  --async              Capture with asyncio, decoupling network reads and writes
+  --workers=<n>        Processes transforming raw data in parallel, or serving
+                       requests with gunicorn [default: 1]
+  --threads=<n>        Threads per serving process, implies gunicorn
+  --chunk-size=<n>     Raw data sets transferred per transaction
+  --sql                Transform within SQLite as a set-based column mapping
+  --follow             Keep running and transfer new raw data as it's captured
+  --codec=<codec>      plain, zlib or zstd, defaults to MB_RAW_CODEC
+  --train              Train a new shared dictionary for the codec first
+  --batch-size=<n>     Raw data sets recompressed or archived per transaction
+  --retention-days=<n> Days processed raw data is kept, defaults to
+                       MB_ARCHIVE_RETENTION_DAYS or 30
+  --directory=<dir>    Archive directory, defaults to MB_ARCHIVE_PATH
+  --datasource=<name>  Only export messages from this datasource
+  --min-id=<id>        Only export messages with this id or greater
+  --max-id=<id>        Only export messages with this id or less
+  --gzip               Compress the export with gzip
 
 Environment variables:
     Logging:
         LOG_LEVEL           DEBUG, INFO, WARNING or ERROR (default: INFO)
 
+    Metrics:
+        MB_METRICS          true to collect metrics, served on /metrics (default: false)
+        MB_METRICS_PATH     File the other commands periodically write metrics to
+        MB_METRICS_INTERVAL Seconds between two writes (default: 15)
+
     Connection to SQLite:
-        SQLITE_PATH         Path to SQLite database file
+        SQLITE_PATH             Path to SQLite database file
+        SQLITE_PROFILE          Pragma profile, shared or safe (default: shared)
+        SQLITE_PRAGMA_<NAME>    Override a single pragma of the profile, e.g.
+                                SQLITE_PRAGMA_BUSY_TIMEOUT=10000
+        SQLITE_POOL_SIZE        Connections kept in the pool (default: 5)
+
+    Transfer specific:
+        MB_MESSAGE_FRAGMENTS        true to store each message's JSON as served
+                                    by the API, rendered once (default: false)
+        MB_TRANSFER_POLL_INTERVAL   Max. seconds transfer --follow waits for
+                                    new raw data notifications (default: 5)
+        MB_NOTIFY_DIR               Directory of the unix sockets captures
+                                    notify following transfers on (default:
+                                    derived from the database path, in tmp)
+
+    API specific:
+        MB_API_BIND         host:port to listen on (default: 0.0.0.0:5000)
+        MB_API_TIMEOUT      Max. seconds per request and for a graceful reload
+                            with gunicorn (default: 30)
+        MB_API_VALIDATION   Responses checked against the schema: full,
+                            request, sampled or off (default: request)
+        MB_API_VALIDATION_SAMPLE_RATE
+                            Responses of which one is validated when sampled
+                            (default: 100)
+        MB_CACHE_SIZE       Cached responses, 0 disables the cache (default: 1024)
+        MB_CACHE_TTL        Max. seconds a response is cached (default: 60)
+
+    Storage specific:
+        MB_RAW_CODEC        plain, zlib or zstd to compress raw data with,
+                            zstd needs zstandard (default: plain)
+
+    Archive specific:
+        MB_ARCHIVE_PATH             Directory for archive files
+        MB_ARCHIVE_RETENTION_DAYS   Days processed raw data is kept (default: 30)
 
     Capture specific:
+        MB_INGEST_BATCH_SIZE        Raw data sets buffered per commit (default: 500)
+        MB_INGEST_FLUSH_INTERVAL    Max. seconds between commits (default: 1.0)
+        MB_INGEST_FUSED             true to store messages right away, transfer is
+                                    then only needed to reprocess (default: false)
+        MB_DEDUP_CAPACITY           Expected dedup keys per source (default: 1000000)
+        MB_DEDUP_ERROR_RATE         Bloom filter false positive rate (default: 0.01)
+        MB_CAPTURE_QUEUE_SIZE       Payloads queued for the writer with --async
+                                    (default: 10000)
+        MB_CAPTURE_POLICY           block, drop or spill when the queue is full
+                                    (default: block)
+        MB_CAPTURE_SPILL_PATH       File for spilled payloads
+                                    (default: microblog-capture.spill in tmp)
+
         Twitter:
             MB_SOURCE_TWITTER_BEARER_TOKEN    Twitter bearer token
             MB_SOURCE_TWITTER_RULE            Twitter query operator
 
+        File:
+            MB_SOURCE_FILE_PATH          NDJSON dump file, plain or gzip, or a
+                                         directory of them
+            MB_SOURCE_FILE_BATCH_SIZE    Lines per transaction (default: 100000)
+
 Return codes:
     0    OK
     1    Error
 """
 
 
-def serve():
+def serve(workers=1, threads=None):
     """
-    Start the API server
+    Start the API server, Flask's own with a single worker and no threads,
+    else gunicorn
     """
+    import microblog.api
+    import microblog.server
+
+    if workers > 1 or threads:
+        microblog.server.serve(workers, threads or 1)
+        return
     logging.debug("Starting flask app")
-    microblog.api.get_app().run(host="0.0.0.0", port="5000")
+    host, port = microblog.server.get_bind().rsplit(":", 1)
+    microblog.api.get_app().run(host=host, port=port)
     logging.debug("Flask app exited!")
 
 
@@ -63,6 +160,9 @@ def openapi():
     """
     Print the current OpenAPI schema as YAML
     """
+    import yaml
+    import microblog.schema
+
     schema = yaml.dump(microblog.schema.SCHEMA_V1)
     print(schema)
 
@@ -81,48 +181,195 @@ def get_arguments_for_source(source_name):
     return src_args
 
 
-def capture(source, arguments):
+def capture(source, arguments, use_async=False):
     """
     Run capture operation on given source
     """
-    # Here we're hardcoding the source for demonstration purposes,
-    # in a real world use case we'd rather look them up dynamically.
-    if source == "twitter":
-        microblog.source.twitter.capture(arguments)
+    source_module = microblog.registry.get_source(source)
+    if not use_async:
+        source_module.capture(arguments)
+    elif hasattr(source_module, "capture_async"):
+        source_module.capture_async(arguments)
     else:
-        logging.error("Invalid value for source: %s", source)
-        raise ValueError(f"Unknown source: {source}")
+        raise ValueError(f"Source {source} has no asynchronous capture")
 
 
-def transfer(source):
+def transfer(source, workers=1, chunk_size=None, sql=False):
     """
     Run transfer operation on given source
     """
-    # Here we're hardcoding the source for demonstration purposes,
-    # in a real world use case we'd rather look them up dynamically.
-    if source == "twitter":
-        microblog.source.twitter.transfer()
-    else:
-        logging.error("Invalid value for source: %s", source)
-        raise ValueError(f"Unknown source: {source}")
+    microblog.registry.get_source(source).transfer(workers, chunk_size, sql)
+
+
+def transfer_follow(source, chunk_size=None):
+    """
+    Keep transferring raw data of the given source as it's captured
+    """
+    import microblog.db
+    import microblog.transfer
+
+    source_module = microblog.registry.get_source(source)
+    with microblog.db.get_session() as session:
+        microblog.transfer.follow(
+            session,
+            source_module.get_datasource(session),
+            source_module.extract,
+            max_batch_size=chunk_size
+            or microblog.transfer.DEFAULT_FOLLOW_MAX_BATCH_SIZE,
+        )
+
+
+def reindex():
+    """
+    Rebuild the full-text search index, recount the rollups and backlogs
+    and render missing message fragments
+    """
+    import microblog.db
+    import microblog.model
+    import microblog.transfer
+
+    with microblog.db.get_session() as session:
+        microblog.model.MessageEntity.rebuild_search_index(session)
+        logging.info("Rebuilt the search index")
+        microblog.model.Rollup.rebuild(session)
+        session.commit()
+        logging.info("Recounted the rollups and backlogs")
+        if microblog.transfer.stores_fragments():
+            microblog.model.MessageEntity.render_fragments(session)
+            session.commit()
+            logging.info("Rendered missing message fragments")
+
+
+def recompress(codec=None, train=False, batch_size=None):
+    """
+    Rewrite all raw data with the given codec and its latest dictionary
+    """
+    import microblog.compression
+    import microblog.db
+
+    if codec is None:
+        codec = microblog.compression.get_codec_name()
+    with microblog.db.get_session() as session:
+        dictionary_id = None
+        if train:
+            dictionary_id = microblog.compression.store_dictionary(session, codec)
+        elif codec != "plain":
+            dictionary_id = microblog.compression.get_latest_dictionary_id(codec)
+        counters = microblog.compression.recompress(
+            session,
+            codec,
+            dictionary_id,
+            batch_size or microblog.compression.DEFAULT_RECOMPRESS_BATCH_SIZE,
+        )
+    logging.info(
+        "Recompressed %s of %s raw data sets, run VACUUM to reclaim freed space",
+        counters["recompressed"],
+        counters["rows"],
+    )
+
+
+def archive(retention_days=None, directory=None, batch_size=None):
+    """
+    Archive processed raw data older than the retention window
+    """
+    import microblog.archive
+    import microblog.db
+
+    if retention_days is None:
+        retention_days = microblog.archive.get_retention_days()
+    if directory is None:
+        directory = microblog.archive.get_archive_directory()
+    with microblog.db.get_session() as session:
+        counters = microblog.archive.archive(
+            session,
+            directory,
+            retention_days,
+            batch_size or microblog.archive.DEFAULT_BATCH_SIZE,
+        )
+    logging.info("Archived %s raw data sets to %s", counters["rows"], directory)
 
 
-def arg_runner(arguments):
+def replay(paths):
+    """
+    Restore archived raw data from the given files and directories
+    """
+    import microblog.archive
+    import microblog.db
+
+    with microblog.db.get_session() as session:
+        restored = microblog.archive.replay(session, paths)
+    logging.info("Replayed %s raw data sets", restored)
+
+
+def export(path, gzip=False, **filters):
+    """
+    Export all messages matching the filters to the given file
+    """
+    import microblog.db
+    import microblog.export
+
+    with microblog.db.get_session() as session, open(path, "wb") as output:
+        written = microblog.export.export(session, output, gzip, **filters)
+    logging.info("Exported %s bytes to %s", written, path)
+
+
+def arg_runner(arguments):  # pylint: disable=R0911
     """
     CLI argument evaluator and runner
     """
     if arguments["serve"]:
-        serve()
+        threads = arguments["--threads"]
+        serve(int(arguments["--workers"]), int(threads) if threads else None)
         return 0
     if arguments["openapi"]:
         openapi()
         return 0
     if arguments["capture"] and arguments["<source>"]:
         src_args = get_arguments_for_source(arguments["<source>"])
-        capture(arguments["<source>"], src_args)
+        capture(arguments["<source>"], src_args, arguments["--async"])
         return 0
     if arguments["transfer"] and arguments["<source>"]:
-        transfer(arguments["<source>"])
+        chunk_size = arguments["--chunk-size"]
+        if arguments["--follow"]:
+            transfer_follow(
+                arguments["<source>"], int(chunk_size) if chunk_size else None
+            )
+            return 0
+        transfer(
+            arguments["<source>"],
+            int(arguments["--workers"]),
+            int(chunk_size) if chunk_size else None,
+            arguments["--sql"],
+        )
+        return 0
+    batch_size = arguments["--batch-size"]
+    batch_size = int(batch_size) if batch_size else None
+    if arguments["reindex"]:
+        reindex()
+        return 0
+    if arguments["recompress"]:
+        recompress(arguments["--codec"], arguments["--train"], batch_size)
+        return 0
+    if arguments["archive"]:
+        retention_days = arguments["--retention-days"]
+        archive(
+            int(retention_days) if retention_days else None,
+            arguments["--directory"],
+            batch_size,
+        )
+        return 0
+    if arguments["replay"] and arguments["<path>"]:
+        replay(arguments["<path>"])
+        return 0
+    if arguments["export"] and arguments["<file>"]:
+        min_id, max_id = arguments["--min-id"], arguments["--max-id"]
+        export(
+            arguments["<file>"],
+            arguments["--gzip"],
+            datasource_name=arguments["--datasource"],
+            min_id=int(min_id) if min_id else None,
+            max_id=int(max_id) if max_id else None,
+        )
         return 0
     logging.error("Encountered unknown argument constellation. This is a bug!")
     return 1
@@ -135,7 +382,8 @@ def entrypoint():
     microblog.logconf.set_logging(microblog.logconf.LogConfig.CLI)
     logging.debug("Starting CLI")
     try:
-        result = arg_runner(docopt(DOCOPT))
+        with microblog.metrics.dumping():
+            result = arg_runner(docopt(DOCOPT))
     except Exception as err:  # pylint: disable=W0703
         logging.error("Fatal error: %s", err)
         if logging.DEBUG >= logging.root.level:
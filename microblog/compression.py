@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Compressed raw payload storage
+Raw payloads are stored either as plain text, like all rows written before
+compression existed, or as a BLOB starting with a format header: one tag
+byte for the codec and the id of the shared dictionary it was compressed
+with (0 for none). Small JSON documents compress poorly on their own, a
+dictionary trained from stored payloads provides the common parts.
+zstd needs the optional zstandard package, zlib is always available.
+"""
+
+import datetime
+import logging
+import os
+import struct
+import threading
+import zlib
+import sqlalchemy
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODECS = ("plain", "zlib", "zstd")
+DEFAULT_CODEC = "plain"
+TAGS = {"zlib": 1, "zstd": 2}
+HEADER = struct.Struct(">BI")
+# zlib only ever looks back 32 KiB, a larger dictionary would be wasted
+ZLIB_DICTIONARY_SIZE = 32768
+ZSTD_DICTIONARY_SIZE = 65536
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+DEFAULT_SAMPLE_SIZE = 5000
+DEFAULT_RECOMPRESS_BATCH_SIZE = 1000
+
+_DICTIONARIES = {}
+_LOADERS = []
+_LOCK = threading.Lock()
+_ENCODERS = {}
+_ZSTD_DICTIONARIES = {}
+
+
+def get_codec_name():
+    """
+    Get the codec new raw payloads are stored with
+    """
+    codec = os.environ.get("MB_RAW_CODEC", DEFAULT_CODEC)
+    if codec not in CODECS:
+        raise ValueError(f"Unknown raw data codec: {codec}")
+    if codec == "zstd" and zstandard is None:
+        raise ValueError("The zstd codec requires the zstandard package")
+    return codec
+
+
+def add_dictionary_loader(loader):
+    """
+    Register a callable returning (id, codec, data) rows of all stored
+    dictionaries, used whenever an unknown dictionary is referenced
+    """
+    with _LOCK:
+        _LOADERS.append(loader)
+
+
+def reset():
+    """
+    Forget all loaded dictionaries, loaders and encoders
+    """
+    with _LOCK:
+        _DICTIONARIES.clear()
+        _LOADERS.clear()
+        _ENCODERS.clear()
+        _ZSTD_DICTIONARIES.clear()
+
+
+def _load_dictionaries():
+    """
+    Load all stored dictionaries through the registered loaders
+    """
+    with _LOCK:
+        loaders = list(_LOADERS)
+    for loader in loaders:
+        for dictionary_id, codec, data in loader():
+            _DICTIONARIES[dictionary_id] = (codec, bytes(data))
+
+
+def get_dictionary(dictionary_id):
+    """
+    Get (codec, data) of the dictionary, raises LookupError if it is unknown
+    """
+    if dictionary_id not in _DICTIONARIES:
+        _load_dictionaries()
+    if dictionary_id not in _DICTIONARIES:
+        raise LookupError(f"Unknown compression dictionary: {dictionary_id}")
+    return _DICTIONARIES[dictionary_id]
+
+
+def get_latest_dictionary_id(codec):
+    """
+    Get the id of the most recent dictionary for the codec, None without one
+    """
+    _load_dictionaries()
+    ids = [key for key, (name, _data) in _DICTIONARIES.items() if name == codec]
+    return max(ids) if ids else None
+
+
+def _get_zstd_dictionary(dictionary_id):
+    """
+    Get the prepared zstd dictionary, parsed only once per process
+    """
+    prepared = _ZSTD_DICTIONARIES.get(dictionary_id, None)
+    if prepared is None:
+        prepared = zstandard.ZstdCompressionDict(get_dictionary(dictionary_id)[1])
+        _ZSTD_DICTIONARIES[dictionary_id] = prepared
+    return prepared
+
+
+def train_dictionary(codec, samples):
+    """
+    Build a dictionary for the codec from sample payloads
+    """
+    samples = [sample.encode() for sample in samples]
+    if codec == "zstd":
+        return zstandard.train_dictionary(ZSTD_DICTIONARY_SIZE, samples).as_bytes()
+    if codec == "zlib":
+        # zlib has no training, its dictionary is plain text to match against.
+        # Matches are cheapest close to the end, so the samples go in last
+        # to first, truncated to what zlib can see.
+        return b"".join(reversed(samples))[-ZLIB_DICTIONARY_SIZE:]
+    raise ValueError(f"Codec {codec} doesn't use dictionaries")
+
+
+class Encoder:  # pylint: disable=R0903
+    """
+    Compressor for one codec and dictionary
+    """
+
+    def __init__(self, codec, dictionary_id=None):
+        """
+        Initialize the encoder, dictionary_id None means no dictionary
+        """
+        self.codec = codec
+        self.header = (
+            b"" if codec == "plain" else HEADER.pack(TAGS[codec], dictionary_id or 0)
+        )
+        self.dictionary = (
+            get_dictionary(dictionary_id)[1] if dictionary_id is not None else None
+        )
+        if codec == "zstd":
+            self.compressor = zstandard.ZstdCompressor(
+                level=ZSTD_LEVEL,
+                dict_data=(
+                    _get_zstd_dictionary(dictionary_id)
+                    if dictionary_id is not None
+                    else None
+                ),
+            )
+
+    def encode(self, text):
+        """
+        Get the stored representation of a payload
+        """
+        if self.codec == "plain":
+            return text
+        data = text.encode()
+        if self.codec == "zstd":
+            return self.header + self.compressor.compress(data)
+        if self.dictionary is None:
+            return self.header + zlib.compress(data, ZLIB_LEVEL)
+        compressor = zlib.compressobj(ZLIB_LEVEL, zdict=self.dictionary)
+        return self.header + compressor.compress(data) + compressor.flush()
+
+
+def get_encoder(codec=None, dictionary_id=None):
+    """
+    Get the encoder for the codec, by default the configured one with its
+    latest dictionary. Encoders are cached, which is safe since stored
+    dictionaries never change.
+    """
+    if codec is None:
+        codec = get_codec_name()
+        encoder = _ENCODERS.get(codec, None)
+        if encoder is None:
+            # Resolved once, a dictionary trained later is used after a restart
+            if codec != "plain":
+                dictionary_id = get_latest_dictionary_id(codec)
+            encoder = get_encoder(codec, dictionary_id)
+            _ENCODERS[codec] = encoder
+        return encoder
+    key = (codec, dictionary_id)
+    encoder = _ENCODERS.get(key, None)
+    if encoder is None:
+        encoder = Encoder(codec, dictionary_id)
+        _ENCODERS[key] = encoder
+    return encoder
+
+
+def encode(text):
+    """
+    Store a payload with the configured codec
+    """
+    return get_encoder().encode(text)
+
+
+def decode(value):
+    """
+    Get the payload text of a stored value, whatever format it is in
+    """
+    if value is None or isinstance(value, str):
+        return value
+    tag, dictionary_id = HEADER.unpack_from(value)
+    data = memoryview(value)[HEADER.size :]
+    if tag == TAGS["zlib"]:
+        dictionary = get_dictionary(dictionary_id)[1] if dictionary_id else None
+        if dictionary is None:
+            return zlib.decompress(data).decode()
+        return zlib.decompressobj(zdict=dictionary).decompress(data).decode()
+    if tag == TAGS["zstd"]:
+        if zstandard is None:
+            raise ValueError("Reading zstd payloads requires the zstandard package")
+        decompressor = zstandard.ZstdDecompressor(
+            dict_data=_get_zstd_dictionary(dictionary_id) if dictionary_id else None
+        )
+        return decompressor.decompress(data).decode()
+    raise ValueError(f"Unknown raw data format: {tag}")
+
+
+def get_format(value):
+    """
+    Get (codec, dictionary_id) of a stored value
+    """
+    if isinstance(value, str):
+        return "plain", None
+    tag, dictionary_id = HEADER.unpack_from(value)
+    codec = {number: name for name, number in TAGS.items()}[tag]
+    return codec, dictionary_id or None
+
+
+def register_functions(dbapi_connection, _connection_record):
+    """
+    Connect event listener making mb_payload(data) available in SQL,
+    e.g. to run json_extract on compressed payloads
+    """
+    dbapi_connection.create_function("mb_payload", 1, decode, deterministic=True)
+
+
+def _stored_size(value):
+    """
+    Get the number of bytes a stored value takes
+    """
+    return len(value.encode()) if isinstance(value, str) else len(value)
+
+
+def store_dictionary(session, codec, sample_size=DEFAULT_SAMPLE_SIZE):
+    """
+    Train a dictionary for the codec from the most recent raw payloads
+    and store it, returns its id
+    """
+    samples = [
+        decode(value)
+        for (value,) in session.execute(
+            sqlalchemy.text(
+                "SELECT data FROM rawsourcedata ORDER BY id DESC LIMIT :count"
+            ),
+            {"count": sample_size},
+        )
+    ]
+    data = train_dictionary(codec, samples)
+    dictionary_id = session.execute(
+        sqlalchemy.text(
+            "INSERT INTO compressiondictionary (codec, data, created) "
+            "VALUES (:codec, :data, :created)"
+        ),
+        {"codec": codec, "data": data, "created": datetime.datetime.now()},
+    ).lastrowid
+    session.commit()
+    logging.info(
+        "Trained %s byte %s dictionary %s from %s payloads",
+        len(data),
+        codec,
+        dictionary_id,
+        len(samples),
+    )
+    return dictionary_id
+
+
+def recompress(
+    session, codec, dictionary_id=None, batch_size=DEFAULT_RECOMPRESS_BATCH_SIZE
+):
+    """
+    Rewrite all raw payloads not yet stored in the given format, one
+    transaction per batch, returns counters of rows and bytes
+    """
+    encoder = get_encoder(codec, dictionary_id)
+    total = session.scalar(sqlalchemy.text("SELECT count(*) FROM rawsourcedata"))
+    counters = {"rows": 0, "recompressed": 0, "bytes_before": 0, "bytes_after": 0}
+    last_id = 0
+    while True:
+        rows = session.execute(
+            sqlalchemy.text(
+                "SELECT id, data FROM rawsourcedata WHERE id > :last_id "
+                "ORDER BY id LIMIT :count"
+            ),
+            {"last_id": last_id, "count": batch_size},
+        ).all()
+        if not rows:
+            break
+        updates = []
+        for row_id, value in rows:
+            size = _stored_size(value)
+            counters["bytes_before"] += size
+            if get_format(value) == (codec, dictionary_id):
+                counters["bytes_after"] += size
+                continue
+            stored = encoder.encode(decode(value))
+            counters["bytes_after"] += _stored_size(stored)
+            updates.append({"id": row_id, "data": stored})
+        if updates:
+            session.execute(
+                sqlalchemy.text("UPDATE rawsourcedata SET data = :data WHERE id = :id"),
+                updates,
+            )
+        session.commit()
+        last_id = rows[-1][0]
+        counters["rows"] += len(rows)
+        counters["recompressed"] += len(updates)
+        logging.info(
+            "Recompressed %s of %s raw data sets (%.1f%%), %s bytes down to %s",
+            counters["rows"],
+            total,
+            100.0 * counters["rows"] / max(total, 1),
+            counters["bytes_before"],
+            counters["bytes_after"],
+        )
+    return counters
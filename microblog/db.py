@@ -9,22 +9,192 @@ config and configuring them here.
 
 import logging
 import os
+import threading
+import sqlalchemy.event
 import sqlalchemy.orm
+import sqlalchemy.pool
+import microblog.compression
+import microblog.dedup
+import microblog.migrations
 import microblog.model
 
+# Pragma profiles applied to every new SQLite connection. "shared" lets
+# capture, transfer and serve work on the same database file concurrently,
+# "safe" keeps SQLite's conservative defaults for journaling and syncing.
+# auto_vacuum only takes effect on new databases and must come before
+# journal_mode, existing ones need a single VACUUM to switch.
+PRAGMA_PROFILES = {
+    "shared": {
+        "auto_vacuum": "INCREMENTAL",
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 268435456,
+        "cache_size": -65536,
+        "busy_timeout": 5000,
+    },
+    "safe": {
+        "auto_vacuum": "INCREMENTAL",
+        "journal_mode": "DELETE",
+        "synchronous": "FULL",
+        "mmap_size": 0,
+        "cache_size": -2000,
+        "busy_timeout": 5000,
+    },
+}
 
-def get_session(create_tables=True):
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+# Process the cached engines belong to, a forked worker must not use them
+_STATE = {"pid": os.getpid()}
+
+
+def get_database_url():
     """
-    Initialize the database connection.
+    Get the database URL from the environment
     """
     sqlite_path = os.environ.get("SQLITE_PATH", None)
     if sqlite_path is None or sqlite_path == "":
         raise ValueError("No valid database connection in config found!")
-    connection = f"sqlite:///{sqlite_path}"
-    logging.info("Connecting to: %s", connection)
-    engine = sqlalchemy.create_engine(connection)
-    if create_tables:
-        base = microblog.model.Base
-        base.metadata.create_all(engine)
+    return f"sqlite:///{sqlite_path}"
+
+
+def get_pragmas():
+    """
+    Get the pragmas of the configured profile, single pragmas
+    may be overridden with SQLITE_PRAGMA_<NAME> environment variables
+    """
+    profile = os.environ.get("SQLITE_PROFILE", "shared")
+    if profile not in PRAGMA_PROFILES:
+        raise ValueError(f"Unknown SQLite pragma profile: {profile}")
+    pragmas = dict(PRAGMA_PROFILES[profile])
+    for name in pragmas:
+        override = os.environ.get(f"SQLITE_PRAGMA_{name.upper()}", None)
+        if override is not None and override != "":
+            pragmas[name] = override
+    return pragmas
+
+
+def _set_pragmas(pragmas):
+    """
+    Create a connect event listener that applies the given pragmas
+    """
+
+    def on_connect(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return on_connect
+
+
+def _forget_inherited_engines():
+    """
+    Drop the engines inherited from the parent after a fork, without
+    closing their connections, which still belong to the parent
+    """
+    if _STATE["pid"] == os.getpid():
+        return
+    for engine in _ENGINES.values():
+        engine.dispose(close=False)
+    _ENGINES.clear()
+    microblog.compression.reset()
+    _STATE["pid"] = os.getpid()
+
+
+def get_engine(url=None, create_tables=True, read_only=False):
+    """
+    Get the process-wide engine for the given database URL.
+    Engines are created once per URL and process, including their
+    connection pool and, if requested, the schema creation.
+    Read-only engines set query_only on their connections and never touch
+    the schema, a regular engine must have created it before.
+    """
+    if url is None:
+        url = get_database_url()
+    with _ENGINES_LOCK:
+        _forget_inherited_engines()
+        engine = _ENGINES.get((url, read_only), None)
+        if engine is None:
+            logging.info("Connecting to: %s", url)
+            engine = sqlalchemy.create_engine(
+                url,
+                poolclass=sqlalchemy.pool.QueuePool,
+                pool_size=int(os.environ.get("SQLITE_POOL_SIZE", 5)),
+                connect_args={"check_same_thread": False},
+            )
+            pragmas = get_pragmas()
+            if read_only:
+                pragmas["query_only"] = "ON"
+            sqlalchemy.event.listen(engine, "connect", _set_pragmas(pragmas))
+            sqlalchemy.event.listen(
+                engine, "connect", microblog.compression.register_functions
+            )
+            sqlalchemy.event.listen(
+                engine, "connect", microblog.dedup.register_functions
+            )
+            if create_tables and not read_only:
+                microblog.model.Base.metadata.create_all(engine)
+                microblog.migrations.migrate(engine)
+            if create_tables or read_only:
+                microblog.compression.add_dictionary_loader(_dictionary_loader(engine))
+            _ENGINES[(url, read_only)] = engine
+    return engine
+
+
+def warm_up(engine):
+    """
+    Open all connections of the engine's pool at once and read the latest
+    messages through each, so the first requests neither pay for connecting
+    nor for loading the pages they need
+    """
+    connections = [engine.connect() for _ in range(engine.pool.size())]
+    try:
+        for connection in connections:
+            connection.execute(
+                sqlalchemy.select(microblog.model.MessageEntity.id)
+                .order_by(microblog.model.MessageEntity.id.desc())
+                .limit(100)
+            ).all()
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def _dictionary_loader(engine):
+    """
+    Create a loader for the compression dictionaries stored in the database
+    """
+
+    def load():
+        with engine.connect() as connection:
+            return connection.execute(
+                sqlalchemy.select(
+                    microblog.model.CompressionDictionary.id,
+                    microblog.model.CompressionDictionary.codec,
+                    microblog.model.CompressionDictionary.data,
+                )
+            ).all()
+
+    return load
+
+
+def dispose_engines():
+    """
+    Close all pooled connections and forget the cached engines
+    """
+    with _ENGINES_LOCK:
+        for engine in _ENGINES.values():
+            engine.dispose()
+        _ENGINES.clear()
+    microblog.compression.reset()
+
+
+def get_session(create_tables=True, read_only=False):
+    """
+    Initialize the database connection.
+    Tables are created only once, when the engine is created.
+    """
+    engine = get_engine(create_tables=create_tables, read_only=read_only)
     session = sqlalchemy.orm.Session(bind=engine, expire_on_commit=False)
     return session
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Deduplication of captured and transferred data
+Rows carry a dedup key per datasource (the source's external id or a
+content hash) guarded by a unique index. An in-memory Bloom filter
+rebuilt from the database at startup answers most lookups for new keys
+without touching SQLite.
+"""
+
+import hashlib
+import logging
+import math
+import os
+import sqlalchemy
+
+DEFAULT_CAPACITY = 1000000
+DEFAULT_ERROR_RATE = 0.01
+
+
+def content_hash(data):
+    """
+    Get the dedup key for raw data without an external id
+    """
+    return hashlib.sha256(str(data).encode()).hexdigest()
+
+
+def _sql_content_hash(data):
+    """
+    content_hash for SQL, NULL stays NULL
+    """
+    return None if data is None else content_hash(data)
+
+
+def register_functions(dbapi_connection, _connection_record):
+    """
+    Connect event listener making mb_content_hash(data) available in SQL,
+    so the set-based transfer keys raw data like extract() does
+    """
+    dbapi_connection.create_function(
+        "mb_content_hash", 1, _sql_content_hash, deterministic=True
+    )
+
+
+class BloomFilter:
+    """
+    Probabilistic set: no false negatives, false positives at the given rate
+    """
+
+    def __init__(self, capacity, error_rate):
+        """
+        Initialize an empty filter sized for capacity keys
+        """
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return ((first + idx * second) % self.size for idx in range(self.hashes))
+
+    def add(self, key):
+        """
+        Add the key to the filter
+        """
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+
+class Deduplicator:
+    """
+    Lookup of dedup keys for one model and datasource, backed by
+    the unique index with a Bloom filter in front
+    """
+
+    def __init__(self, session, model, datasource_id):
+        """
+        Initialize the deduplicator and rebuild its filter from the database
+        """
+        self.session = session
+        self.model = model
+        self.datasource_id = datasource_id
+        # Keys of rows which are about to be written but are not yet committed
+        self.pending = {}
+        self.counters = {
+            "duplicates": 0,
+            "unique": 0,
+            "lookups": 0,
+            "false_positives": 0,
+        }
+        self.bloom = self.load()
+
+    def load(self):
+        """
+        Build the Bloom filter from all keys stored for the datasource
+        """
+        count = self.session.scalar(
+            sqlalchemy.select(sqlalchemy.func.count(self.model.dedup_key)).where(
+                self.model.datasource_id == self.datasource_id
+            )
+        )
+        bloom = BloomFilter(
+            max(int(os.environ.get("MB_DEDUP_CAPACITY", DEFAULT_CAPACITY)), 2 * count),
+            float(os.environ.get("MB_DEDUP_ERROR_RATE", DEFAULT_ERROR_RATE)),
+        )
+        for (key,) in self.session.execute(
+            sqlalchemy.select(self.model.dedup_key)
+            .where(self.model.datasource_id == self.datasource_id)
+            .where(self.model.dedup_key != None)  # pylint: disable=C0121
+        ):
+            bloom.add(key)
+        logging.debug("Loaded %s dedup keys for %s", count, self.model.__tablename__)
+        return bloom
+
+    def lookup(self, key):
+        """
+        Get the id of the row already stored with this key, or the value
+        remembered for a pending row, or None if the key is new
+        """
+        if key in self.pending:
+            self.counters["duplicates"] += 1
+            return self.pending[key]
+        if key not in self.bloom:
+            self.counters["unique"] += 1
+            return None
+        self.counters["lookups"] += 1
+        row_id = self.session.scalar(
+            sqlalchemy.select(self.model.id)
+            .where(self.model.datasource_id == self.datasource_id)
+            .where(self.model.dedup_key == key)
+        )
+        if row_id is None:
+            self.counters["false_positives"] += 1
+            self.counters["unique"] += 1
+        else:
+            self.counters["duplicates"] += 1
+        return row_id
+
+    def remember(self, key, value):
+        """
+        Remember a new key, value identifies the pending row to the caller
+        """
+        self.bloom.add(key)
+        self.pending[key] = value
+
+    def reset_pending(self):
+        """
+        Forget pending rows after a commit, from then on they are found in
+        the database, or after a rollback, when they were not written at all
+        """
+        self.pending = {}
+
+    def stats(self):
+        """
+        Get counters for duplicates, unique keys and database lookups
+        """
+        return dict(self.counters)
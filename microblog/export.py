@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Bulk export of message entities
+Messages are read through a single streaming query and written as NDJSON,
+one message per line, optionally gzip compressed. Only one chunk of rows
+is held in memory at a time, whatever the size of the table.
+"""
+
+import zlib
+import sqlalchemy
+import microblog.model
+import microblog.schema
+
+DEFAULT_CHUNK_SIZE = 1000
+MIMETYPE = "application/x-ndjson"
+
+
+def select_messages(datasource_name=None, min_id=None, max_id=None):
+    """
+    Build the export query in id order, bounds are inclusive
+    """
+    entity = microblog.model.MessageEntity
+    query = entity.select_projection().order_by(entity.id)
+    if min_id is not None:
+        query = query.where(entity.id >= min_id)
+    if max_id is not None:
+        query = query.where(entity.id <= max_id)
+    if datasource_name is not None:
+        query = query.where(
+            entity.datasource_id
+            == sqlalchemy.select(microblog.model.DataSource.id)
+            .where(microblog.model.DataSource.name == datasource_name)
+            .scalar_subquery()
+        )
+    return query
+
+
+def generate_ndjson(  # pylint: disable=R0913
+    session,
+    datasource_name=None,
+    min_id=None,
+    max_id=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+):
+    """
+    Yield the selected messages as NDJSON, one bytes chunk per chunk of rows
+    """
+    result = session.execute(
+        select_messages(datasource_name, min_id, max_id).execution_options(
+            yield_per=chunk_size
+        )
+    )
+    for rows in result.partitions():
+        yield b"".join(
+            (
+                row.fragment
+                or microblog.schema.render_message(
+                    row.id, row.datasource_name, row.message
+                )
+            )
+            + b"\n"
+            for row in rows
+        )
+
+
+def gzip_chunks(chunks):
+    """
+    Compress a stream of bytes chunks into a gzip stream
+    """
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export(session, output, gzip=False, **filters):
+    """
+    Write the export to a binary file object, returns the number of bytes
+    """
+    chunks = generate_ndjson(session, **filters)
+    if gzip:
+        chunks = gzip_chunks(chunks)
+    written = 0
+    for chunk in chunks:
+        output.write(chunk)
+        written += len(chunk)
+    return written
@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Buffered raw data ingest
+Sources hand their raw payloads to a writer which collects them in memory
+and persists them in a single bulk insert transaction (group commit) once
+a size or time threshold is hit.
+In fused mode the writer also transforms each payload into its message
+right away and stores both in the same transaction, the raw data already
+linked to its message, so no separate transfer is needed.
+"""
+
+import collections
+import datetime
+import logging
+import os
+import time
+import sqlalchemy
+import microblog.dedup
+import microblog.metrics
+import microblog.model
+import microblog.notify
+import microblog.transfer
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+def get_batch_size():
+    """
+    Maximum number of buffered payloads before a flush is forced
+    """
+    return int(os.environ.get("MB_INGEST_BATCH_SIZE", DEFAULT_BATCH_SIZE))
+
+
+def get_flush_interval():
+    """
+    Maximum number of seconds a payload may stay buffered
+    """
+    return float(os.environ.get("MB_INGEST_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL))
+
+
+def is_fused():
+    """
+    Whether captures store messages right away instead of leaving them
+    to the transfer
+    """
+    return os.environ.get("MB_INGEST_FUSED", "false") == "true"
+
+
+class BufferedWriter:  # pylint: disable=R0902
+    """
+    Group-commit writer for raw source data
+    """
+
+    def __init__(  # pylint: disable=R0913
+        self,
+        session,
+        datasource,
+        batch_size=None,
+        flush_interval=None,
+        deduplicator=None,
+        *,
+        extract=None,
+    ):
+        """
+        Initialize a new writer for the given session and datasource,
+        payloads with a known dedup key are dropped if a deduplicator is given.
+        With the source's extract function the writer runs in fused mode.
+        """
+        self.session = session
+        self.datasource_id = datasource.id
+        self.deduplicator = deduplicator
+        self.extract = extract
+        self.entity_deduplicator = (
+            None
+            if extract is None
+            else microblog.dedup.Deduplicator(
+                session, microblog.model.MessageEntity, datasource.id
+            )
+        )
+        self.batch_size = get_batch_size() if batch_size is None else batch_size
+        self.flush_interval = (
+            get_flush_interval() if flush_interval is None else flush_interval
+        )
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.counters = {
+            "flushes": 0,
+            "rows_written": 0,
+            "max_buffer_depth": 0,
+            "last_flush_latency": 0.0,
+            "max_flush_latency": 0.0,
+            "total_flush_latency": 0.0,
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
+
+    def add(self, data, timestamp=None, dedup_key=None, message=None):
+        """
+        Buffer a raw payload and flush if a threshold is hit. In fused mode
+        the message is extracted from the payload unless it's given.
+        """
+        if self.deduplicator is not None and dedup_key is not None:
+            if self.deduplicator.lookup(dedup_key) is not None:
+                logging.debug("Dropping duplicate raw data with key %s", dedup_key)
+                return
+            self.deduplicator.remember(dedup_key, True)
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+        data = str(data)
+        if self.extract is not None and message is None:
+            message, extracted_key = self.extract(data)
+            dedup_key = dedup_key or extracted_key
+        self.buffer.append((data, timestamp, dedup_key, message))
+        self.counters["max_buffer_depth"] = max(
+            self.counters["max_buffer_depth"], len(self.buffer)
+        )
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """
+        Flush the buffer if the last flush is longer ago than the interval
+        """
+        if self.buffer and time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Persist all buffered payloads within a single transaction
+        """
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        start = time.perf_counter()
+        rows = [
+            {
+                "datasource_id": self.datasource_id,
+                "data": data,
+                "timestamp": timestamp,
+                "entity_id": None,
+                "dedup_key": dedup_key,
+            }
+            for data, timestamp, dedup_key, _message in self.buffer
+        ]
+        if self.extract is None:
+            self.insert_raw(self.session, rows)
+            self.session.commit()
+        else:
+            self.write_fused(rows)
+        microblog.notify.notify(self.session.get_bind().url)
+        if self.deduplicator is not None:
+            self.deduplicator.reset_pending()
+        latency = time.perf_counter() - start
+        self.buffer = []
+        self.counters["flushes"] += 1
+        self.counters["rows_written"] += len(rows)
+        self.counters["last_flush_latency"] = latency
+        self.counters["max_flush_latency"] = max(
+            self.counters["max_flush_latency"], latency
+        )
+        self.counters["total_flush_latency"] += latency
+        logging.debug("Flushed %s raw data sets in %.4fs", len(rows), latency)
+
+    @staticmethod
+    def insert_raw(session, rows, returning=False):
+        """
+        Insert raw data rows, dropping the ones with a dedup key already
+        stored, and count them in the rollups. With returning, the (id,
+        dedup_key) rows of the raw data actually inserted are returned.
+        """
+        # The unique dedup key index has the final say, e.g. on concurrent captures
+        insert = sqlalchemy.insert(microblog.model.RawSourceData).prefix_with(
+            "OR IGNORE"
+        )
+        if not returning:
+            result = session.connection().execute(insert, rows)
+            microblog.model.Rollup.add_captured(session, result.rowcount)
+            return None
+        inserted = (
+            session.connection()
+            .execute(
+                insert.returning(
+                    microblog.model.RawSourceData.id,
+                    microblog.model.RawSourceData.dedup_key,
+                ),
+                rows,
+            )
+            .all()
+        )
+        microblog.model.Rollup.add_captured(session, len(inserted))
+        return inserted
+
+    def write_fused(self, rows):
+        """
+        Write the buffered payloads and their messages within one
+        transaction: the raw data first, then messages for the raw data
+        actually inserted, so a payload dropped as duplicate, e.g. by a
+        concurrent capture, leaves no message behind
+        """
+        messages = [message for _data, _timestamp, _key, message in self.buffer]
+
+        def insert_raw(session):
+            inserted = self.insert_raw(session, rows, returning=True)
+            # Ids follow the order of the rows, ignored rows just have none
+            raw_ids = iter(sorted(raw_id for raw_id, _dedup_key in inserted))
+            remaining = collections.Counter(
+                dedup_key for _raw_id, dedup_key in inserted
+            )
+            items = []
+            for row, message in zip(rows, messages):
+                if remaining[row["dedup_key"]]:
+                    remaining[row["dedup_key"]] -= 1
+                    items.append((next(raw_ids), message, row["dedup_key"]))
+            return items
+
+        microblog.transfer.write_entities(
+            self.session,
+            self.datasource_id,
+            None,
+            self.entity_deduplicator,
+            insert_raw,
+        )
+        microblog.metrics.TRANSFERRED.inc(len(rows))
+
+    def close(self):
+        """
+        Flush remaining payloads, e.g. on disconnect or shutdown
+        """
+        self.flush()
+        logging.info("Ingest writer statistics: %s", self.stats())
+
+    def stats(self):
+        """
+        Get counters for flush latency and buffer depth
+        """
+        flushes = self.counters["flushes"]
+        dedup = self.deduplicator.stats() if self.deduplicator is not None else {}
+        return {
+            **self.counters,
+            **{f"dedup_{name}": value for name, value in dedup.items()},
+            "buffer_depth": len(self.buffer),
+            "avg_flush_latency": (
+                self.counters["total_flush_latency"] / flushes if flushes else 0.0
+            ),
+        }
@@ -0,0 +1,380 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Metrics in the Prometheus text format
+Counters, gauges and histograms of the hot paths, served on /metrics by the
+API and periodically written to a file by the CLI jobs, e.g. for the
+node_exporter textfile collector. Metrics are off unless MB_METRICS=true;
+disabled, every update returns right away and timers are a shared no-op.
+"""
+
+import bisect
+import contextlib
+import logging
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+DEFAULT_DUMP_INTERVAL = 15
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_NULL_TIMER = contextlib.nullcontext()
+_STATE = {"enabled": os.environ.get("MB_METRICS", "false") == "true"}
+
+
+def is_enabled():
+    """
+    Whether metrics are collected
+    """
+    return _STATE["enabled"]
+
+
+def set_enabled(enabled):
+    """
+    Switch collecting metrics on or off, overrides MB_METRICS
+    """
+    _STATE["enabled"] = enabled
+
+
+def get_dump_path():
+    """
+    File the CLI jobs write their metrics to, None to not write any
+    """
+    return os.environ.get("MB_METRICS_PATH", None) or None
+
+
+def get_dump_interval():
+    """
+    Seconds between two metric dumps of the CLI jobs
+    """
+    return float(os.environ.get("MB_METRICS_INTERVAL", DEFAULT_DUMP_INTERVAL))
+
+
+def _format_labels(labels, extra=None):
+    """
+    Get the label set of a sample as text
+    """
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metric:
+    """
+    Base of all metrics, a named set of values by labels
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation):
+        """
+        Initialize the metric
+        """
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def render(self):
+        """
+        Get the lines of the metric in the Prometheus text format
+        """
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.extend(self.render_value(labels, value))
+        return lines
+
+    def render_value(self, labels, value):
+        """
+        Get the sample lines of one label set
+        """
+        return [f"{self.name}{_format_labels(labels)} {value}"]
+
+    def clear(self):
+        """
+        Forget all values
+        """
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    """
+    Value which only ever goes up, e.g. rows written
+    """
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        """
+        Increase the counter of the label set
+        """
+        if not _STATE["enabled"]:
+            return
+        key = tuple(sorted(labels.items())) if labels else ()
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value which goes up and down, e.g. a backlog
+    """
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        """
+        Set the gauge of the label set
+        """
+        if not _STATE["enabled"]:
+            return
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, e.g. durations, in cumulative buckets
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        """
+        Initialize the histogram with the upper bounds of its buckets
+        """
+        super().__init__(name, documentation)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """
+        Add an observation to the label set
+        """
+        if not _STATE["enabled"]:
+            return
+        key = tuple(sorted(labels.items())) if labels else ()
+        with self.lock:
+            counts = self.values.get(key, None)
+            if counts is None:
+                # One count per bucket and one for values above all of them,
+                # then the overall count and sum
+                counts = [0] * (len(self.buckets) + 2) + [0.0]
+                self.values[key] = counts
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """
+        Get a context manager observing the seconds its block takes
+        """
+        if not _STATE["enabled"]:
+            return _NULL_TIMER
+        return _Timer(self, labels)
+
+    def render_value(self, labels, value):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets, value):
+            cumulative += count
+            lines.append(
+                f"{self.name}_bucket{_format_labels(labels, ('le', bound))} "
+                f"{cumulative}"
+            )
+        lines.append(
+            f"{self.name}_bucket{_format_labels(labels, ('le', '+Inf'))} {value[-2]}"
+        )
+        lines.append(f"{self.name}_count{_format_labels(labels)} {value[-2]}")
+        lines.append(f"{self.name}_sum{_format_labels(labels)} {value[-1]}")
+        return lines
+
+
+class _Timer:
+    """
+    Context manager observing its duration in a histogram
+    """
+
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+    """
+    Set of metrics rendered together
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty registry
+        """
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Add a metric, returns the one registered first under its name
+        """
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation):
+        """
+        Get the counter of this name, created if it doesn't exist yet
+        """
+        return self.register(Counter(name, documentation))
+
+    def gauge(self, name, documentation):
+        """
+        Get the gauge of this name, created if it doesn't exist yet
+        """
+        return self.register(Gauge(name, documentation))
+
+    def histogram(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        """
+        Get the histogram of this name, created if it doesn't exist yet
+        """
+        return self.register(Histogram(name, documentation, buckets))
+
+    def render(self):
+        """
+        Get all metrics in the Prometheus text format
+        """
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        return "".join(
+            line + "\n" for metric in metrics for line in metric.render()
+        ).encode()
+
+    def clear(self):
+        """
+        Forget the values of all metrics
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            metric.clear()
+
+
+REGISTRY = Registry()
+
+CAPTURED = REGISTRY.counter("mb_capture_tweets_total", "Tweets received")
+CAPTURE_SECONDS = REGISTRY.histogram(
+    "mb_capture_tweet_seconds", "Time spent handling one received tweet"
+)
+TRANSFERRED = REGISTRY.counter(
+    "mb_transfer_rows_total", "Raw data sets transferred into messages"
+)
+TRANSFER_SECONDS = REGISTRY.histogram(
+    "mb_transfer_batch_seconds", "Time per transfer batch and stage"
+)
+QUERY_SECONDS = REGISTRY.histogram("mb_query_seconds", "Time per database query")
+REQUESTS = REGISTRY.counter("mb_http_requests_total", "HTTP requests handled")
+REQUEST_SECONDS = REGISTRY.histogram(
+    "mb_http_request_seconds", "Time spent handling an HTTP request"
+)
+BACKLOG = REGISTRY.gauge(
+    "mb_raw_backlog", "Raw data sets not yet transferred into messages"
+)
+
+
+def dump(path, registry=REGISTRY):
+    """
+    Atomically write all metrics to a file
+    """
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "wb") as metrics_file:
+        metrics_file.write(registry.render())
+    os.replace(temporary_path, path)
+
+
+class Dumper(threading.Thread):
+    """
+    Background thread writing the metrics to a file every interval
+    and once more when stopped
+    """
+
+    def __init__(self, path, interval, registry=REGISTRY):
+        """
+        Initialize the dumper, start it with start()
+        """
+        super().__init__(name="metrics-dumper", daemon=True)
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
+        self.dump()
+
+    def dump(self):
+        """
+        Write the metrics, logging instead of raising errors
+        """
+        try:
+            dump(self.path, self.registry)
+        except OSError as err:
+            logging.warning("Failed to write metrics to %s: %s", self.path, err)
+
+    def stop(self):
+        """
+        Stop the thread after a final dump
+        """
+        self.stopped.set()
+        self.join()
+
+
+@contextlib.contextmanager
+def dumping():
+    """
+    Context manager periodically writing the metrics to MB_METRICS_PATH
+    while its block runs, does nothing if metrics are off or no path is set
+    """
+    path = get_dump_path()
+    if not is_enabled() or path is None:
+        yield
+        return
+    dumper = Dumper(path, get_dump_interval())
+    dumper.start()
+    try:
+        yield
+    finally:
+        dumper.stop()
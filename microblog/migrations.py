@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Schema migrations
+create_all only creates missing tables, it never alters existing ones.
+Changes to existing tables like new indexes are therefore listed here and
+applied to databases which are already in use. The schema version is kept
+in SQLite's user_version pragma. Every migration must be idempotent, fresh
+databases run all of them right after create_all.
+"""
+
+import logging
+import microblog.model
+
+
+def add_column(table, column, definition):
+    """
+    Create a migration step adding a column unless it already exists
+    """
+
+    def apply(connection):
+        columns = {
+            row[1] for row in connection.exec_driver_sql(f"PRAGMA table_info({table})")
+        }
+        if column not in columns:
+            connection.exec_driver_sql(
+                f"ALTER TABLE {table} ADD COLUMN {column} {definition}"
+            )
+
+    return apply
+
+
+# (version, description, statements), statements are SQL or callables
+# taking the connection
+MIGRATIONS = [
+    (
+        1,
+        "Index pending raw data and messages per datasource",
+        [
+            "CREATE INDEX IF NOT EXISTS ix_messageentity_datasource_id_id "
+            "ON messageentity (datasource_id, id)",
+            "CREATE INDEX IF NOT EXISTS ix_rawsourcedata_pending "
+            "ON rawsourcedata (datasource_id, timestamp) WHERE entity_id IS NULL",
+            "CREATE INDEX IF NOT EXISTS ix_rawsourcedata_entity_id "
+            "ON rawsourcedata (entity_id)",
+        ],
+    ),
+    (
+        2,
+        "Deduplicate raw data and messages by key per datasource",
+        [
+            add_column("rawsourcedata", "dedup_key", "VARCHAR"),
+            add_column("messageentity", "dedup_key", "VARCHAR"),
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_rawsourcedata_dedup_key "
+            "ON rawsourcedata (datasource_id, dedup_key)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_messageentity_dedup_key "
+            "ON messageentity (datasource_id, dedup_key)",
+        ],
+    ),
+    (
+        3,
+        "Full-text search index over messages, kept in sync by triggers",
+        [
+            # External content: the index refers to messageentity rows by id
+            # instead of storing a second copy of every message
+            "CREATE VIRTUAL TABLE IF NOT EXISTS messagesearch USING fts5("
+            "message, content='messageentity', content_rowid='id')",
+            "CREATE TRIGGER IF NOT EXISTS messagesearch_insert "
+            "AFTER INSERT ON messageentity BEGIN "
+            "INSERT INTO messagesearch (rowid, message) VALUES (new.id, new.message); "
+            "END",
+            "CREATE TRIGGER IF NOT EXISTS messagesearch_delete "
+            "AFTER DELETE ON messageentity BEGIN "
+            "INSERT INTO messagesearch (messagesearch, rowid, message) "
+            "VALUES ('delete', old.id, old.message); "
+            "END",
+            "CREATE TRIGGER IF NOT EXISTS messagesearch_update "
+            "AFTER UPDATE OF message ON messageentity BEGIN "
+            "INSERT INTO messagesearch (messagesearch, rowid, message) "
+            "VALUES ('delete', old.id, old.message); "
+            "INSERT INTO messagesearch (rowid, message) VALUES (new.id, new.message); "
+            "END",
+        ],
+    ),
+    (
+        4,
+        "Rollups of raw data and messages per time bucket and the backlog",
+        [
+            lambda connection: microblog.model.Base.metadata.create_all(
+                connection,
+                tables=[
+                    microblog.model.Rollup.__table__,
+                    microblog.model.Backlog.__table__,
+                ],
+            ),
+            microblog.model.Rollup.rebuild,
+        ],
+    ),
+    (
+        5,
+        "Pre-rendered JSON fragments of messages",
+        [add_column("messageentity", "fragment", "BLOB")],
+    ),
+]
+
+
+def get_latest_version():
+    """
+    Get the schema version after all migrations are applied
+    """
+    return MIGRATIONS[-1][0]
+
+
+def get_version(connection):
+    """
+    Get the schema version of the connected database
+    """
+    return connection.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def migrate(engine):
+    """
+    Apply all pending migrations to the database
+    """
+    with engine.begin() as connection:
+        version = get_version(connection)
+        for number, description, statements in MIGRATIONS:
+            if number <= version:
+                continue
+            logging.info("Applying schema migration %s: %s", number, description)
+            for statement in statements:
+                if callable(statement):
+                    statement(connection)
+                else:
+                    connection.exec_driver_sql(statement)
+            connection.exec_driver_sql(f"PRAGMA user_version = {number}")
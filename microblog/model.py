@@ -7,48 +7,301 @@ Data models
 import logging
 import datetime
 import random
+import sqlalchemy.dialects.sqlite
 import sqlalchemy.orm
-import sqlalchemy.sql.expression
+import sqlalchemy.types
+import microblog.compression
 
 Base = sqlalchemy.orm.declarative_base()
 
+# Random sampling: rounds of id probing and max. ids probed per round
+SAMPLE_PROBE_ROUNDS = 4
+SAMPLE_MAX_PROBES = 500
+# Tokens around the matches in search result snippets
+SEARCH_SNIPPET_TOKENS = 16
+# Rollup granularities with the length of the timestamp prefix identifying
+# a bucket and the suffix completing it to the bucket's start
+ROLLUP_GRANULARITIES = {
+    "minute": (16, ":00"),
+    "hour": (13, ":00:00"),
+    "day": (10, " 00:00:00"),
+}
+# Colons escaped, else sqlalchemy.text() would take them for bind parameters
+_ROLLUP_GRANULARITIES_SQL = " UNION ALL ".join(
+    f"SELECT '{name}' AS name, {length} AS length, "
+    f"'{suffix.replace(':', chr(92) + ':')}' AS suffix"
+    for name, (length, suffix) in ROLLUP_GRANULARITIES.items()
+)
+# Raw data inserted after a raw data id, counted per bucket of its timestamp.
+# The WHERE clause is required for SQLite to parse the upsert.
+_ROLLUP_CAPTURED = f"""
+INSERT INTO rollup (granularity, datasource_id, bucket, captured, messages)
+SELECT
+    g.name, r.datasource_id, substr(r.timestamp, 1, g.length) || g.suffix, count(*), 0
+FROM rawsourcedata AS r, ({_ROLLUP_GRANULARITIES_SQL}) AS g
+WHERE r.id > :after_id
+GROUP BY 1, 2, 3
+ON CONFLICT (granularity, datasource_id, bucket)
+DO UPDATE SET captured = captured + excluded.captured
+"""
+# Messages from an entity id on, counted per bucket of their first raw data
+_ROLLUP_MESSAGES = f"""
+INSERT INTO rollup (granularity, datasource_id, bucket, captured, messages)
+SELECT
+    g.name, r.datasource_id, substr(r.timestamp, 1, g.length) || g.suffix, 0, count(*)
+FROM (
+    SELECT datasource_id, min(timestamp) AS timestamp FROM rawsourcedata
+    WHERE entity_id >= :first_entity_id
+    GROUP BY entity_id
+) AS r, ({_ROLLUP_GRANULARITIES_SQL}) AS g
+WHERE true
+GROUP BY 1, 2, 3
+ON CONFLICT (granularity, datasource_id, bucket)
+DO UPDATE SET messages = messages + excluded.messages
+"""
+# Same JSON as microblog.schema.render_message, as far as the encoders agree
+_RENDER_FRAGMENTS = """
+UPDATE messageentity SET fragment = CAST(json_object(
+    'id', id,
+    'datasource_name', (
+        SELECT name FROM datasource WHERE datasource.id = messageentity.datasource_id
+    ),
+    'message', message
+) AS BLOB)
+WHERE id >= :first_id AND fragment IS NULL
+"""
+_BACKLOG_CAPTURED = """
+INSERT INTO backlog (datasource_id, pending)
+SELECT datasource_id, count(*) FROM rawsourcedata
+WHERE id > :after_id AND entity_id IS NULL
+GROUP BY datasource_id
+ON CONFLICT (datasource_id) DO UPDATE SET pending = pending + excluded.pending
+"""
+
+
+class Payload(sqlalchemy.types.TypeDecorator):  # pylint: disable=R0901,W0223
+    """
+    Raw payload text, stored compressed if configured. Values which are
+    already bytes are stored as they are, e.g. when recompressing.
+    """
+
+    impl = sqlalchemy.String
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or isinstance(value, bytes):
+            return value
+        return microblog.compression.encode(value)
+
+    def process_result_value(self, value, dialect):
+        return microblog.compression.decode(value)
+
+    def coerce_compared_value(self, op, value):
+        # Compare against the stored value as it is, e.g. in LIKE patterns
+        return sqlalchemy.String()
+
 
 class MessageEntity(Base):
     """
     Abstracted message entity from a microblogging platform
     """
 
+    @staticmethod
+    def select_projection():
+        """
+        Select only the columns served by the API as plain rows with id,
+        datasource_name, message and fragment, joined in a single query
+        """
+        return sqlalchemy.select(
+            MessageEntity.id,
+            DataSource.name.label("datasource_name"),
+            MessageEntity.message,
+            MessageEntity.fragment,
+        ).join(DataSource, MessageEntity.datasource_id == DataSource.id)
+
     @staticmethod
     def get_a_lot(session):
         """
-        Simply return a random number of unordered messages
+        Simply return a random number of unordered message rows.
+        Instead of sorting the whole table by random(), random ids between
+        the lowest and highest id are probed, so the cost depends on the
+        number of returned messages and not on the size of the table.
         """
         limit = random.randint(10, 50)
-        result = session.scalars(
-            sqlalchemy.select(MessageEntity)
-            .order_by(sqlalchemy.sql.expression.func.random())
+        # Separate subqueries, SQLite only optimizes a lone min() or max() to a seek
+        low, high = session.execute(
+            sqlalchemy.select(
+                sqlalchemy.select(
+                    sqlalchemy.func.min(MessageEntity.id)
+                ).scalar_subquery(),
+                sqlalchemy.select(
+                    sqlalchemy.func.max(MessageEntity.id)
+                ).scalar_subquery(),
+            )
+        ).one()
+        if low is None:
+            return []
+        if high - low + 1 <= limit:
+            result = session.execute(MessageEntity.select_projection()).all()
+            random.shuffle(result)
+            return result
+        found = {}
+        probes, hits = 0, 0
+        for _ in range(SAMPLE_PROBE_ROUNDS):
+            missing = limit - len(found)
+            if missing <= 0:
+                break
+            # Oversample according to the density of ids seen so far to cover gaps
+            density = max(hits / probes, 0.05) if probes else 0.5
+            count = min(int(missing / density) + 1, SAMPLE_MAX_PROBES, high - low + 1)
+            candidates = set(random.sample(range(low, high + 1), count))
+            candidates.difference_update(found)
+            probes += len(candidates)
+            for message in session.execute(
+                MessageEntity.select_projection().where(
+                    MessageEntity.id.in_(candidates)
+                )
+            ):
+                hits += 1
+                found[message.id] = message
+        if len(found) < limit:
+            # Sparse id range: take a contiguous run after a random id, wrapping around
+            start = random.randint(low, high)
+            for lower_bound in (start, low):
+                if len(found) >= limit:
+                    break
+                for message in session.execute(
+                    MessageEntity.select_projection()
+                    .where(MessageEntity.id >= lower_bound)
+                    .where(MessageEntity.id.not_in(list(found)))
+                    .order_by(MessageEntity.id)
+                    .limit(limit - len(found))
+                ):
+                    found[message.id] = message
+        result = list(found.values())[:limit]
+        random.shuffle(result)
+        return result
+
+    @staticmethod
+    def get_page(session, after_id=0, limit=50, datasource_name=None):
+        """
+        Return up to limit message rows with an id greater than after_id in id order.
+        Keyset pagination: every page is an index range scan starting at
+        after_id, so later pages cost the same as the first one.
+        """
+        query = (
+            MessageEntity.select_projection()
+            .where(MessageEntity.id > after_id)
+            .order_by(MessageEntity.id)
             .limit(limit)
+        )
+        if datasource_name is not None:
+            # Resolve the datasource first so the (datasource_id, id) index is used
+            query = query.where(
+                MessageEntity.datasource_id
+                == sqlalchemy.select(DataSource.id)
+                .where(DataSource.name == datasource_name)
+                .scalar_subquery()
+            )
+        return session.execute(query).all()
+
+    @staticmethod
+    def search(  # pylint: disable=R0913,R0917
+        session, terms, limit=20, offset=0, datasource_name=None, snippet=False
+    ):
+        """
+        Return message rows containing all of the terms, best match first by
+        bm25 rank, using the messagesearch full-text index. Rows have a rank
+        and, if requested, a snippet with the matches marked.
+        """
+        if not terms:
+            return []
+        # Every term is quoted, so user input can't run into FTS5 query syntax
+        match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        where = "messagesearch MATCH :match"
+        if datasource_name is not None:
+            where += (
+                " AND messageentity.datasource_id = "
+                "(SELECT id FROM datasource WHERE name = :datasource_name)"
+            )
+        columns = "messageentity.id, datasource.name AS datasource_name, "
+        columns += "messageentity.message, bm25(messagesearch) AS rank"
+        if snippet:
+            columns += (
+                ", snippet(messagesearch, 0, '<mark>', '</mark>', '…', "
+                f"{SEARCH_SNIPPET_TOKENS}) AS snippet"
+            )
+        query = sqlalchemy.text(
+            f"SELECT {columns} FROM messagesearch "
+            "JOIN messageentity ON messageentity.id = messagesearch.rowid "
+            "JOIN datasource ON datasource.id = messageentity.datasource_id "
+            f"WHERE {where} ORDER BY rank, messageentity.id "
+            "LIMIT :limit OFFSET :offset"
+        )
+        return session.execute(
+            query,
+            {
+                "match": match,
+                "datasource_name": datasource_name,
+                "limit": limit,
+                "offset": offset,
+            },
         ).all()
-        return result
+
+    @staticmethod
+    def render_fragments(session, first_id=0):
+        """
+        Render the missing JSON fragments of messages from the id on within
+        SQLite, e.g. for messages stored before fragments were enabled
+        """
+        session.execute(sqlalchemy.text(_RENDER_FRAGMENTS), {"first_id": first_id})
+
+    @staticmethod
+    def rebuild_search_index(session):
+        """
+        Rebuild the full-text index from all stored messages, needed once
+        for messages stored before the index existed
+        """
+        session.execute(
+            sqlalchemy.text(
+                "INSERT INTO messagesearch (messagesearch) VALUES ('rebuild')"
+            )
+        )
+        session.execute(
+            sqlalchemy.text(
+                "INSERT INTO messagesearch (messagesearch) VALUES ('optimize')"
+            )
+        )
+        session.commit()
 
     __tablename__ = "messageentity"
+    __table_args__ = (
+        sqlalchemy.Index("ix_messageentity_datasource_id_id", "datasource_id", "id"),
+        sqlalchemy.Index(
+            "ux_messageentity_dedup_key", "datasource_id", "dedup_key", unique=True
+        ),
+    )
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
     datasource_id = sqlalchemy.Column(
         sqlalchemy.Integer, sqlalchemy.ForeignKey("datasource.id"), nullable=False
     )
     datasource = sqlalchemy.orm.relationship("DataSource")
     message = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    dedup_key = sqlalchemy.Column(sqlalchemy.String)
+    # The message as served by the API, pre-rendered JSON
+    fragment = sqlalchemy.Column(sqlalchemy.LargeBinary)
     raw = sqlalchemy.orm.relationship(
         "RawSourceData", back_populates="entity", uselist=False
     )
 
-    def __init__(self, datasource, message, raw):
+    def __init__(self, datasource, message, raw, dedup_key=None):
         """
         Initialize a new message entity
         """
         self.datasource = datasource
         self.message = message
         self.raw = raw
+        self.dedup_key = dedup_key
 
     def asdict(self):
         """
@@ -67,6 +320,19 @@ class RawSourceData(Base):  # pylint: disable=R0903
     """
 
     __tablename__ = "rawsourcedata"
+    __table_args__ = (
+        # Only unhandled raw data is scanned by the transfer, in timestamp order
+        sqlalchemy.Index(
+            "ix_rawsourcedata_pending",
+            "datasource_id",
+            "timestamp",
+            sqlite_where=sqlalchemy.text("entity_id IS NULL"),
+        ),
+        sqlalchemy.Index("ix_rawsourcedata_entity_id", "entity_id"),
+        sqlalchemy.Index(
+            "ux_rawsourcedata_dedup_key", "datasource_id", "dedup_key", unique=True
+        ),
+    )
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
     datasource_id = sqlalchemy.Column(
         sqlalchemy.Integer, sqlalchemy.ForeignKey("datasource.id"), nullable=False
@@ -78,10 +344,11 @@ class RawSourceData(Base):  # pylint: disable=R0903
     entity = sqlalchemy.orm.relationship(
         "MessageEntity", back_populates="raw", uselist=False
     )
-    data = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    data = sqlalchemy.Column(Payload, nullable=False)
     timestamp = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
+    dedup_key = sqlalchemy.Column(sqlalchemy.String)
 
-    def __init__(self, datasource, data, timestamp=None):
+    def __init__(self, datasource, data, timestamp=None, dedup_key=None):
         """
         Initialize a new object
         """
@@ -93,6 +360,7 @@ class RawSourceData(Base):  # pylint: disable=R0903
         self.datasource = datasource
         self.data = str(data)
         self.entity_id = None
+        self.dedup_key = dedup_key
         if timestamp is None:
             self.timestamp = datetime.datetime.now()
         else:
@@ -124,6 +392,32 @@ class DataSource(Base):  # pylint: disable=R0903
         ).first()
         return result
 
+    @staticmethod
+    def get_or_create(session, name):
+        """
+        Get the datasource specified by name, persist it first if it's new
+        """
+        datasource = DataSource.get_by_name(session, name)
+        if datasource is None:
+            logging.debug("Persisting new DataSource for %s", name)
+            datasource = DataSource(name)
+            session.add(datasource)
+            session.commit()
+        return datasource
+
+    @staticmethod
+    def get_backlog(session):
+        """
+        Get the number of raw data sets not yet transferred per datasource name
+        """
+        return dict(
+            session.execute(
+                sqlalchemy.select(
+                    DataSource.name, sqlalchemy.func.coalesce(Backlog.pending, 0)
+                ).outerjoin(Backlog, Backlog.datasource_id == DataSource.id)
+            ).all()
+        )
+
     __tablename__ = "datasource"
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
     name = sqlalchemy.Column(sqlalchemy.String, nullable=False)
@@ -148,7 +442,7 @@ class DataSource(Base):  # pylint: disable=R0903
                     RawSourceData.entity_id == None,  # pylint: disable=C0121
                 )
             )
-            .order_by(RawSourceData.timestamp)
+            .order_by(RawSourceData.timestamp, RawSourceData.id)
             .limit(count)
         ).all()
         logging.debug("Fetched raw data from database for %s: %s", self.name, result)
@@ -159,3 +453,162 @@ class DataSource(Base):  # pylint: disable=R0903
         Get log-able dict representation of the object
         """
         return {"name": self.name}
+
+
+class DataVersion(Base):  # pylint: disable=R0903
+    """
+    Single row counter bumped whenever new message entities are committed,
+    cached API responses are only valid for the version they were made with
+    """
+
+    @staticmethod
+    def get(session):
+        """
+        Get the current data version, 0 if nothing was transferred yet
+        """
+        return session.scalar(sqlalchemy.select(DataVersion.version)) or 0
+
+    @staticmethod
+    def bump(session):
+        """
+        Increment the data version within the caller's transaction
+        """
+        insert = sqlalchemy.dialects.sqlite.insert(DataVersion).values(id=1, version=1)
+        session.execute(
+            insert.on_conflict_do_update(
+                index_elements=[DataVersion.id],
+                set_={"version": DataVersion.version + 1},
+            )
+        )
+
+    __tablename__ = "dataversion"
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    version = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+
+
+class CompressionDictionary(Base):  # pylint: disable=R0903
+    """
+    Shared dictionary raw payloads can be compressed with, never changed
+    once stored since payloads refer to it by id
+    """
+
+    __tablename__ = "compressiondictionary"
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    codec = sqlalchemy.Column(sqlalchemy.String, nullable=False)
+    data = sqlalchemy.Column(sqlalchemy.LargeBinary, nullable=False)
+    created = sqlalchemy.Column(
+        sqlalchemy.DateTime, nullable=False, default=datetime.datetime.now
+    )
+
+
+class Rollup(Base):  # pylint: disable=R0903
+    """
+    Raw data captured and messages stored per datasource and time bucket,
+    maintained incrementally by the writers within their transactions
+    """
+
+    @staticmethod
+    def _add_captured_after(session, after_id):
+        """
+        Count the raw data stored after the raw data id
+        """
+        params = {"after_id": after_id}
+        session.execute(sqlalchemy.text(_ROLLUP_CAPTURED), params)
+        session.execute(sqlalchemy.text(_BACKLOG_CAPTURED), params)
+
+    @staticmethod
+    def add_captured(session, inserted):
+        """
+        Count the number of raw data rows the caller just inserted, within
+        its transaction. They're the rows with the highest ids: the insert
+        holds the write lock until the commit, so no other writer can add
+        rows in between.
+        """
+        if not inserted:
+            return
+        last_id = session.scalar(
+            sqlalchemy.select(sqlalchemy.func.max(RawSourceData.id))
+        )
+        Rollup._add_captured_after(session, last_id - inserted)
+
+    @staticmethod
+    def add_messages(session, first_entity_id, transferred=None):
+        """
+        Count the messages inserted from the entity id on, if any, and take
+        the raw data transferred per datasource id off the backlog, within
+        the caller's transaction
+        """
+        if first_entity_id is not None:
+            session.execute(
+                sqlalchemy.text(_ROLLUP_MESSAGES), {"first_entity_id": first_entity_id}
+            )
+        for datasource_id, count in (transferred or {}).items():
+            # Raw data inserted without add_captured, e.g. by a script, was
+            # never counted, the backlog mustn't go negative for it
+            session.execute(
+                sqlalchemy.update(Backlog)
+                .where(Backlog.datasource_id == datasource_id)
+                .values(pending=sqlalchemy.func.max(Backlog.pending - count, 0))
+            )
+
+    @staticmethod
+    def rebuild(session):
+        """
+        Recount all rollups and backlogs from the stored data,
+        raw data removed by the archive isn't counted anymore
+        """
+        session.execute(sqlalchemy.delete(Rollup))
+        session.execute(sqlalchemy.delete(Backlog))
+        Rollup._add_captured_after(session, 0)
+        session.execute(sqlalchemy.text(_ROLLUP_MESSAGES), {"first_entity_id": 0})
+
+    @staticmethod
+    def get_buckets(  # pylint: disable=R0913
+        session, granularity, datasource_name=None, since=None, limit=100
+    ):
+        """
+        Get the latest buckets of the granularity as (datasource_name, bucket,
+        captured, messages) rows, newest first
+        """
+        query = (
+            sqlalchemy.select(
+                DataSource.name.label("datasource_name"),
+                Rollup.bucket,
+                Rollup.captured,
+                Rollup.messages,
+            )
+            .join(DataSource, DataSource.id == Rollup.datasource_id)
+            .where(Rollup.granularity == granularity)
+            .order_by(Rollup.bucket.desc(), DataSource.name)
+            .limit(limit)
+        )
+        if datasource_name is not None:
+            query = query.where(DataSource.name == datasource_name)
+        if since is not None:
+            query = query.where(Rollup.bucket >= since)
+        return session.execute(query).all()
+
+    __tablename__ = "rollup"
+    __table_args__ = (
+        sqlalchemy.Index("ix_rollup_granularity_bucket", "granularity", "bucket"),
+    )
+    granularity = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    datasource_id = sqlalchemy.Column(
+        sqlalchemy.Integer, sqlalchemy.ForeignKey("datasource.id"), primary_key=True
+    )
+    # Start of the bucket, formatted like stored timestamps
+    bucket = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+    captured = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+    messages = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
+
+
+class Backlog(Base):  # pylint: disable=R0903
+    """
+    Raw data not yet transferred per datasource, see Rollup
+    """
+
+    __tablename__ = "backlog"
+    datasource_id = sqlalchemy.Column(
+        sqlalchemy.Integer, sqlalchemy.ForeignKey("datasource.id"), primary_key=True
+    )
+    pending = sqlalchemy.Column(sqlalchemy.Integer, nullable=False, default=0)
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Notifications about new raw data
+Writers send a datagram to every listener of the database after each
+commit, a following transfer listens and wakes up right away instead of
+polling. Each listener binds its own unix socket in a directory per
+database, so several transfers can follow the same database. Notifications
+are a hint only: nobody listening, a full socket buffer or a platform
+without unix sockets just means the transfer finds the data on its next
+poll.
+"""
+
+import hashlib
+import logging
+import os
+import select
+import socket
+import tempfile
+
+SUFFIX = ".sock"
+_SENDER = {}
+
+
+def get_socket_dir(url):
+    """
+    Get the directory of the notification sockets of the database URL,
+    MB_NOTIFY_DIR overrides it. Derived from the URL so each database has
+    its own.
+    """
+    path = os.environ.get("MB_NOTIFY_DIR", None)
+    if path:
+        return path
+    digest = hashlib.blake2b(str(url).encode(), digest_size=8).hexdigest()
+    return os.path.join(tempfile.gettempdir(), f"microblog-{digest}")
+
+
+def _get_sender():
+    """
+    Get the unbound socket notifications are sent from
+    """
+    if "socket" not in _SENDER:
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+        _SENDER["socket"] = sender
+    return _SENDER["socket"]
+
+
+def notify(url):
+    """
+    Tell all listeners of the database that new raw data was committed
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        return
+    directory = get_socket_dir(url)
+    try:
+        names = [name for name in os.listdir(directory) if name.endswith(SUFFIX)]
+    except OSError:
+        # Nobody ever listened
+        return
+    sender = _get_sender()
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            sender.sendto(b"\n", path)
+        except ConnectionRefusedError:
+            # Nothing bound anymore, e.g. the listener was killed
+            _remove(path)
+        except OSError:
+            # The listener is behind or just went away, it'll poll anyway
+            pass
+
+
+def _remove(path):
+    """
+    Remove a socket file, if it's still there
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class Listener:
+    """
+    Receiver of the notifications of one database
+    """
+
+    def __init__(self, url):
+        """
+        Bind a socket of its own in the directory of the database
+        """
+        self.path = None
+        self.socket = None
+        if not hasattr(socket, "AF_UNIX"):
+            logging.warning("No unix sockets, falling back to polling")
+            return
+        directory = get_socket_dir(url)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # A unique name, the temporary file only reserves it
+        handle, self.path = tempfile.mkstemp(suffix=SUFFIX, dir=directory)
+        os.close(handle)
+        os.unlink(self.path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+        self.socket.setblocking(False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        self.close()
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for notifications, returns whether
+        there were any. All pending ones are consumed at once.
+        """
+        if self.socket is None:
+            select.select([], [], [], timeout)
+            return False
+        readable, _, _ = select.select([self.socket], [], [], timeout)
+        if not readable:
+            return False
+        while True:
+            try:
+                self.socket.recv(16)
+            except BlockingIOError:
+                return True
+
+    def close(self):
+        """
+        Close and remove its own socket
+        """
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+            _remove(self.path)
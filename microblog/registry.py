@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Registry of data sources
+A source is a module providing capture(config), transfer(workers,
+chunk_size, sql) and optionally capture_async(config). Built-in sources are
+listed here, others are found through the "microblog.sources" entry point
+group of installed packages. Sources are only imported once they're named,
+so a job doesn't pay for the dependencies of sources it doesn't use.
+"""
+
+import importlib
+import importlib.metadata
+
+ENTRY_POINT_GROUP = "microblog.sources"
+BUILTIN_SOURCES = {
+    "file": "microblog.source.file",
+    "twitter": "microblog.source.twitter",
+}
+
+
+def _get_entry_points():
+    """
+    Get the installed source entry points by name
+    """
+    return {
+        entry_point.name: entry_point
+        for entry_point in importlib.metadata.entry_points(group=ENTRY_POINT_GROUP)
+    }
+
+
+def get_source_names():
+    """
+    Get the names of all available sources, sorted
+    """
+    return sorted(set(BUILTIN_SOURCES) | set(_get_entry_points()))
+
+
+def get_source(name):
+    """
+    Import and get the module of the source, raises ValueError if unknown
+    """
+    if name in BUILTIN_SOURCES:
+        return importlib.import_module(BUILTIN_SOURCES[name])
+    entry_point = _get_entry_points().get(name, None)
+    if entry_point is None:
+        raise ValueError(f"Unknown source: {name}")
+    return entry_point.load()
@@ -2,20 +2,138 @@
 # -*- coding: utf-8 -*-
 """
 OpenAPI schema definition
+Messages are rendered into JSON fragments which responses are joined from,
+see render_messages. orjson is used for encoding if it's installed.
 """
 
-import openapi_core
+import base64
+import functools
+import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def generate_messages(messages):
+
+def dumps(value):
+    """
+    Encode a value as compact JSON bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(value)  # pylint: disable=E1101
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def render_message(message_id, datasource_name, message):
+    """
+    Render a message as its MessageEntity JSON fragment
+    """
+    return dumps(
+        {"id": message_id, "datasource_name": datasource_name, "message": message}
+    )
+
+
+def render_messages(messages, cursor=None):
+    """
+    Render message rows into the JSON body of a messages response, joined
+    from the fragments stored with the messages where there are any
+    """
+    fragments = [
+        message.fragment
+        or render_message(message.id, message.datasource_name, message.message)
+        for message in messages
+    ]
+    body = b'{"messages":[' + b",".join(fragments) + b"]"
+    if cursor is not None:
+        body += b',"cursor":' + dumps(cursor)
+    return body + b"}"
+
+
+def encode_cursor(after_id, datasource_name=None):
+    """
+    Create an opaque pagination cursor pointing after the given message id
+    """
+    state = {"after_id": after_id, "datasource": datasource_name}
+    return base64.urlsafe_b64encode(json.dumps(state).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Read a pagination cursor, raises ValueError if it is invalid
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        after_id = int(state["after_id"])
+        datasource_name = state["datasource"]
+    except (ValueError, TypeError, KeyError) as err:
+        raise ValueError(f"Invalid cursor: {cursor}") from err
+    if datasource_name is not None and not isinstance(datasource_name, str):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return after_id, datasource_name
+
+
+def generate_search_results(results, snippet=False, cursor=None):
+    """
+    Convert search result rows into their OpenAPI representation
+    """
+    messages = []
+    for result in results:
+        message = {
+            "id": result.id,
+            "datasource_name": result.datasource_name,
+            "message": result.message,
+            "rank": result.rank,
+        }
+        if snippet:
+            message["snippet"] = result.snippet
+        messages.append(message)
+    response = {"messages": messages}
+    if cursor is not None:
+        response["cursor"] = cursor
+    return response
+
+
+def encode_search_cursor(offset):
+    """
+    Create an opaque cursor pointing to the search results after offset
     """
-    Convert model messages into their OpenAPI representation
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode()).decode()
+
+
+def decode_search_cursor(cursor):
+    """
+    Read a search cursor, raises ValueError if it is invalid
+    """
+    try:
+        offset = int(json.loads(base64.urlsafe_b64decode(cursor.encode()))["offset"])
+    except (ValueError, TypeError, KeyError) as err:
+        raise ValueError(f"Invalid cursor: {cursor}") from err
+    if offset < 0:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return offset
+
+
+def generate_stats(granularity, backlog, buckets):
+    """
+    Convert the backlog per datasource and rollup rows into their
+    OpenAPI representation
     """
     return {
-        "messages": [
-            {"datasource_name": message.datasource.name, "message": message.message}
-            for message in messages
-        ]
+        "granularity": granularity,
+        "backlog": [
+            {"datasource_name": name, "pending": pending}
+            for name, pending in sorted(backlog.items())
+        ],
+        "buckets": [
+            {
+                "datasource_name": bucket.datasource_name,
+                "bucket": bucket.bucket,
+                "captured": bucket.captured,
+                "messages": bucket.messages,
+            }
+            for bucket in buckets
+        ],
     }
 
 
@@ -49,16 +167,82 @@ SCHEMA_V1 = {
             "MessageEntity": {
                 "type": "object",
                 "properties": {
+                    "id": {"type": "integer"},
                     "datasource_name": {"type": "string"},
                     "message": {"type": "string"},
                 },
             },
+            "SearchResult": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "integer"},
+                    "datasource_name": {"type": "string"},
+                    "message": {"type": "string"},
+                    "rank": {
+                        "type": "number",
+                        "description": "bm25 rank, lower is better",
+                    },
+                    "snippet": {
+                        "type": "string",
+                        "description": "Excerpt with matches in <mark> tags",
+                    },
+                },
+            },
+            "StatsBucket": {
+                "type": "object",
+                "properties": {
+                    "datasource_name": {"type": "string"},
+                    "bucket": {
+                        "type": "string",
+                        "description": "Start of the bucket, e.g. 2022-08-01 13:00:00",
+                    },
+                    "captured": {"type": "integer"},
+                    "messages": {"type": "integer"},
+                },
+            },
+            "Backlog": {
+                "type": "object",
+                "properties": {
+                    "datasource_name": {"type": "string"},
+                    "pending": {"type": "integer"},
+                },
+            },
         }
     },
     "paths": {
         "/messages": {
             "get": {
-                "description": "Just an unsorted, messy batch of messages",
+                "description": (
+                    "Without parameters just an unsorted, messy batch of messages. "
+                    "With any parameter given the messages are paged through in id "
+                    "order, pass the returned cursor to fetch the next page."
+                ),
+                "parameters": [
+                    {
+                        "name": "after_id",
+                        "in": "query",
+                        "description": "Only return messages with a greater id",
+                        "schema": {"type": "integer", "minimum": 0},
+                    },
+                    {
+                        "name": "limit",
+                        "in": "query",
+                        "description": "Maximum number of messages per page",
+                        "schema": {"type": "integer", "minimum": 1, "maximum": 1000},
+                    },
+                    {
+                        "name": "datasource",
+                        "in": "query",
+                        "description": "Only return messages from this datasource",
+                        "schema": {"type": "string"},
+                    },
+                    {
+                        "name": "cursor",
+                        "in": "query",
+                        "description": "Opaque cursor returned by the previous page",
+                        "schema": {"type": "string"},
+                    },
+                ],
                 "responses": {
                     "200": {
                         "description": "Successfully fetched message data",
@@ -73,15 +257,229 @@ SCHEMA_V1 = {
                                                 "$ref": "#/components/schemas/MessageEntity"
                                             },
                                         },
+                                        "cursor": {"type": "string"},
                                     },
                                 }
                             }
                         },
                     },
+                    "400": {
+                        "description": "Invalid parameters",
+                        "content": {
+                            "application/json": {
+                                "schema": {"$ref": "#/components/schemas/BasicError"}
+                            }
+                        },
+                    },
                 },
             }
-        }
+        },
+        "/messages/search": {
+            "get": {
+                "description": (
+                    "Messages containing all of the given words, best match first. "
+                    "Pass the returned cursor to fetch the next page."
+                ),
+                "parameters": [
+                    {
+                        "name": "q",
+                        "in": "query",
+                        "required": True,
+                        "description": "Words to search for, separated by spaces",
+                        "schema": {"type": "string", "minLength": 1},
+                    },
+                    {
+                        "name": "limit",
+                        "in": "query",
+                        "description": "Maximum number of messages per page",
+                        "schema": {"type": "integer", "minimum": 1, "maximum": 1000},
+                    },
+                    {
+                        "name": "datasource",
+                        "in": "query",
+                        "description": "Only return messages from this datasource",
+                        "schema": {"type": "string"},
+                    },
+                    {
+                        "name": "snippet",
+                        "in": "query",
+                        "description": "Add an excerpt with the matches marked",
+                        "schema": {"type": "boolean"},
+                    },
+                    {
+                        "name": "cursor",
+                        "in": "query",
+                        "description": "Opaque cursor returned by the previous page",
+                        "schema": {"type": "string"},
+                    },
+                ],
+                "responses": {
+                    "200": {
+                        "description": "Successfully searched messages",
+                        "content": {
+                            "application/json": {
+                                "schema": {
+                                    "type": "object",
+                                    "properties": {
+                                        "messages": {
+                                            "type": "array",
+                                            "items": {
+                                                "$ref": "#/components/schemas/SearchResult"
+                                            },
+                                        },
+                                        "cursor": {"type": "string"},
+                                    },
+                                }
+                            }
+                        },
+                    },
+                    "400": {
+                        "description": "Invalid parameters",
+                        "content": {
+                            "application/json": {
+                                "schema": {"$ref": "#/components/schemas/BasicError"}
+                            }
+                        },
+                    },
+                },
+            }
+        },
+        "/stats": {
+            "get": {
+                "description": (
+                    "Raw data captured and messages stored per datasource and "
+                    "time bucket, newest first, and the raw data still waiting "
+                    "for transfer per datasource."
+                ),
+                "parameters": [
+                    {
+                        "name": "granularity",
+                        "in": "query",
+                        "description": "Size of the buckets, hour by default",
+                        "schema": {
+                            "type": "string",
+                            "enum": ["minute", "hour", "day"],
+                        },
+                    },
+                    {
+                        "name": "datasource",
+                        "in": "query",
+                        "description": "Only return buckets of this datasource",
+                        "schema": {"type": "string"},
+                    },
+                    {
+                        "name": "since",
+                        "in": "query",
+                        "description": "Only return buckets starting at this time or later",
+                        "schema": {"type": "string"},
+                    },
+                    {
+                        "name": "limit",
+                        "in": "query",
+                        "description": "Maximum number of buckets",
+                        "schema": {"type": "integer", "minimum": 1, "maximum": 1000},
+                    },
+                ],
+                "responses": {
+                    "200": {
+                        "description": "Successfully fetched the stats",
+                        "content": {
+                            "application/json": {
+                                "schema": {
+                                    "type": "object",
+                                    "properties": {
+                                        "granularity": {"type": "string"},
+                                        "backlog": {
+                                            "type": "array",
+                                            "items": {
+                                                "$ref": "#/components/schemas/Backlog"
+                                            },
+                                        },
+                                        "buckets": {
+                                            "type": "array",
+                                            "items": {
+                                                "$ref": "#/components/schemas/StatsBucket"
+                                            },
+                                        },
+                                    },
+                                }
+                            }
+                        },
+                    },
+                    "400": {
+                        "description": "Invalid parameters",
+                        "content": {
+                            "application/json": {
+                                "schema": {"$ref": "#/components/schemas/BasicError"}
+                            }
+                        },
+                    },
+                },
+            }
+        },
+        "/export": {
+            "get": {
+                "description": (
+                    "Stream all messages in id order as newline delimited JSON, "
+                    "one MessageEntity per line."
+                ),
+                "parameters": [
+                    {
+                        "name": "datasource",
+                        "in": "query",
+                        "description": "Only export messages from this datasource",
+                        "schema": {"type": "string"},
+                    },
+                    {
+                        "name": "min_id",
+                        "in": "query",
+                        "description": "Only export messages with this id or greater",
+                        "schema": {"type": "integer", "minimum": 0},
+                    },
+                    {
+                        "name": "max_id",
+                        "in": "query",
+                        "description": "Only export messages with this id or less",
+                        "schema": {"type": "integer", "minimum": 0},
+                    },
+                    {
+                        "name": "gzip",
+                        "in": "query",
+                        "description": "Compress the stream with gzip",
+                        "schema": {"type": "boolean"},
+                    },
+                ],
+                "responses": {
+                    "200": {
+                        "description": "Successfully started the export",
+                        "content": {
+                            "application/x-ndjson": {
+                                "schema": {"$ref": "#/components/schemas/MessageEntity"}
+                            }
+                        },
+                    },
+                    "400": {
+                        "description": "Invalid parameters",
+                        "content": {
+                            "application/json": {
+                                "schema": {"$ref": "#/components/schemas/BasicError"}
+                            }
+                        },
+                    },
+                },
+            }
+        },
     },
 }
 
-SPEC_V1 = openapi_core.create_spec(SCHEMA_V1)
+
+@functools.lru_cache(maxsize=None)
+def get_spec():
+    """
+    Get the openapi_core spec of the schema, e.g. to check it's a valid
+    OpenAPI document. Created on first use, openapi_core is slow to import
+    and the API itself validates with microblog.validation.
+    """
+    import openapi_core  # pylint: disable=C0415
+
+    return openapi_core.create_spec(SCHEMA_V1)
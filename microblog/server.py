@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Production serving of the API
+Runs the app in a prefork gunicorn server: the master prepares the schema,
+then each worker process opens its own read-only connection pool, which
+never writes, and warms it up before taking requests. gunicorn is
+optional, it's only imported when serving with workers. Send the master
+SIGHUP for a graceful reload: new workers start, old ones finish their
+requests and exit.
+"""
+
+import logging
+import os
+import microblog.api
+import microblog.db
+
+DEFAULT_BIND = "0.0.0.0:5000"
+DEFAULT_TIMEOUT = 30
+
+
+def get_bind():
+    """
+    Get the host:port the API listens on
+    """
+    return os.environ.get("MB_API_BIND", None) or DEFAULT_BIND
+
+
+def get_timeout():
+    """
+    Seconds a worker may take for a request, and for finishing its
+    requests on a graceful reload or shutdown
+    """
+    return int(os.environ.get("MB_API_TIMEOUT", DEFAULT_TIMEOUT))
+
+
+def on_starting(_server):
+    """
+    gunicorn hook: create and migrate the schema once in the master, before
+    any worker exists, then close the master's connections so no worker
+    inherits them
+    """
+    microblog.db.get_engine()
+    microblog.db.dispose_engines()
+
+
+def post_worker_init(worker):
+    """
+    gunicorn hook: warm up the worker's connection pool before it accepts
+    """
+    microblog.db.warm_up(microblog.db.get_engine(read_only=True))
+    logging.info("Worker %s warmed up", worker.pid)
+
+
+def get_application_class():
+    """
+    Define the gunicorn application on first use, importing gunicorn
+    """
+    try:
+        from gunicorn.app.base import (  # pylint: disable=C0415
+            BaseApplication,
+        )
+    except ImportError as err:
+        raise ValueError(
+            "Serving with workers or threads requires gunicorn, "
+            "run 'pip install gunicorn' or serve without them"
+        ) from err
+
+    class Application(BaseApplication):  # pylint: disable=W0223
+        """
+        gunicorn application serving the API app
+        """
+
+        def __init__(self, options):
+            """
+            Initialize the application with gunicorn settings
+            """
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for name, value in self.options.items():
+                self.cfg.set(name, value)
+
+        def load(self):
+            # Called in each worker, so every worker gets its own app and pool
+            return microblog.api.get_app(read_only=True)
+
+    return Application
+
+
+def serve(workers, threads=1):
+    """
+    Serve the API with the given numbers of worker processes and threads
+    per worker until the master is stopped
+    """
+    options = {
+        "bind": get_bind(),
+        "workers": workers,
+        "threads": threads,
+        "timeout": get_timeout(),
+        "graceful_timeout": get_timeout(),
+        "on_starting": on_starting,
+        "post_worker_init": post_worker_init,
+    }
+    logging.info(
+        "Serving on %s with %s workers of %s threads", options["bind"], workers, threads
+    )
+    get_application_class()(options).run()
@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+NDJSON dump files as data source
+Replays tweets stored one JSON object per line, plain or gzip compressed,
+e.g. for backfills, disaster recovery or load tests without the network.
+Lines are stored like the twitter source stores tweets, so the transfer
+works the same. Plain files are memory mapped and decoded a large block at
+a time straight from the mapping, gzip files are streamed.
+"""
+
+import datetime
+import gzip
+import json
+import logging
+import mmap
+import os
+import microblog.compression
+import microblog.db
+import microblog.metrics
+import microblog.model
+import microblog.notify
+import microblog.source.twitter
+import microblog.transfer
+
+DATASOURCE_NAME = "file"
+GZIP_MAGIC = b"\x1f\x8b"
+SUFFIXES = (".ndjson", ".jsonl", ".json", ".ndjson.gz", ".jsonl.gz", ".json.gz")
+DEFAULT_BATCH_SIZE = 100000
+BLOCK_SIZE = 8 * 1024 * 1024
+# As SQLAlchemy stores DateTime columns in SQLite
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def get_datasource(session):
+    """
+    Get the datasource associated with this implementation
+    """
+    return microblog.model.DataSource.get_or_create(session, DATASOURCE_NAME)
+
+
+def check_config(config):
+    """
+    Raise ValueError if a required config value is missing
+    """
+    if not config.get("MB_SOURCE_FILE_PATH", None):
+        raise ValueError("Invalid config, MB_SOURCE_FILE_PATH not set!")
+
+
+def find_files(path):
+    """
+    Get the dump file or all dump files in the directory, sorted
+    """
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(
+        os.path.join(path, name) for name in os.listdir(path) if name.endswith(SUFFIXES)
+    )
+
+
+def _mapped_blocks(mapped, block_size):
+    """
+    Yield the text of blocks of whole lines, decoded right from the mapping
+    """
+    start, size = 0, len(mapped)
+    with memoryview(mapped) as view:
+        while start < size:
+            end = size
+            if start + block_size < size:
+                end = mapped.rfind(b"\n", start, start + block_size) + 1
+                if end <= 0:
+                    # A single line longer than the block
+                    end = mapped.find(b"\n", start + block_size) + 1 or size
+            yield str(view[start:end], "utf-8")
+            start = end
+
+
+def _gzip_blocks(path, block_size):
+    """
+    Yield the text of blocks of whole lines of a gzip file
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as dump_file:
+        rest = ""
+        while True:
+            block = dump_file.read(block_size)
+            if not block:
+                break
+            end = block.rfind("\n") + 1
+            if end == 0:
+                rest += block
+                continue
+            yield rest + block[:end]
+            rest = block[end:]
+        if rest:
+            yield rest
+
+
+def _blocks(path, block_size):
+    """
+    Yield the text of blocks of whole lines of a plain or gzip compressed file
+    """
+    with open(path, "rb") as dump_file:
+        if dump_file.read(len(GZIP_MAGIC)) == GZIP_MAGIC:
+            yield from _gzip_blocks(path, block_size)
+            return
+        if os.fstat(dump_file.fileno()).st_size == 0:
+            # An empty file can't be mapped
+            return
+        with mmap.mmap(dump_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield from _mapped_blocks(mapped, block_size)
+
+
+def read_lines(path, block_size=BLOCK_SIZE):
+    """
+    Yield the non-empty lines of a plain or gzip compressed dump file
+    """
+    for block in _blocks(path, block_size):
+        for line in block.split("\n"):
+            if line and not line.isspace():
+                yield line
+
+
+def get_dedup_key(line):
+    """
+    Get the dedup key of a line holding a JSON object with a message text,
+    None for any other line
+    """
+    try:
+        tweet = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(tweet, dict) or not isinstance(tweet.get("text", None), str):
+        return None
+    return microblog.source.twitter.get_dedup_key(tweet, line)
+
+
+def ingest(session, datasource, lines, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Bulk insert lines as raw data, one transaction per batch, returns the
+    numbers of stored, duplicate and skipped lines. Lines whose dedup key is
+    already stored, e.g. by an earlier overlapping dump, are dropped.
+    """
+    counters = {"rows": 0, "duplicates": 0, "skipped": 0}
+    batch = []
+
+    def flush():
+        # Straight to the driver, SQLAlchemy's per row parameter processing
+        # would take longer than the insert itself. Lines of one batch share
+        # their timestamp, the id keeps their order. The unique dedup key
+        # index drops duplicates, as for the twitter source.
+        encode = microblog.compression.get_encoder().encode
+        timestamp = datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
+        try:
+            result = session.connection().exec_driver_sql(
+                "INSERT OR IGNORE INTO rawsourcedata "
+                "(datasource_id, data, timestamp, dedup_key) VALUES (?, ?, ?, ?)",
+                [
+                    (datasource.id, encode(line), timestamp, dedup_key)
+                    for line, dedup_key in batch
+                ],
+            )
+            inserted = result.rowcount
+            microblog.model.Rollup.add_captured(session, inserted)
+            session.commit()
+        except Exception:
+            # Neither a broken transaction nor the batch is left for the next flush
+            session.rollback()
+            raise
+        finally:
+            count = len(batch)
+            batch.clear()
+        microblog.notify.notify(session.get_bind().url)
+        counters["rows"] += inserted
+        counters["duplicates"] += count - inserted
+        microblog.metrics.CAPTURED.inc(inserted)
+        logging.info("Ingested %s lines", counters["rows"])
+
+    for line in lines:
+        dedup_key = get_dedup_key(line)
+        if dedup_key is None:
+            counters["skipped"] += 1
+            continue
+        batch.append((line, dedup_key))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return counters
+
+
+def capture(config):
+    """
+    Entrypoint for this data source: Ingest the dump file or all dump files
+    of the directory in MB_SOURCE_FILE_PATH
+    """
+    check_config(config)
+    batch_size = int(config.get("MB_SOURCE_FILE_BATCH_SIZE", DEFAULT_BATCH_SIZE))
+    with microblog.db.get_session() as session:
+        datasource = get_datasource(session)
+        for path in find_files(config["MB_SOURCE_FILE_PATH"]):
+            counters = ingest(session, datasource, read_lines(path), batch_size)
+            if counters["skipped"]:
+                logging.warning(
+                    "Skipped %s invalid lines in %s", counters["skipped"], path
+                )
+            if counters["duplicates"]:
+                logging.info(
+                    "Dropped %s duplicate lines in %s", counters["duplicates"], path
+                )
+            logging.info("Ingested %s lines from %s", counters["rows"], path)
+    logging.debug("Finished capture")
+
+
+def transfer(workers=1, chunk_size=None, sql=False):
+    """
+    Entrypoint for the transfer routine, see microblog.transfer
+    """
+    options = {"workers": workers, "chunk_size": chunk_size, "sql": sql}
+    with microblog.db.get_session() as session:
+        datasource = get_datasource(session)
+        # Lines are tweets, extracted and mapped as the twitter source does
+        microblog.transfer.run(
+            session,
+            datasource,
+            microblog.source.twitter.extract,
+            microblog.source.twitter.SQL_MAPPING,
+            **options,
+        )
+    logging.debug("Finished transfer")
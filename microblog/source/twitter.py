@@ -4,105 +4,200 @@
 Twitter Streaming API as data source
 """
 
+import asyncio
 import logging
 import json
-import tweepy
-import sqlalchemy.orm
+import microblog.capture
 import microblog.db
+import microblog.dedup
+import microblog.ingest
+import microblog.metrics
+import microblog.transfer
+
+# Column mapping for the set-based transfer, as JSON paths into the raw data
+SQL_MAPPING = {"message": "$.text", "dedup_key": "$.id"}
 
 
 def get_datasource(session):
     """
     Get the datasource associated with this implementation
     """
-    datasource = microblog.model.DataSource.get_by_name(session, "twitter")
-    if datasource is None:
-        logging.debug("Persisting new DataSource for twitter")
-        datasource = microblog.model.DataSource("twitter")
-        session.add(datasource)
-        session.commit()
-    return datasource
+    return microblog.model.DataSource.get_or_create(session, "twitter")
 
 
-class StreamingClient(tweepy.StreamingClient):
+def check_config(config):
     """
-    This class overrides tweepy's StreamingClient to implement our handlers
+    Raise ValueError if a required config value is missing
     """
+    if not "MB_SOURCE_TWITTER_BEARER_TOKEN" in config:
+        raise ValueError("Invalid config, MB_SOURCE_TWITTER_BEARER_TOKEN not set!")
+    if not "MB_SOURCE_TWITTER_RULE" in config:
+        raise ValueError("Invalid config, MB_SOURCE_TWITTER_RULE not set!")
 
-    def on_tweet(self, tweet):
-        """
-        Data handler
-        """
-        logging.debug("Received tweet with id: %s", tweet.id)
-        session = sqlalchemy.orm.Session.object_session(self.mb_datasource)
-        raw_data = microblog.model.RawSourceData(
-            self.mb_datasource, json.dumps(tweet.data)
-        )
-        session.add(raw_data)
-        session.commit()
-        logging.debug("Persisted tweet with id: %s", tweet.id)
 
-    def on_errors(self, errors):
-        """
-        Error handler
-        """
-        logging.warning("Received errors: %s", errors)
+def get_writer(session):
+    """
+    Get a deduplicating buffered writer for this datasource, storing
+    messages right away if MB_INGEST_FUSED is set
+    """
+    datasource = get_datasource(session)
+    return microblog.ingest.BufferedWriter(
+        session,
+        datasource,
+        deduplicator=microblog.dedup.Deduplicator(
+            session, microblog.model.RawSourceData, datasource.id
+        ),
+        extract=extract if microblog.ingest.is_fused() else None,
+    )
 
 
 def capture(config):
     """
     Entrypoint for this data source: Capture and save the raw twitter stream
     """
-    if not "MB_SOURCE_TWITTER_BEARER_TOKEN" in config:
-        raise ValueError("Invalid config, MB_SOURCE_TWITTER_BEARER_TOKEN not set!")
-    if not "MB_SOURCE_TWITTER_RULE" in config:
-        raise ValueError("Invalid config, MB_SOURCE_TWITTER_RULE not set!")
+    from tweepy import StreamRule  # pylint: disable=C0415
+    from microblog.source.twitter_stream import (  # pylint: disable=C0415
+        StreamingClient,
+    )
+
+    check_config(config)
     logging.debug("Capturing twitter traffic with config: %s", config)
     streaming_client = StreamingClient(config["MB_SOURCE_TWITTER_BEARER_TOKEN"])
     with microblog.db.get_session() as session:
-        streaming_client.mb_datasource = get_datasource(  # pylint: disable=W0201
-            session
-        )
+        streaming_client.mb_writer = get_writer(session)
         # We delete existing rules first so only the supplied, new rule is active.
         streaming_client.delete_rules(streaming_client.get_rules().data)
         rule_result = streaming_client.add_rules(
-            tweepy.StreamRule(config["MB_SOURCE_TWITTER_RULE"])
+            StreamRule(config["MB_SOURCE_TWITTER_RULE"])
         )
         logging.debug("Added rule: %s", rule_result)
         logging.info("Currently active rules: %s", streaming_client.get_rules())
         # Use this to read the real stream; for our purposes a sample is good enough though
         # streaming_client.filter()
-        streaming_client.sample()
+        try:
+            streaming_client.sample()
+        finally:
+            streaming_client.mb_writer.close()
         session.commit()
     logging.debug("Finished capture")
 
 
+def get_async_streaming_client(bearer_token, capture_queue):
+    """
+    Create an asynchronous streaming client which puts received tweets
+    into the capture queue. tweepy's async client requires aiohttp,
+    so it is only imported when needed.
+    """
+    from tweepy import asynchronous  # pylint: disable=C0415
+
+    class AsyncStreamingClient(asynchronous.AsyncStreamingClient):
+        """
+        Async counterpart of StreamingClient, handlers never touch the database
+        """
+
+        async def on_tweet(self, tweet):
+            """
+            Data handler, waits for free space in the queue with the block policy
+            """
+            with microblog.metrics.CAPTURE_SECONDS.time():
+                await capture_queue.put(json.dumps(tweet.data), str(tweet.id))
+            microblog.metrics.CAPTURED.inc()
+
+        async def on_errors(self, errors):
+            """
+            Error handler
+            """
+            logging.warning("Received errors: %s", errors)
+
+    return AsyncStreamingClient(bearer_token)
+
+
+async def capture_stream(config, writer):
+    """
+    Read the twitter stream into a capture queue drained by the writer task
+    """
+    from tweepy import StreamRule  # pylint: disable=C0415
+
+    capture_queue = microblog.capture.CaptureQueue()
+    writer_task = asyncio.create_task(
+        microblog.capture.run_writer(capture_queue, writer)
+    )
+    streaming_client = get_async_streaming_client(
+        config["MB_SOURCE_TWITTER_BEARER_TOKEN"], capture_queue
+    )
+    try:
+        # We delete existing rules first so only the supplied, new rule is active.
+        rules = await streaming_client.get_rules()
+        if rules.data:
+            await streaming_client.delete_rules(rules.data)
+        await streaming_client.add_rules(StreamRule(config["MB_SOURCE_TWITTER_RULE"]))
+        logging.info("Currently active rules: %s", await streaming_client.get_rules())
+        # Use filter() to read the real stream, as with the synchronous client
+        await streaming_client.sample()
+    finally:
+        await capture_queue.close()
+        await writer_task
+
+
+def capture_async(config):
+    """
+    Entrypoint for the asynchronous capture: like capture(), but network
+    reads and database writes are decoupled by a bounded queue
+    """
+    check_config(config)
+    logging.debug("Capturing twitter traffic asynchronously with config: %s", config)
+    with microblog.db.get_session() as session:
+        asyncio.run(capture_stream(config, get_writer(session)))
+        session.commit()
+    logging.debug("Finished capture")
+
+
+def get_dedup_key(tweet, data):
+    """
+    Get the dedup key of a parsed tweet: its id, or a hash of the raw payload
+    """
+    if "id" in tweet:
+        return str(tweet["id"])
+    return microblog.dedup.content_hash(data)
+
+
+def extract(data):
+    """
+    Extract the message text and dedup key from a raw tweet payload
+    """
+    tweet = json.loads(data)
+    return tweet["text"], get_dedup_key(tweet, data)
+
+
 def transform(raws):
     """
     Transform the list of raw data into entity messages
     """
-    return [
-        microblog.model.MessageEntity(raw.datasource, json.loads(raw.data)["text"], raw)
-        for raw in raws
-    ]
+    entities = []
+    for raw in raws:
+        message, dedup_key = extract(raw.data)
+        entities.append(
+            microblog.model.MessageEntity(
+                raw.datasource, message, raw, raw.dedup_key or dedup_key
+            )
+        )
+    return entities
 
 
-def transfer():
+def transfer(workers=1, chunk_size=None, sql=False):
     """
     Entrypoint for the transfer routine: Fetch all entries from the source's
-    stored raw data and transform and store them as message entities
+    stored raw data and transform and store them as message entities,
+    see microblog.transfer.run
     """
     with microblog.db.get_session() as session:
-        datasource = get_datasource(session)
-        while True:
-            raw_data_sets = datasource.get_raw_data()
-            if raw_data_sets is None or len(raw_data_sets) == 0:
-                logging.debug("Exhausted raw data sets, finishing transfer")
-                break
-            logging.debug(
-                "Starting transfer for %s entries in twitter", len(raw_data_sets)
-            )
-            entities = transform(raw_data_sets)
-            session.add_all(entities)
-            session.commit()
+        microblog.transfer.run(
+            session,
+            get_datasource(session),
+            extract,
+            SQL_MAPPING,
+            workers=workers,
+            chunk_size=chunk_size,
+            sql=sql,
+        )
     logging.debug("Finished transfer")
@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Twitter streaming client of the twitter source
+Kept apart from microblog.source.twitter since tweepy takes a while to
+import and only capturing needs it, not transfers.
+"""
+
+import logging
+import json
+import tweepy
+import microblog.metrics
+
+
+class StreamingClient(tweepy.StreamingClient):
+    """
+    This class overrides tweepy's StreamingClient to implement our handlers
+    """
+
+    def __init__(self, bearer_token, **kwargs):
+        """
+        Initialize the client, mb_writer must be set before streaming
+        """
+        super().__init__(bearer_token, **kwargs)
+        self.mb_writer = None
+
+    def on_tweet(self, tweet):
+        """
+        Data handler
+        """
+        logging.debug("Received tweet with id: %s", tweet.id)
+        with microblog.metrics.CAPTURE_SECONDS.time():
+            # The text comes along for fused writes, saving a parse
+            self.mb_writer.add(
+                json.dumps(tweet.data), dedup_key=str(tweet.id), message=tweet.text
+            )
+        microblog.metrics.CAPTURED.inc()
+
+    def on_keep_alive(self):
+        """
+        Keep-alive handler, flushes buffered tweets on an idle stream
+        """
+        self.mb_writer.flush_if_due()
+
+    def on_disconnect(self):
+        """
+        Disconnect handler, persists everything still buffered
+        """
+        logging.debug("Stream disconnected, flushing buffered tweets")
+        self.mb_writer.flush()
+
+    def on_errors(self, errors):
+        """
+        Error handler
+        """
+        logging.warning("Received errors: %s", errors)
@@ -0,0 +1,534 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Transfer pipelines
+Shared machinery to turn stored raw data into message entities in bulk.
+Sources provide a pure extract function which maps a raw payload to the
+message text and its dedup key, everything else is source independent.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import os
+import sqlalchemy
+import sqlalchemy.exc
+import microblog.dedup
+import microblog.metrics
+import microblog.model
+import microblog.notify
+import microblog.schema
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_SQL_CHUNK_SIZE = 50000
+DEFAULT_FOLLOW_MIN_BATCH_SIZE = 10
+DEFAULT_FOLLOW_MAX_BATCH_SIZE = 10000
+DEFAULT_POLL_INTERVAL = 5.0
+WRITE_RETRIES = 3
+
+_LINK_RAW_DATA = (
+    sqlalchemy.update(microblog.model.RawSourceData.__table__)
+    .where(microblog.model.RawSourceData.__table__.c.id == sqlalchemy.bindparam("raw"))
+    .values(entity_id=sqlalchemy.bindparam("entity"))
+)
+
+
+def stores_fragments():
+    """
+    Whether transfers store the JSON fragment the API serves with each message
+    """
+    return os.environ.get("MB_MESSAGE_FRAGMENTS", "false") == "true"
+
+
+def read_pending(session, datasource_id, position, count):
+    """
+    Read pending raw data as (id, timestamp, data, dedup_key) rows in the
+    same (timestamp, id) order as the serial transfer, starting after position
+    """
+    raw = microblog.model.RawSourceData
+    # Keep the timestamp as stored, a datetime rendered back into SQL
+    # could differ in format and thereby skip rows
+    timestamp = sqlalchemy.type_coerce(raw.timestamp, sqlalchemy.String)
+    query = (
+        sqlalchemy.select(raw.id, timestamp.label("timestamp"), raw.data, raw.dedup_key)
+        .where(raw.datasource_id == datasource_id)
+        .where(raw.entity_id == None)  # pylint: disable=C0121
+        .order_by(raw.timestamp, raw.id)
+        .limit(count)
+    )
+    if position is not None:
+        query = query.where(
+            sqlalchemy.tuple_(timestamp, raw.id)
+            > sqlalchemy.tuple_(
+                sqlalchemy.literal(position[0], sqlalchemy.String),
+                sqlalchemy.literal(position[1], sqlalchemy.Integer),
+            )
+        )
+    return session.execute(query).all()
+
+
+def read_after(session, datasource_id, last_id, count):
+    """
+    Read pending raw data as (id, data, dedup_key) rows in id order,
+    starting after the raw data id last_id
+    """
+    raw = microblog.model.RawSourceData
+    query = (
+        sqlalchemy.select(raw.id, raw.data, raw.dedup_key)
+        .where(raw.datasource_id == datasource_id)
+        .where(raw.entity_id == None)  # pylint: disable=C0121
+        .order_by(raw.id)
+        .limit(count)
+    )
+    if last_id is not None:
+        query = query.where(raw.id > last_id)
+    return session.execute(query).all()
+
+
+def _allocate_entities(datasource_id, items, first_id, deduplicator):
+    """
+    Assign entity ids to (raw_id, message, dedup_key) items, returns the
+    new entities and the links of all raw data to their entity
+    """
+    entities, links = [], []
+    next_id = first_id
+    for raw_id, message, dedup_key in items:
+        entity_id = None
+        if deduplicator is not None and dedup_key is not None:
+            entity_id = deduplicator.lookup(dedup_key)
+        if entity_id is None:
+            entity_id = next_id
+            next_id += 1
+            entities.append(
+                {
+                    "id": entity_id,
+                    "datasource_id": datasource_id,
+                    "message": message,
+                    "dedup_key": dedup_key,
+                }
+            )
+            if deduplicator is not None and dedup_key is not None:
+                deduplicator.remember(dedup_key, entity_id)
+        links.append({"raw": raw_id, "entity": entity_id})
+    return entities, links
+
+
+def _add_fragments(session, datasource_id, entities):
+    """
+    Render the JSON fragments of new entities
+    """
+    name = session.get(microblog.model.DataSource, datasource_id).name
+    for entity in entities:
+        entity["fragment"] = microblog.schema.render_message(
+            entity["id"], name, entity["message"]
+        )
+
+
+def _is_collision(error):
+    """
+    Whether an IntegrityError is a unique constraint, i.e. a concurrent
+    writer taking the same entity ids or dedup keys first, which is worth a
+    retry. Anything else, e.g. a missing message, fails the same way again.
+    """
+    return "UNIQUE constraint failed" in str(error.orig)
+
+
+def write_entities(session, datasource_id, items, deduplicator=None, insert_raw=None):
+    """
+    Bulk insert message entities for (raw_id, message, dedup_key) items and
+    link the raw data to them, all within one transaction.
+    Entity ids are allocated after the current highest id so the raw data
+    can be linked without reading the ids back; should a concurrent writer
+    claim them first the transaction is retried. Raw data with a known
+    dedup key is linked to the existing entity instead.
+    insert_raw inserts the raw data within the same transaction instead of
+    taking items: it's called with the session at the start of every
+    attempt and returns the items of the raw data it actually inserted.
+    """
+    for attempt in range(WRITE_RETRIES):
+        if insert_raw is not None:
+            items = insert_raw(session)
+        first_id = (
+            session.scalar(
+                sqlalchemy.select(sqlalchemy.func.max(microblog.model.MessageEntity.id))
+            )
+            or 0
+        ) + 1
+        entities, links = _allocate_entities(
+            datasource_id, items, first_id, deduplicator
+        )
+        if stores_fragments():
+            _add_fragments(session, datasource_id, entities)
+        try:
+            if entities:
+                session.execute(
+                    sqlalchemy.insert(microblog.model.MessageEntity), entities
+                )
+                microblog.model.DataVersion.bump(session)
+            if links:
+                session.execute(_LINK_RAW_DATA, links)
+            microblog.model.Rollup.add_messages(
+                session, first_id if entities else None, {datasource_id: len(links)}
+            )
+            session.commit()
+            return
+        except sqlalchemy.exc.IntegrityError as error:
+            session.rollback()
+            if attempt + 1 == WRITE_RETRIES or not _is_collision(error):
+                raise
+            logging.debug("Entity ids starting at %s already taken, retrying", first_id)
+        finally:
+            if deduplicator is not None:
+                deduplicator.reset_pending()
+
+
+def serial_transfer(session, datasource, extract, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Transfer all pending raw data of the datasource within this process,
+    with the same bulk writes as the parallel transfer
+    """
+    deduplicator = microblog.dedup.Deduplicator(
+        session, microblog.model.MessageEntity, datasource.id
+    )
+    position = None
+    while True:
+        with microblog.metrics.TRANSFER_SECONDS.time(stage="fetch"):
+            rows = read_pending(session, datasource.id, position, chunk_size)
+        if not rows:
+            break
+        position = (rows[-1].timestamp, rows[-1].id)
+        with microblog.metrics.TRANSFER_SECONDS.time(stage="transform"):
+            items = extract_items(extract, rows)
+        with microblog.metrics.TRANSFER_SECONDS.time(stage="commit"):
+            write_entities(session, datasource.id, items, deduplicator)
+        microblog.metrics.TRANSFERRED.inc(len(rows))
+        logging.debug("Transferred %s entries in %s", len(rows), datasource.name)
+    logging.info("Deduplication statistics: %s", deduplicator.stats())
+
+
+def extract_all(extract, datas):
+    """
+    Apply the extract function to a chunk of raw payloads in a worker process
+    """
+    return [extract(data) for data in datas]
+
+
+def extract_items(extract, rows):
+    """
+    Get the (raw_id, message, dedup_key) items of raw data rows, a dedup key
+    stored with the raw data wins over the extracted one
+    """
+    return [
+        (row.id, message, row.dedup_key or dedup_key)
+        for row, (message, dedup_key) in zip(
+            rows, extract_all(extract, [row.data for row in rows])
+        )
+    ]
+
+
+def parallel_transfer(
+    session, datasource, extract, workers, chunk_size=DEFAULT_CHUNK_SIZE
+):
+    """
+    Transfer all pending raw data of the datasource as a pipeline:
+    the reader fetches chunks, a process pool extracts message and dedup key
+    of each payload and a single writer bulk inserts the results in the
+    original order.
+    """
+    deduplicator = microblog.dedup.Deduplicator(
+        session, microblog.model.MessageEntity, datasource.id
+    )
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = collections.deque()
+        position = None
+        exhausted = False
+        while True:
+            # Keep every worker busy with one chunk and have one more chunk queued
+            while not exhausted and len(in_flight) < workers * 2:
+                with microblog.metrics.TRANSFER_SECONDS.time(stage="fetch"):
+                    rows = read_pending(session, datasource.id, position, chunk_size)
+                if not rows:
+                    exhausted = True
+                    break
+                position = (rows[-1].timestamp, rows[-1].id)
+                future = pool.submit(extract_all, extract, [row.data for row in rows])
+                in_flight.append((rows, future))
+            if not in_flight:
+                break
+            rows, future = in_flight.popleft()
+            # Only the wait for the workers, the transformation itself overlaps
+            with microblog.metrics.TRANSFER_SECONDS.time(stage="transform"):
+                results = future.result()
+            items = [
+                (row.id, message, row.dedup_key or dedup_key)
+                for row, (message, dedup_key) in zip(rows, results)
+            ]
+            with microblog.metrics.TRANSFER_SECONDS.time(stage="commit"):
+                write_entities(session, datasource.id, items, deduplicator)
+            microblog.metrics.TRANSFERRED.inc(len(rows))
+            logging.debug("Transferred %s entries in %s", len(rows), datasource.name)
+    logging.info("Deduplication statistics: %s", deduplicator.stats())
+    logging.debug("Finished parallel transfer with %s workers", workers)
+
+
+# Temp tables live per connection, which may change between chunks
+_SQL_PREPARE_CHUNK = [
+    """
+    CREATE TEMP TABLE IF NOT EXISTS transfer_chunk (
+        raw_id INTEGER PRIMARY KEY,
+        position INTEGER NOT NULL,
+        entity_id INTEGER,
+        message TEXT,
+        dedup_key TEXT,
+        is_new INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS temp.ix_transfer_chunk_dedup_key "
+    "ON transfer_chunk (dedup_key)",
+    """
+    CREATE TEMP TABLE IF NOT EXISTS transfer_new (
+        raw_id INTEGER PRIMARY KEY,
+        entity_id INTEGER NOT NULL
+    )
+    """,
+    "DELETE FROM transfer_chunk",
+    "DELETE FROM transfer_new",
+]
+
+_SQL_FILL_CHUNK = """
+INSERT INTO transfer_chunk (raw_id, position, message, dedup_key)
+SELECT
+    id,
+    row_number() OVER (ORDER BY timestamp, id),
+    json_extract(mb_payload(data), :message_path),
+    coalesce(
+        dedup_key,
+        CAST(json_extract(mb_payload(data), :dedup_key_path) AS TEXT),
+        mb_content_hash(mb_payload(data))
+    )
+FROM (
+    SELECT id, timestamp, data, dedup_key FROM rawsourcedata
+    WHERE datasource_id = :datasource_id AND entity_id IS NULL
+    ORDER BY timestamp, id
+    LIMIT :chunk_size
+)
+"""
+
+_SQL_TRANSFER_CHUNK = [
+    # Link to messages already stored with the same dedup key
+    """
+    UPDATE transfer_chunk SET entity_id = (
+        SELECT id FROM messageentity
+        WHERE datasource_id = :datasource_id
+        AND dedup_key = transfer_chunk.dedup_key
+    )
+    WHERE dedup_key IS NOT NULL
+    """,
+    # Only the first occurrence of a dedup key within the chunk is new
+    """
+    UPDATE transfer_chunk SET is_new = 1
+    WHERE entity_id IS NULL AND (
+        dedup_key IS NULL OR position = (
+            SELECT min(position) FROM transfer_chunk AS first
+            WHERE first.dedup_key = transfer_chunk.dedup_key
+        )
+    )
+    """,
+    # New entity ids are numbered after the current highest id in raw data
+    # order, which is what the serial transfer would have assigned
+    """
+    INSERT INTO transfer_new (raw_id, entity_id)
+    SELECT
+        raw_id,
+        (SELECT coalesce(max(id), 0) FROM messageentity)
+            + row_number() OVER (ORDER BY position)
+    FROM transfer_chunk WHERE is_new
+    """,
+    """
+    UPDATE transfer_chunk SET entity_id = (
+        SELECT entity_id FROM transfer_new WHERE raw_id = transfer_chunk.raw_id
+    )
+    WHERE is_new
+    """,
+    # Duplicates within the chunk point to their first occurrence
+    """
+    UPDATE transfer_chunk SET entity_id = (
+        SELECT first.entity_id FROM transfer_chunk AS first
+        WHERE first.dedup_key = transfer_chunk.dedup_key AND first.is_new
+    )
+    WHERE entity_id IS NULL
+    """,
+    """
+    INSERT INTO messageentity (id, datasource_id, message, dedup_key)
+    SELECT entity_id, :datasource_id, message, dedup_key
+    FROM transfer_chunk WHERE is_new ORDER BY entity_id
+    """,
+    """
+    UPDATE rawsourcedata SET entity_id = (
+        SELECT entity_id FROM transfer_chunk WHERE raw_id = rawsourcedata.id
+    )
+    WHERE id IN (SELECT raw_id FROM transfer_chunk)
+    """,
+]
+
+
+_SQL_FIRST_NEW_ENTITY = "SELECT min(entity_id) FROM transfer_new"
+
+_SQL_MISSING_MESSAGES = (
+    "SELECT raw_id FROM transfer_chunk WHERE message IS NULL ORDER BY position"
+)
+
+
+def _sql_transfer_chunk(session, params):
+    """
+    Transfer one chunk within a single transaction, returns the number of rows
+    """
+    for attempt in range(WRITE_RETRIES):
+        try:
+            for statement in _SQL_PREPARE_CHUNK:
+                session.execute(sqlalchemy.text(statement))
+            count = session.execute(sqlalchemy.text(_SQL_FILL_CHUNK), params).rowcount
+            missing = session.scalars(sqlalchemy.text(_SQL_MISSING_MESSAGES)).all()
+            if missing:
+                # Like a failing extract() in the other transfers, no retry
+                # or later chunk would get past this raw data
+                session.rollback()
+                raise ValueError(
+                    f"No message at {params['message_path']} in raw data {missing}"
+                )
+            if count > 0:
+                for statement in _SQL_TRANSFER_CHUNK:
+                    session.execute(sqlalchemy.text(statement), params)
+                first_id = session.scalar(sqlalchemy.text(_SQL_FIRST_NEW_ENTITY))
+                if first_id is not None and stores_fragments():
+                    microblog.model.MessageEntity.render_fragments(session, first_id)
+                microblog.model.Rollup.add_messages(
+                    session, first_id, {params["datasource_id"]: count}
+                )
+                microblog.model.DataVersion.bump(session)
+            session.commit()
+            return count
+        except sqlalchemy.exc.IntegrityError as error:
+            session.rollback()
+            if attempt + 1 == WRITE_RETRIES or not _is_collision(error):
+                raise
+            logging.debug("Entity ids of chunk already taken, retrying")
+    return 0
+
+
+def sql_transfer(session, datasource, mapping, chunk_size=DEFAULT_SQL_CHUNK_SIZE):
+    """
+    Transfer all pending raw data of the datasource within SQLite itself:
+    the mapping's JSON paths are evaluated with json_extract and the results
+    copied with INSERT ... SELECT, one transaction per chunk.
+    Only usable for sources whose transformation is a plain column mapping.
+    Raw data without a stored dedup key or one in the mapped path is keyed
+    by a content hash of its payload, as the twitter source's extract does.
+    Raw data without a message in the mapped path raises ValueError.
+    """
+    params = {
+        "datasource_id": datasource.id,
+        "message_path": mapping["message"],
+        "dedup_key_path": mapping["dedup_key"],
+        "chunk_size": chunk_size,
+    }
+    total = 0
+    while True:
+        # Fetch, transform and commit are a single statement sequence here
+        with microblog.metrics.TRANSFER_SECONDS.time(stage="sql"):
+            count = _sql_transfer_chunk(session, params)
+        if count == 0:
+            break
+        microblog.metrics.TRANSFERRED.inc(count)
+        total += count
+        logging.debug("Transferred %s entries in %s", count, datasource.name)
+    logging.debug("Finished SQL transfer of %s entries", total)
+
+
+def get_poll_interval():
+    """
+    Get the max. seconds a following transfer waits for a notification
+    before it looks for new raw data anyway
+    """
+    return float(os.environ.get("MB_TRANSFER_POLL_INTERVAL", DEFAULT_POLL_INTERVAL))
+
+
+def next_batch_size(batch_size, rows, min_size, max_size):
+    """
+    Get the batch size after a batch of the given number of rows:
+    doubled while batches come back full, i.e. there's a backlog to catch
+    up with, halved when they don't
+    """
+    if rows >= batch_size:
+        return min(batch_size * 2, max_size)
+    return max(batch_size // 2, min_size)
+
+
+def follow(  # pylint: disable=R0913
+    session,
+    datasource,
+    extract,
+    *,
+    min_batch_size=DEFAULT_FOLLOW_MIN_BATCH_SIZE,
+    max_batch_size=DEFAULT_FOLLOW_MAX_BATCH_SIZE,
+    stopped=None,
+):
+    """
+    Keep transferring raw data of the datasource as it arrives, until the
+    stopped event is set. The id of the last transferred raw data is kept
+    as high-water mark, so each batch is a range read on the primary key
+    instead of a scan for pending rows. Once caught up it sleeps until a
+    writer notifies it, see microblog.notify, or the poll interval passed.
+    """
+    deduplicator = microblog.dedup.Deduplicator(
+        session, microblog.model.MessageEntity, datasource.id
+    )
+    poll_interval = get_poll_interval()
+    batch_size = min_batch_size
+    last_id = None
+    url = session.get_bind().url
+    with microblog.notify.Listener(url) as listener:
+        while stopped is None or not stopped.is_set():
+            with microblog.metrics.TRANSFER_SECONDS.time(stage="fetch"):
+                rows = read_after(session, datasource.id, last_id, batch_size)
+            # End the read transaction, else the next batch couldn't see
+            # raw data committed in the meantime
+            session.commit()
+            if not rows:
+                batch_size = min_batch_size
+                listener.wait(poll_interval)
+                continue
+            with microblog.metrics.TRANSFER_SECONDS.time(stage="transform"):
+                items = extract_items(extract, rows)
+            with microblog.metrics.TRANSFER_SECONDS.time(stage="commit"):
+                write_entities(session, datasource.id, items, deduplicator)
+            microblog.metrics.TRANSFERRED.inc(len(rows))
+            last_id = rows[-1].id
+            logging.debug(
+                "Transferred %s entries in %s up to raw data %s",
+                len(rows),
+                datasource.name,
+                last_id,
+            )
+            batch_size = next_batch_size(
+                batch_size, len(rows), min_batch_size, max_batch_size
+            )
+    logging.info("Deduplication statistics: %s", deduplicator.stats())
+
+
+def run(  # pylint: disable=R0913
+    session, datasource, extract, mapping, *, workers=1, chunk_size=None, sql=False
+):
+    """
+    Transfer all pending raw data of the datasource set-based within SQLite
+    using the mapping if sql is set, else in a pool of workers if there's
+    more than one, else within this process
+    """
+    if sql:
+        sql_transfer(session, datasource, mapping, chunk_size or DEFAULT_SQL_CHUNK_SIZE)
+    elif workers > 1:
+        parallel_transfer(
+            session, datasource, extract, workers, chunk_size or DEFAULT_CHUNK_SIZE
+        )
+    else:
+        serial_transfer(session, datasource, extract, chunk_size or DEFAULT_CHUNK_SIZE)
@@ -0,0 +1,308 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Request and response validation against the OpenAPI schema
+The schemas of all operations are compiled into plain Python checks once
+when the app is created, instead of being interpreted on every request.
+Query parameters are always checked, the views rely on their bounds. How
+many responses are checked depends on MB_API_VALIDATION:
+
+    full     Every response, a response not matching the schema is turned
+             into an error. Meant for tests and development, so spec drift
+             gets caught.
+    request  None, the default
+    sampled  One in MB_API_VALIDATION_SAMPLE_RATE responses, mismatches are
+             only logged
+    off      None, same as request
+"""
+
+import functools
+import itertools
+import logging
+import os
+import re
+from flask import g, jsonify, make_response, request
+import microblog.schema
+
+MODES = ("full", "request", "sampled", "off")
+DEFAULT_MODE = "request"
+DEFAULT_SAMPLE_RATE = 100
+# Keywords which only document a schema
+ANNOTATIONS = {"description", "example", "format", "title"}
+INTEGER = re.compile(r"^-?\d+$")
+
+
+class ValidationError(ValueError):
+    """
+    A value doesn't match its schema
+    """
+
+
+def get_mode():
+    """
+    Get the configured validation mode
+    """
+    mode = os.environ.get("MB_API_VALIDATION", DEFAULT_MODE)
+    if mode not in MODES:
+        raise ValueError(f"Unknown validation mode: {mode}")
+    return mode
+
+
+def get_sample_rate():
+    """
+    Get the number of responses of which one is validated in sampled mode
+    """
+    return max(
+        int(os.environ.get("MB_API_VALIDATION_SAMPLE_RATE", DEFAULT_SAMPLE_RATE)), 1
+    )
+
+
+def _check_type(kind):
+    """
+    Get a check of the JSON type
+    """
+    python_types = {
+        "object": (dict,),
+        "array": (list,),
+        "string": (str,),
+        "integer": (int,),
+        "number": (int, float),
+        "boolean": (bool,),
+    }[kind]
+
+    def check(value, location):
+        if isinstance(value, bool) and kind != "boolean":
+            raise ValidationError(f"{location}: expected {kind}, got boolean")
+        if not isinstance(value, python_types):
+            raise ValidationError(f"{location}: expected {kind}, got {value!r}")
+
+    return check
+
+
+def compile_schema(schema, components):
+    """
+    Compile a schema into a function raising ValidationError for values
+    not matching it. Keywords not supported here raise ValueError right
+    away, rather than being silently ignored.
+    """
+    if "$ref" in schema:
+        name = schema["$ref"].rsplit("/", 1)[-1]
+        return compile_schema(components[name], components)
+    checks = []
+    nullable = schema.get("nullable", False)
+    for keyword, argument in schema.items():
+        if keyword in ANNOTATIONS or keyword == "nullable":
+            continue
+        if keyword == "type":
+            checks.append(_check_type(argument))
+        elif keyword == "properties":
+            checks.append(_check_properties(argument, components))
+        elif keyword == "required":
+            checks.append(_check_required(argument))
+        elif keyword == "items":
+            checks.append(_check_items(argument, components))
+        elif keyword in ("minimum", "maximum", "minLength", "maxLength", "enum"):
+            checks.append(_check_bound(keyword, argument))
+        else:
+            raise ValueError(f"Unsupported schema keyword: {keyword}")
+
+    def validate(value, location="value"):
+        if value is None and nullable:
+            return
+        for check in checks:
+            check(value, location)
+
+    return validate
+
+
+def _check_properties(properties, components):
+    """
+    Get a check of the known properties of an object
+    """
+    compiled = [
+        (name, compile_schema(schema, components))
+        for name, schema in properties.items()
+    ]
+
+    def check(value, location):
+        for name, validate in compiled:
+            if name in value:
+                validate(value[name], f"{location}.{name}")
+
+    return check
+
+
+def _check_required(names):
+    """
+    Get a check of the required properties of an object
+    """
+
+    def check(value, location):
+        for name in names:
+            if name not in value:
+                raise ValidationError(f"{location}: {name} is required")
+
+    return check
+
+
+def _check_items(schema, components):
+    """
+    Get a check of all items of an array
+    """
+    validate = compile_schema(schema, components)
+
+    def check(value, location):
+        for index, item in enumerate(value):
+            validate(item, f"{location}[{index}]")
+
+    return check
+
+
+def _check_bound(keyword, argument):
+    """
+    Get a check of a limit of numbers and strings or of allowed values
+    """
+    failed = {
+        "enum": lambda value: value not in argument,
+        "minimum": lambda value: value < argument,
+        "maximum": lambda value: value > argument,
+        "minLength": lambda value: len(value) < argument,
+        "maxLength": lambda value: len(value) > argument,
+    }[keyword]
+
+    def check(value, location):
+        if failed(value):
+            raise ValidationError(
+                f"{location}: {value!r} violates {keyword} {argument}"
+            )
+
+    return check
+
+
+def _convert(value, kind, name):
+    """
+    Convert a query parameter string to the type of its schema
+    """
+    if kind == "integer":
+        if not INTEGER.match(value):
+            raise ValidationError(f"{name}: expected integer, got {value!r}")
+        return int(value)
+    if kind == "number":
+        try:
+            return float(value)
+        except ValueError as err:
+            raise ValidationError(f"{name}: expected number, got {value!r}") from err
+    if kind == "boolean":
+        if value not in ("true", "false"):
+            raise ValidationError(f"{name}: expected boolean, got {value!r}")
+        return value == "true"
+    return value
+
+
+class Operation:  # pylint: disable=R0903
+    """
+    Compiled parameters and response schema of one GET operation
+    """
+
+    def __init__(self, operation, components):
+        """
+        Compile the operation's query parameters and its JSON response
+        """
+        self.parameters = [
+            (
+                parameter["name"],
+                parameter.get("required", False),
+                parameter["schema"]["type"],
+                compile_schema(parameter["schema"], components),
+            )
+            for parameter in operation.get("parameters", [])
+            if parameter["in"] == "query"
+        ]
+        content = operation["responses"]["200"]["content"]
+        self.response = (
+            compile_schema(content["application/json"]["schema"], components)
+            if "application/json" in content
+            else None
+        )
+
+    def parse_query(self, args):
+        """
+        Get the known query parameters converted to their types,
+        raises ValidationError if one is invalid or missing
+        """
+        query = {}
+        for name, required, kind, check in self.parameters:
+            if name not in args:
+                if required:
+                    raise ValidationError(f"{name} is required")
+                continue
+            query[name] = _convert(args[name], kind, name)
+            check(query[name], name)
+        return query
+
+
+class Validator:
+    """
+    View decorator parsing and validating requests and responses
+    according to the compiled schema and the validation mode
+    """
+
+    def __init__(self, schema=None, mode=None, sample_rate=None):
+        """
+        Compile all GET operations of the schema, by default SCHEMA_V1
+        """
+        schema = schema or microblog.schema.SCHEMA_V1
+        self.mode = mode or get_mode()
+        self.sample_rate = sample_rate or get_sample_rate()
+        self.requests = itertools.count()
+        prefix = next(
+            server["url"] for server in schema["servers"] if server["url"][0] == "/"
+        )
+        components = schema.get("components", {}).get("schemas", {})
+        self.operations = {
+            prefix + path: Operation(item["get"], components)
+            for path, item in schema["paths"].items()
+            if "get" in item
+        }
+
+    def should_validate_response(self):
+        """
+        Whether the response of the current request gets validated
+        """
+        if self.mode == "full":
+            return True
+        if self.mode == "sampled":
+            return next(self.requests) % self.sample_rate == 0
+        return False
+
+    def __call__(self, view):
+        """
+        Decorate the view, the parsed query parameters are provided as g.query
+        """
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            operation = self.operations[request.url_rule.rule]
+            try:
+                g.query = operation.parse_query(request.args)
+            except ValidationError as err:
+                return make_response(
+                    jsonify(microblog.schema.BasicError(str(err), 400)), 400
+                )
+            response = make_response(view(*args, **kwargs))
+            if (
+                response.status_code == 200
+                and operation.response is not None
+                and self.should_validate_response()
+            ):
+                try:
+                    operation.response(response.get_json(), "response")
+                except ValidationError as err:
+                    logging.error("Invalid response for %s: %s", request.path, err)
+                    if self.mode == "full":
+                        return make_response(
+                            jsonify(microblog.schema.BasicError(str(err), 500)), 500
+                        )
+            return response
+
+        return wrapper
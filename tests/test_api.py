@@ -4,21 +4,199 @@
 Test cases for API
 """
 
+import contextlib
+import datetime
+import gzip
+import json
+import os
 import unittest
+import unittest.mock
+import sqlalchemy.event
 import yaml
 import microblog.api
+import microblog.db
+import microblog.ingest
+import microblog.metrics
+import microblog.source.twitter
 
 
 class Api(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
+        # Strict validation, responses drifting from the schema fail
+        cls.environment = unittest.mock.patch.dict(
+            os.environ, {"MB_API_VALIDATION": "full"}
+        )
+        cls.environment.start()
         cls.app = microblog.api.get_app()
         cls.client = cls.app.test_client()
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            session.add_all(
+                [
+                    microblog.model.MessageEntity(datasource, f"message{idx}", None)
+                    for idx in range(10)
+                ]
+            )
+            session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.environment.stop()
+
+    @contextlib.contextmanager
+    def count_statements(self):
+        statements = []
+
+        def before_cursor_execute(*args):
+            statements.append(args[2])
+
+        engine = microblog.db.get_engine()
+        sqlalchemy.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            sqlalchemy.event.remove(
+                engine, "before_cursor_execute", before_cursor_execute
+            )
 
     def test_get_provider(self):
         response = self.client.get("/openapi/v1/messages")
         self.assertEqual(200, response.status_code)
         self.assertEqual("application/json", response.content_type)
+        self.assertNotIn("cursor", response.json)
+
+    def test_pagination(self):
+        response = self.client.get("/openapi/v1/messages?limit=4")
+        self.assertEqual(200, response.status_code)
+        pages = [response.json["messages"]]
+        while pages[-1]:
+            response = self.client.get(
+                f"/openapi/v1/messages?limit=4&cursor={response.json['cursor']}"
+            )
+            self.assertEqual(200, response.status_code)
+            pages.append(response.json["messages"])
+        self.assertEqual([4, 4, 2, 0], [len(page) for page in pages])
+        messages = [message["message"] for page in pages for message in page]
+        self.assertEqual([f"message{idx}" for idx in range(10)], messages)
+
+    def test_pagination_after_id(self):
+        first = self.client.get("/openapi/v1/messages?limit=2").json["messages"]
+        response = self.client.get(
+            f"/openapi/v1/messages?after_id={first[0]['id']}&limit=1"
+        )
+        self.assertEqual([first[1]], response.json["messages"])
+
+    def test_pagination_datasource(self):
+        response = self.client.get("/openapi/v1/messages?datasource=twitter")
+        self.assertEqual(10, len(response.json["messages"]))
+        response = self.client.get("/openapi/v1/messages?datasource=unknown")
+        self.assertEqual([], response.json["messages"])
+
+    def test_pagination_invalid(self):
+        response = self.client.get("/openapi/v1/messages?cursor=invalid")
+        self.assertEqual(400, response.status_code)
+        response = self.client.get("/openapi/v1/messages?limit=0")
+        self.assertEqual(400, response.status_code)
+
+    def test_search(self):
+        response = self.client.get(
+            "/openapi/v1/messages/search?q=message3&snippet=true"
+        )
+        self.assertEqual(200, response.status_code)
+        messages = response.json["messages"]
+        self.assertEqual(["message3"], [message["message"] for message in messages])
+        self.assertEqual("<mark>message3</mark>", messages[0]["snippet"])
+        self.assertNotIn("cursor", response.json)
+        response = self.client.get("/openapi/v1/messages/search?q=message3&limit=1")
+        self.assertNotIn("snippet", response.json["messages"][0])
+        response = self.client.get(
+            f"/openapi/v1/messages/search?q=message3&cursor={response.json['cursor']}"
+        )
+        self.assertEqual([], response.json["messages"])
+
+    def test_search_invalid(self):
+        response = self.client.get("/openapi/v1/messages/search")
+        self.assertEqual(400, response.status_code)
+        response = self.client.get("/openapi/v1/messages/search?q=a&cursor=invalid")
+        self.assertEqual(400, response.status_code)
+
+    def test_fragments(self):
+        response = self.client.get("/openapi/v1/messages?limit=1000")
+        with microblog.db.get_session() as session:
+            # Half of the messages with fragments
+            microblog.model.MessageEntity.render_fragments(
+                session, response.json["messages"][5]["id"]
+            )
+            session.commit()
+        self.app.response_cache.clear()
+        rendered = self.client.get("/openapi/v1/messages?limit=1000")
+        self.assertEqual(response.json, rendered.json)
+
+    def test_statements_per_request(self):
+        # A cold page costs the data version check and the query itself
+        self.app.response_cache.clear()
+        with self.count_statements() as statements:
+            response = self.client.get("/openapi/v1/messages?limit=50")
+        self.assertEqual(10, len(response.json["messages"]))
+        self.assertEqual(2, len(statements))
+        with self.count_statements() as statements:
+            response = self.client.get("/openapi/v1/messages?datasource=twitter")
+        self.assertEqual(10, len(response.json["messages"]))
+        self.assertEqual(2, len(statements))
+        with self.count_statements() as statements:
+            response = self.client.get("/openapi/v1/messages?datasource=twitter")
+        self.assertEqual(10, len(response.json["messages"]))
+        self.assertEqual(1, len(statements))
+        with self.count_statements() as statements:
+            response = self.client.get("/openapi/v1/messages")
+        self.assertEqual(10, len(response.json["messages"]))
+        self.assertEqual(2, len(statements))
+
+    def test_etag(self):
+        response = self.client.get("/openapi/v1/messages?limit=3")
+        self.assertEqual(200, response.status_code)
+        etag = response.headers["ETag"]
+        response = self.client.get(
+            "/openapi/v1/messages?limit=3", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b"", response.data)
+        response = self.client.get(
+            "/openapi/v1/openapi.yaml", headers={"If-None-Match": etag}
+        )
+        self.assertEqual(200, response.status_code)
+        response = self.client.get(
+            "/openapi/v1/openapi.yaml",
+            headers={"If-None-Match": response.headers["ETag"]},
+        )
+        self.assertEqual(304, response.status_code)
+
+    def test_cache_invalidation(self):
+        first = self.client.get("/openapi/v1/messages?after_id=0&limit=1000")
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            session.add(microblog.model.MessageEntity(datasource, "new", None))
+            session.commit()
+            cached = self.client.get("/openapi/v1/messages?after_id=0&limit=1000")
+            self.assertEqual(first.json, cached.json)
+            microblog.model.DataVersion.bump(session)
+            session.commit()
+        response = self.client.get(
+            "/openapi/v1/messages?after_id=0&limit=1000",
+            headers={"If-None-Match": first.headers["ETag"]},
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("new", response.json["messages"][-1]["message"])
+        with microblog.db.get_session() as session:
+            session.delete(
+                session.get(
+                    microblog.model.MessageEntity,
+                    response.json["messages"][-1]["id"],
+                )
+            )
+            microblog.model.DataVersion.bump(session)
+            session.commit()
 
     def test_openapi_schema(self):
         response = self.client.get("/openapi/v1/openapi.yaml")
@@ -26,3 +204,83 @@ class Api(unittest.TestCase):
         self.assertEqual("application/yaml", response.content_type)
         expected = yaml.dump(microblog.schema.SCHEMA_V1)
         self.assertEqual(expected, response.text)
+
+    def test_export(self):
+        response = self.client.get("/openapi/v1/export?datasource=twitter")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("application/x-ndjson", response.mimetype)
+        messages = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual(
+            [f"message{idx}" for idx in range(10)],
+            [message["message"] for message in messages],
+        )
+        ids = [message["id"] for message in messages]
+        response = self.client.get(
+            f"/openapi/v1/export?min_id={ids[2]}&max_id={ids[4]}&gzip=true"
+        )
+        self.assertEqual("gzip", response.headers["Content-Encoding"])
+        lines = gzip.decompress(response.data).decode().splitlines()
+        self.assertEqual(ids[2:5], [json.loads(line)["id"] for line in lines])
+
+    def test_export_invalid(self):
+        response = self.client.get("/openapi/v1/export?min_id=-1")
+        self.assertEqual(400, response.status_code)
+
+    def test_stats(self):
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            with microblog.ingest.BufferedWriter(session, datasource) as writer:
+                for minute in (1, 1, 2):
+                    writer.add(
+                        '{"text":"stats"}', datetime.datetime(2022, 8, 1, 13, minute)
+                    )
+        response = self.client.get(
+            "/openapi/v1/stats?granularity=minute&datasource=twitter"
+            "&since=2022-08-01 13:00:00&limit=1"
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            [
+                {
+                    "datasource_name": "twitter",
+                    "bucket": "2022-08-01 13:02:00",
+                    "captured": 1,
+                    "messages": 0,
+                }
+            ],
+            response.json["buckets"],
+        )
+        self.assertIn(
+            {"datasource_name": "twitter", "pending": 3}, response.json["backlog"]
+        )
+        response = self.client.get("/openapi/v1/stats")
+        self.assertEqual("hour", response.json["granularity"])
+        self.assertEqual(
+            3,
+            sum(
+                bucket["captured"]
+                for bucket in response.json["buckets"]
+                if bucket["bucket"] == "2022-08-01 13:00:00"
+            ),
+        )
+        response = self.client.get("/openapi/v1/stats?granularity=week")
+        self.assertEqual(400, response.status_code)
+
+    def test_metrics(self):
+        response = self.client.get("/metrics")
+        self.assertEqual(404, response.status_code)
+        microblog.metrics.set_enabled(True)
+        try:
+            client = microblog.api.get_app().test_client()
+            self.assertEqual(200, client.get("/openapi/v1/messages").status_code)
+            response = client.get("/metrics")
+        finally:
+            microblog.metrics.set_enabled(False)
+        self.assertEqual(200, response.status_code)
+        body = response.get_data(as_text=True)
+        self.assertIn(
+            'mb_http_requests_total{endpoint="/openapi/v1/messages",status="200"}',
+            body,
+        )
+        self.assertIn('mb_query_seconds_count{query="get_a_lot"}', body)
+        self.assertIn("mb_raw_backlog", body)
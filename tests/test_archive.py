@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test cases for archival of raw data
+"""
+
+import datetime
+import os
+import tempfile
+import unittest
+import sqlalchemy
+import microblog.archive
+import microblog.db
+import microblog.model
+import microblog.source.twitter
+
+
+class Archive(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def add_raws(self, session, days_ago, processed, count=3):
+        datasource = microblog.source.twitter.get_datasource(session)
+        entity = microblog.model.MessageEntity(datasource, "archived", None)
+        session.add(entity)
+        session.flush()
+        timestamp = datetime.datetime.combine(
+            datetime.date.today() - datetime.timedelta(days=days_ago),
+            datetime.time(12),
+        )
+        raws = []
+        for idx in range(count):
+            raw = microblog.model.RawSourceData(
+                datasource,
+                f'{{"text":"archive{idx}"}}',
+                timestamp + datetime.timedelta(seconds=idx),
+                dedup_key=None if idx == 0 else f"archive-{days_ago}-{processed}-{idx}",
+            )
+            raw.entity_id = entity.id if processed else None
+            raws.append(raw)
+        session.add_all(raws)
+        session.commit()
+        return [raw.id for raw in raws]
+
+    def test_file_roundtrip(self):
+        rows = [
+            (1, 10, datetime.datetime(2022, 8, 1, 12, 0, 0, 1), None, '{"text":"ä"}'),
+            (5, 9, datetime.datetime(2022, 8, 1, 12, 0, 1), "key", "{}"),
+        ]
+        path = os.path.join(self.directory.name, "test.mbc")
+        microblog.archive.write_file(path, "twitter", rows)
+        self.assertEqual(("twitter", rows), microblog.archive.read_file(path))
+
+    def test_archive_and_replay(self):
+        with microblog.db.get_session() as session:
+            old = self.add_raws(session, 40, True)
+            recent = self.add_raws(session, 1, True)
+            pending = self.add_raws(session, 40, False)
+            counters = microblog.archive.archive(session, self.directory.name, 30)
+            self.assertEqual(len(old), counters["rows"])
+            remaining = {
+                raw_id
+                for raw_id in old + recent + pending
+                if session.get(microblog.model.RawSourceData, raw_id) is not None
+            }
+            self.assertEqual(set(recent + pending), remaining)
+            files = microblog.archive.find_files([self.directory.name])
+            self.assertEqual(1, len(files))
+            day = datetime.date.today() - datetime.timedelta(days=40)
+            self.assertIn(f"datasource=twitter/date={day.isoformat()}", files[0])
+            restored = microblog.archive.replay(session, [self.directory.name])
+            self.assertEqual(len(old), restored)
+            raw = session.get(microblog.model.RawSourceData, old[1])
+            self.assertEqual('{"text":"archive1"}', raw.data)
+            self.assertIsNotNone(raw.entity_id)
+            # Rows still present are kept as they are and not counted
+            self.assertEqual(0, microblog.archive.replay(session, files))
+
+    def test_replay_reused_ids(self):
+        with microblog.db.get_session() as session:
+            old = self.add_raws(session, 50, True)
+            timestamps = [
+                session.get(microblog.model.RawSourceData, raw_id).timestamp
+                for raw_id in old
+            ]
+            microblog.archive.archive(session, self.directory.name, 30)
+            # New captures take the ids of the archived rows
+            new = self.add_raws(session, 2, True)
+            self.assertTrue(set(old) & set(new))
+            files = microblog.archive.find_files([self.directory.name])
+            self.assertLessEqual(len(old), microblog.archive.replay(session, files))
+            raw = microblog.model.RawSourceData
+            restored = session.scalars(
+                sqlalchemy.select(raw.data)
+                .where(raw.timestamp.in_(timestamps))
+                .order_by(raw.timestamp)
+            ).all()
+            self.assertEqual(
+                [f'{{"text":"archive{idx}"}}' for idx in range(3)], restored
+            )
+            self.assertEqual(
+                [f'{{"text":"archive{idx}"}}' for idx in range(3)],
+                [session.get(raw, raw_id).data for raw_id in new],
+            )
+            # Replaying again restores nothing twice
+            self.assertEqual(0, microblog.archive.replay(session, files))
+            self.assertEqual(
+                3,
+                session.scalar(
+                    sqlalchemy.select(sqlalchemy.func.count()).where(
+                        raw.timestamp.in_(timestamps)
+                    )
+                ),
+            )
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test cases for the response cache
+"""
+
+import time
+import unittest
+import microblog.cache
+
+
+class LRUCache(unittest.TestCase):
+    def test_eviction(self):
+        cache = microblog.cache.LRUCache(size=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(3, cache.get("c"))
+        stats = cache.stats()
+        self.assertEqual(1, stats["evictions"])
+        self.assertEqual(2, stats["entries"])
+
+    def test_ttl(self):
+        cache = microblog.cache.LRUCache(size=2, ttl=0.01)
+        cache.set("a", 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(0, cache.stats()["entries"])
+
+    def test_disabled(self):
+        cache = microblog.cache.LRUCache(size=0, ttl=60)
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test cases for the asynchronous capture engine
+"""
+
+import asyncio
+import os
+import tempfile
+import unittest
+import sqlalchemy
+import microblog.capture
+import microblog.db
+import microblog.ingest
+import microblog.source.twitter
+
+
+class CaptureQueue(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.spill_path = os.path.join(self.directory.name, "capture.spill")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def count_raws(self, session, prefix):
+        return session.scalar(
+            sqlalchemy.select(
+                sqlalchemy.func.count(microblog.model.RawSourceData.id)
+            ).where(
+                sqlalchemy.func.mb_payload(
+                    microblog.model.RawSourceData.data
+                ).startswith(prefix)
+            )
+        )
+
+    def capture(self, policy, prefix, count, size=4):
+        """
+        Put count payloads into a queue of the given size while the writer is
+        stalled, then let the writer drain it, returns the queue statistics
+        """
+
+        async def run(writer):
+            capture_queue = microblog.capture.CaptureQueue(
+                size=size, policy=policy, spill_path=self.spill_path
+            )
+            producer = asyncio.gather(
+                *[capture_queue.put(f"{prefix}{idx}") for idx in range(count)]
+            )
+            await asyncio.sleep(0)
+            writer_task = asyncio.create_task(
+                microblog.capture.run_writer(capture_queue, writer)
+            )
+            await producer
+            await capture_queue.close()
+            await writer_task
+            return capture_queue.stats()
+
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            writer = microblog.ingest.BufferedWriter(
+                session, datasource, batch_size=3, flush_interval=3600
+            )
+            stats = asyncio.run(run(writer))
+            return stats, self.count_raws(session, prefix)
+
+    def test_block(self):
+        stats, written = self.capture("block", "block", 10)
+        self.assertEqual(10, written)
+        self.assertEqual(10, stats["received"])
+        self.assertEqual(4, stats["max_depth"])
+        self.assertEqual(0, stats["depth"])
+
+    def test_drop(self):
+        stats, written = self.capture("drop", "drop", 10)
+        self.assertEqual(4, written)
+        self.assertEqual(6, stats["dropped"])
+
+    def test_spill(self):
+        stats, written = self.capture("spill", "spill", 10)
+        self.assertEqual(10, written)
+        self.assertEqual(6, stats["spilled"])
+        self.assertFalse(os.path.exists(self.spill_path))
+        self.assertFalse(os.path.exists(f"{self.spill_path}.replay"))
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            microblog.capture.CaptureQueue(policy="unknown")
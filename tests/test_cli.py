@@ -4,15 +4,45 @@
 Test cases for CLI
 """
 
+import gzip
+import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
+import unittest.mock
+from docopt import docopt
 import microblog.cli
 
 ARGS = {
     "--help": False,
     "--version": False,
+    "--workers": "1",
+    "--chunk-size": None,
+    "--sql": False,
+    "--follow": False,
+    "--threads": None,
+    "--async": False,
+    "--codec": None,
+    "--train": False,
+    "--batch-size": None,
+    "--retention-days": None,
+    "--directory": None,
+    "<path>": [],
+    "archive": False,
+    "replay": False,
+    "--datasource": None,
+    "--min-id": None,
+    "--max-id": None,
+    "--gzip": False,
     "<source>": None,
+    "<file>": None,
     "capture": False,
+    "export": False,
     "openapi": True,
+    "recompress": False,
+    "reindex": False,
     "serve": False,
     "transfer": False,
 }
@@ -25,11 +55,83 @@ class Cli(unittest.TestCase):
         result = microblog.cli.arg_runner(arguments)
         self.assertEqual(0, result)
 
+    def test_usage(self):
+        # Option names in the docs' prose would be taken as options, too
+        arguments = docopt(microblog.cli.DOCOPT, ["transfer", "twitter", "--follow"])
+        self.assertEqual(set(), set(arguments) - set(ARGS))
+        self.assertTrue(arguments["--follow"])
+
+    def test_lazy_imports(self):
+        # The schema doesn't need any of the heavy dependencies
+        code = (
+            "import sys, microblog.cli; microblog.cli.openapi(); "
+            "print(' '.join(sys.modules))"
+        )
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        modules = output.splitlines()[-1].split()
+        for name in ("flask", "openapi_core", "sqlalchemy", "tweepy"):
+            self.assertNotIn(name, modules)
+
     def test_capture(self):
-        pass
+        arguments = ARGS.copy()
+        arguments["openapi"] = False
+        arguments["capture"] = True
+        arguments["<source>"] = "twitter"
+        with unittest.mock.patch("microblog.source.twitter.capture") as capture:
+            result = microblog.cli.arg_runner(arguments)
+        capture.assert_called_once()
+        self.assertEqual(0, result)
+        arguments["<source>"] = "unknown"
+        with self.assertRaises(ValueError):
+            microblog.cli.arg_runner(arguments)
 
     def test_serve(self):
-        pass
+        arguments = ARGS.copy()
+        arguments["openapi"] = False
+        arguments["serve"] = True
+        with unittest.mock.patch("flask.Flask.run") as run:
+            result = microblog.cli.arg_runner(arguments)
+        run.assert_called_once_with(host="0.0.0.0", port="5000")
+        self.assertEqual(0, result)
+        arguments["--workers"] = "4"
+        with unittest.mock.patch("microblog.server.serve") as serve:
+            result = microblog.cli.arg_runner(arguments)
+        serve.assert_called_once_with(4, 1)
+        self.assertEqual(0, result)
+
+    def test_serve_without_gunicorn(self):
+        arguments = ARGS.copy()
+        arguments["openapi"] = False
+        arguments["serve"] = True
+        arguments["--workers"] = "2"
+        missing = {"gunicorn": None, "gunicorn.app": None, "gunicorn.app.base": None}
+        # The CLI logs the message as fatal error
+        with unittest.mock.patch.dict(sys.modules, missing):
+            with self.assertRaisesRegex(ValueError, "pip install gunicorn"):
+                microblog.cli.arg_runner(arguments)
 
     def test_transfer(self):
-        pass
+        arguments = ARGS.copy()
+        arguments["openapi"] = False
+        arguments["transfer"] = True
+        arguments["<source>"] = "twitter"
+        result = microblog.cli.arg_runner(arguments)
+        self.assertEqual(0, result)
+
+    def test_export(self):
+        arguments = ARGS.copy()
+        arguments["openapi"] = False
+        arguments["export"] = True
+        arguments["--gzip"] = True
+        with tempfile.TemporaryDirectory() as directory:
+            arguments["<file>"] = os.path.join(directory, "export.ndjson.gz")
+            result = microblog.cli.arg_runner(arguments)
+            with gzip.open(arguments["<file>"], "rt") as export:
+                for line in export:
+                    self.assertIn("message", json.loads(line))
+        self.assertEqual(0, result)
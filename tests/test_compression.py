@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test cases for compressed raw data storage
+"""
+
+import json
+import os
+import unittest
+from unittest import mock
+import sqlalchemy
+import microblog.compression
+import microblog.db
+import microblog.model
+import microblog.source.twitter
+
+PAYLOADS = [
+    json.dumps({"id": str(idx), "text": f"compressed message {idx}"})
+    for idx in range(50)
+]
+
+
+class Compression(unittest.TestCase):
+    def stored(self, session, raw_id):
+        return session.scalar(
+            sqlalchemy.text("SELECT data FROM rawsourcedata WHERE id = :id"),
+            {"id": raw_id},
+        )
+
+    def add_raws(self, session, prefix):
+        datasource = microblog.source.twitter.get_datasource(session)
+        raws = [
+            microblog.model.RawSourceData(
+                datasource, payload, dedup_key=f"{prefix}-{idx}"
+            )
+            for idx, payload in enumerate(PAYLOADS)
+        ]
+        session.add_all(raws)
+        session.commit()
+        return [raw.id for raw in raws]
+
+    def test_roundtrip(self):
+        for codec in microblog.compression.CODECS:
+            if codec == "zstd" and microblog.compression.zstandard is None:
+                continue
+            with self.subTest(codec):
+                encoder = microblog.compression.get_encoder(codec)
+                for payload in PAYLOADS:
+                    stored = encoder.encode(payload)
+                    self.assertEqual(payload, microblog.compression.decode(stored))
+                    self.assertEqual(
+                        (codec, None), microblog.compression.get_format(stored)
+                    )
+
+    def test_legacy_text(self):
+        self.assertEqual("{}", microblog.compression.decode("{}"))
+        self.assertIsNone(microblog.compression.decode(None))
+
+    def test_transparent(self):
+        with mock.patch.dict(os.environ, {"MB_RAW_CODEC": "zlib"}):
+            with microblog.db.get_session() as session:
+                raw_ids = self.add_raws(session, "transparent")
+                self.assertIsInstance(self.stored(session, raw_ids[0]), bytes)
+            with microblog.db.get_session() as session:
+                raw = session.get(microblog.model.RawSourceData, raw_ids[0])
+                self.assertEqual(PAYLOADS[0], raw.data)
+                self.assertEqual(PAYLOADS[0], raw.asdict()["data"])
+                entity = microblog.source.twitter.transform([raw])[0]
+                self.assertEqual("compressed message 0", entity.message)
+                self.assertEqual(
+                    "compressed message 1",
+                    session.scalar(
+                        sqlalchemy.text(
+                            "SELECT json_extract(mb_payload(data), '$.text') "
+                            "FROM rawsourcedata WHERE id = :id"
+                        ),
+                        {"id": raw_ids[1]},
+                    ),
+                )
+
+    def test_recompress(self):
+        with microblog.db.get_session() as session:
+            raw_ids = self.add_raws(session, "recompress")
+            self.assertIsInstance(self.stored(session, raw_ids[0]), str)
+            dictionary_id = microblog.compression.store_dictionary(session, "zlib")
+            counters = microblog.compression.recompress(session, "zlib", dictionary_id)
+            self.assertLess(counters["bytes_after"], counters["bytes_before"])
+            stored = self.stored(session, raw_ids[0])
+            self.assertEqual(
+                ("zlib", dictionary_id), microblog.compression.get_format(stored)
+            )
+            self.assertEqual(PAYLOADS[0], microblog.compression.decode(stored))
+            counters = microblog.compression.recompress(session, "zlib", dictionary_id)
+            self.assertEqual(0, counters["recompressed"])
+            microblog.compression.recompress(session, "plain")
+            self.assertEqual(PAYLOADS[0], self.stored(session, raw_ids[0]))
+
+    @unittest.skipIf(microblog.compression.zstandard is None, "requires zstandard")
+    def test_zstd_dictionary(self):
+        samples = [
+            json.dumps({"id": str(idx), "text": f"sample tweet number {idx}"})
+            for idx in range(2000)
+        ]
+        data = microblog.compression.train_dictionary("zstd", samples)
+        with microblog.db.get_session() as session:
+            dictionary_id = session.execute(
+                sqlalchemy.insert(microblog.model.CompressionDictionary).values(
+                    codec="zstd", data=data
+                )
+            ).inserted_primary_key[0]
+            session.commit()
+        encoder = microblog.compression.get_encoder("zstd", dictionary_id)
+        stored = encoder.encode(samples[0])
+        self.assertEqual(samples[0], microblog.compression.decode(stored))
+        self.assertLess(
+            len(stored),
+            len(microblog.compression.get_encoder("zstd").encode(samples[0])),
+        )
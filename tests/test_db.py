@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test cases for database set up
+"""
+
+import os
+import unittest
+import unittest.mock
+import sqlalchemy
+import microblog.db
+import microblog.model
+
+
+class Db(unittest.TestCase):
+    def test_engine_cached(self):
+        self.assertIs(microblog.db.get_engine(), microblog.db.get_engine())
+        with microblog.db.get_session() as first, microblog.db.get_session() as second:
+            self.assertIs(first.get_bind(), second.get_bind())
+
+    def test_pragmas_applied(self):
+        with microblog.db.get_engine().connect() as connection:
+            journal_mode = connection.exec_driver_sql("PRAGMA journal_mode").scalar()
+            busy_timeout = connection.exec_driver_sql("PRAGMA busy_timeout").scalar()
+        self.assertEqual("wal", journal_mode)
+        self.assertEqual(5000, busy_timeout)
+
+    def test_pragma_override(self):
+        with unittest.mock.patch.dict(
+            os.environ, {"SQLITE_PROFILE": "safe", "SQLITE_PRAGMA_BUSY_TIMEOUT": "100"}
+        ):
+            pragmas = microblog.db.get_pragmas()
+        self.assertEqual("DELETE", pragmas["journal_mode"])
+        self.assertEqual("100", pragmas["busy_timeout"])
+
+    def test_unknown_profile(self):
+        with unittest.mock.patch.dict(os.environ, {"SQLITE_PROFILE": "fast"}):
+            with self.assertRaises(ValueError):
+                microblog.db.get_pragmas()
+
+    def test_schema_created(self):
+        inspector = sqlalchemy.inspect(microblog.db.get_engine())
+        self.assertTrue(inspector.has_table("messageentity"))
+        self.assertTrue(inspector.has_table("rawsourcedata"))
+        self.assertTrue(inspector.has_table("datasource"))
+
+    def test_read_only(self):
+        microblog.db.get_engine()
+        microblog.db.dispose_engines()
+        # As in a worker, which must not touch the schema
+        with unittest.mock.patch("microblog.migrations.migrate") as migrate:
+            engine = microblog.db.get_engine(read_only=True)
+        migrate.assert_not_called()
+        self.assertIsNot(microblog.db.get_engine(), engine)
+        self.assertIs(engine, microblog.db.get_engine(read_only=True))
+        microblog.db.warm_up(engine)
+        with engine.connect() as connection:
+            connection.execute(sqlalchemy.select(microblog.model.MessageEntity.id))
+            with self.assertRaises(sqlalchemy.exc.OperationalError):
+                connection.exec_driver_sql("DELETE FROM messageentity")
+
+    def test_engines_per_process(self):
+        engine = microblog.db.get_engine()
+        # As seen from a forked worker
+        with unittest.mock.patch("os.getpid", return_value=-1):
+            worker_engine = microblog.db.get_engine()
+            self.assertIsNot(engine, worker_engine)
+            self.assertIs(worker_engine, microblog.db.get_engine())
+        microblog.db.dispose_engines()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test cases for deduplication
+"""
+
+import unittest
+import microblog.db
+import microblog.dedup
+import microblog.model
+import microblog.source.twitter
+
+
+class BloomFilter(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = microblog.dedup.BloomFilter(1000, 0.01)
+        keys = [f"key{idx}" for idx in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+
+    def test_false_positive_rate(self):
+        bloom = microblog.dedup.BloomFilter(1000, 0.01)
+        for idx in range(1000):
+            bloom.add(f"key{idx}")
+        false_positives = sum(f"other{idx}" in bloom for idx in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class Deduplicator(unittest.TestCase):
+    def test_lookup(self):
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            raw = microblog.model.RawSourceData(datasource, "{}", dedup_key="stored")
+            session.add(raw)
+            session.commit()
+            deduplicator = microblog.dedup.Deduplicator(
+                session, microblog.model.RawSourceData, datasource.id
+            )
+            self.assertEqual(raw.id, deduplicator.lookup("stored"))
+            self.assertIsNone(deduplicator.lookup("new"))
+            deduplicator.remember("new", "pending")
+            self.assertEqual("pending", deduplicator.lookup("new"))
+            deduplicator.reset_pending()
+            self.assertIsNone(deduplicator.lookup("new"))
+            stats = deduplicator.stats()
+        self.assertEqual(2, stats["duplicates"])
+        self.assertEqual(2, stats["unique"])
+        # Only keys in the filter are looked up in the database
+        self.assertEqual(2, stats["lookups"])
+        self.assertEqual(1, stats["false_positives"])
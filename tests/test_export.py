@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test cases for export
+"""
+
+import gzip
+import io
+import json
+import unittest
+import microblog.db
+import microblog.export
+import microblog.model
+import microblog.source.twitter
+
+
+class Export(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            entities = [
+                microblog.model.MessageEntity(datasource, f"export{idx}", None)
+                for idx in range(25)
+            ]
+            session.add_all(entities)
+            session.commit()
+            cls.ids = [entity.id for entity in entities]
+
+    def test_chunks(self):
+        with microblog.db.get_session() as session:
+            chunks = list(
+                microblog.export.generate_ndjson(
+                    session, min_id=self.ids[0], max_id=self.ids[-1], chunk_size=10
+                )
+            )
+        self.assertEqual([10, 10, 5], [chunk.count(b"\n") for chunk in chunks])
+        messages = [json.loads(line) for line in b"".join(chunks).splitlines()]
+        self.assertEqual(self.ids, [message["id"] for message in messages])
+        self.assertEqual("twitter", messages[0]["datasource_name"])
+
+    def test_gzip(self):
+        output = io.BytesIO()
+        with microblog.db.get_session() as session:
+            written = microblog.export.export(
+                session, output, gzip=True, min_id=self.ids[0], max_id=self.ids[4]
+            )
+        self.assertEqual(written, len(output.getvalue()))
+        lines = gzip.decompress(output.getvalue()).splitlines()
+        self.assertEqual(self.ids[:5], [json.loads(line)["id"] for line in lines])
+
+    def test_datasource(self):
+        output = io.BytesIO()
+        with microblog.db.get_session() as session:
+            microblog.export.export(session, output, datasource_name="unknown")
+        self.assertEqual(b"", output.getvalue())
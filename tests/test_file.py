@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test cases for the file source
+"""
+
+import gzip
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import sqlalchemy
+import microblog.db
+import microblog.model
+import microblog.notify
+import microblog.source.file
+import microblog.source.twitter
+import microblog.transfer
+
+LINES = [
+    '{"id":"f1","text":"first"}',
+    '{"id":"f2","text":"second \\u00e4"}',
+    '{"id":"f1","text":"first"}',
+    '{"id":"f3","text":"' + "x" * 100 + '"}',
+]
+
+
+class File(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, text, compress=False):
+        path = os.path.join(self.directory.name, name)
+        with (gzip.open if compress else open)(path, "wt", encoding="utf-8") as dump:
+            dump.write(text)
+        return path
+
+    def test_read_lines(self):
+        text = "\n".join(LINES) + "\n\n  \n"
+        for compress in (False, True):
+            path = self.write(f"dump{compress}.ndjson", text, compress)
+            # Small blocks split lines and need to grow for the long one
+            for block_size in (7, 64, 1024):
+                with self.subTest(compress=compress, block_size=block_size):
+                    self.assertEqual(
+                        LINES,
+                        list(microblog.source.file.read_lines(path, block_size)),
+                    )
+        # Without a trailing newline, and empty
+        path = self.write("last.ndjson", LINES[0])
+        self.assertEqual(LINES[:1], list(microblog.source.file.read_lines(path)))
+        path = self.write("empty.ndjson", "")
+        self.assertEqual([], list(microblog.source.file.read_lines(path)))
+
+    def test_capture_and_transfer(self):
+        self.write("a.ndjson", "\n".join(LINES[:2] + ["invalid", "[]"]))
+        self.write("b.ndjson.gz", "\n".join(LINES[2:]), compress=True)
+        self.write("ignored.txt", LINES[0])
+        microblog.source.file.capture({"MB_SOURCE_FILE_PATH": self.directory.name})
+        microblog.source.file.transfer()
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.file.get_datasource(session)
+            raws = session.scalars(
+                sqlalchemy.select(microblog.model.RawSourceData)
+                .where(microblog.model.RawSourceData.datasource_id == datasource.id)
+                .order_by(microblog.model.RawSourceData.id)
+            ).all()
+            # The repeated tweet is dropped at ingest
+            self.assertEqual([LINES[0], LINES[1], LINES[3]], [raw.data for raw in raws])
+            self.assertEqual(["f1", "f2", "f3"], [raw.dedup_key for raw in raws])
+            self.assertEqual(
+                ["first", "second ä", "x" * 100],
+                [raw.entity.message for raw in raws],
+            )
+
+    def test_ingest_duplicates(self):
+        line = '{"text":"without id"}'
+        with microblog.db.get_session() as session:
+            datasource = microblog.model.DataSource.get_or_create(session, "dups")
+            counters = microblog.source.file.ingest(
+                session, datasource, [line, line, "invalid"]
+            )
+            self.assertEqual({"rows": 1, "duplicates": 1, "skipped": 1}, counters)
+            # An overlapping dump stores nothing twice
+            counters = microblog.source.file.ingest(session, datasource, [line])
+            self.assertEqual({"rows": 0, "duplicates": 1, "skipped": 0}, counters)
+            raw = session.scalars(
+                sqlalchemy.select(microblog.model.RawSourceData).where(
+                    microblog.model.RawSourceData.datasource_id == datasource.id
+                )
+            ).one()
+            # Keyed like extract() keys it
+            self.assertEqual(microblog.source.twitter.extract(line)[1], raw.dedup_key)
+
+    def test_failed_commit(self):
+        with microblog.db.get_session() as session:
+            datasource = microblog.model.DataSource("failing")
+            session.add(datasource)
+            session.commit()
+            batches = iter([["first", "second"], ["third"]])
+
+            def lines():
+                yield from next(batches)
+
+            with mock.patch.object(
+                session,
+                "commit",
+                side_effect=sqlalchemy.exc.OperationalError("", {}, None),
+            ):
+                with self.assertRaises(sqlalchemy.exc.OperationalError):
+                    microblog.source.file.ingest(
+                        session,
+                        datasource,
+                        (f'{{"text":"{text}"}}' for text in lines()),
+                        2,
+                    )
+            # Rolled back, the next ingest neither fails nor repeats the batch
+            counters = microblog.source.file.ingest(
+                session, datasource, (f'{{"text":"{text}"}}' for text in lines()), 2
+            )
+            self.assertEqual(1, counters["rows"])
+            self.assertEqual(
+                ['{"text":"third"}'],
+                session.scalars(
+                    sqlalchemy.select(microblog.model.RawSourceData.data).where(
+                        microblog.model.RawSourceData.datasource_id == datasource.id
+                    )
+                ).all(),
+            )
+
+    @mock.patch.dict(os.environ, {"MB_TRANSFER_POLL_INTERVAL": "30"})
+    def test_follow(self):
+        stopped = threading.Event()
+
+        def follow():
+            with microblog.db.get_session() as session:
+                microblog.transfer.follow(
+                    session,
+                    microblog.source.file.get_datasource(session),
+                    microblog.source.twitter.extract,
+                    stopped=stopped,
+                )
+
+        def messages():
+            with microblog.db.get_session() as session:
+                datasource = microblog.source.file.get_datasource(session)
+                return session.scalars(
+                    sqlalchemy.select(microblog.model.RawSourceData)
+                    .where(microblog.model.RawSourceData.datasource_id == datasource.id)
+                    .where(microblog.model.RawSourceData.entity_id != None)
+                ).all()
+
+        lines = [f'{{"id":"follow{idx}","text":"follow"}}' for idx in range(3)]
+        expected = len(messages()) + len(lines)
+        follower = threading.Thread(target=follow)
+        follower.start()
+        try:
+            # Without the notification this would take the 30s poll interval
+            time.sleep(0.2)
+            path = self.write("a.ndjson", "\n".join(lines))
+            microblog.source.file.capture({"MB_SOURCE_FILE_PATH": path})
+            deadline = time.monotonic() + 10
+            while len(messages()) < expected and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(expected, len(messages()))
+        finally:
+            stopped.set()
+            microblog.notify.notify(microblog.db.get_engine().url)
+            follower.join()
+
+    def test_config(self):
+        with self.assertRaises(ValueError):
+            microblog.source.file.capture({})
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test cases for buffered ingest
+"""
+
+import datetime
+import unittest
+import sqlalchemy
+import microblog.db
+import microblog.dedup
+import microblog.ingest
+import microblog.source.twitter
+
+
+class BufferedWriter(unittest.TestCase):
+    def count_raws(self, session):
+        return session.scalar(
+            sqlalchemy.select(sqlalchemy.func.count(microblog.model.RawSourceData.id))
+        )
+
+    def test_flush_on_batch_size(self):
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            before = self.count_raws(session)
+            writer = microblog.ingest.BufferedWriter(
+                session, datasource, batch_size=3, flush_interval=3600
+            )
+            for idx in range(7):
+                writer.add(f'{{"text":"message{idx}"}}')
+            self.assertEqual(before + 6, self.count_raws(session))
+            self.assertEqual(1, writer.stats()["buffer_depth"])
+            writer.close()
+            self.assertEqual(before + 7, self.count_raws(session))
+            stats = writer.stats()
+            self.assertEqual(3, stats["flushes"])
+            self.assertEqual(7, stats["rows_written"])
+            self.assertEqual(3, stats["max_buffer_depth"])
+            self.assertEqual(0, stats["buffer_depth"])
+
+    def test_flush_on_interval(self):
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            before = self.count_raws(session)
+            with microblog.ingest.BufferedWriter(
+                session, datasource, batch_size=100, flush_interval=0
+            ) as writer:
+                writer.add('{"text":"message"}')
+                self.assertEqual(before + 1, self.count_raws(session))
+            raw = session.scalars(
+                sqlalchemy.select(microblog.model.RawSourceData).order_by(
+                    microblog.model.RawSourceData.id.desc()
+                )
+            ).first()
+            self.assertEqual('{"text":"message"}', raw.data)
+            self.assertIsNone(raw.entity_id)
+            self.assertEqual("twitter", raw.datasource.name)
+
+    def test_deduplicate(self):
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            before = self.count_raws(session)
+            with microblog.ingest.BufferedWriter(
+                session, datasource, batch_size=2, flush_interval=3600
+            ) as writer:
+                writer.add('{"id":"1","text":"message"}', dedup_key="dedup-1")
+                writer.add('{"id":"2","text":"message"}', dedup_key="dedup-2")
+            deduplicator = microblog.dedup.Deduplicator(
+                session, microblog.model.RawSourceData, datasource.id
+            )
+            with microblog.ingest.BufferedWriter(
+                session, datasource, batch_size=2, deduplicator=deduplicator
+            ) as writer:
+                writer.add('{"id":"1","text":"message"}', dedup_key="dedup-1")
+                writer.add('{"id":"3","text":"message"}', dedup_key="dedup-3")
+                writer.add('{"id":"3","text":"message"}', dedup_key="dedup-3")
+            self.assertEqual(before + 3, self.count_raws(session))
+            stats = writer.stats()
+            self.assertEqual(2, stats["dedup_duplicates"])
+            self.assertEqual(1, stats["dedup_unique"])
+
+    def test_fused(self):
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            with microblog.ingest.BufferedWriter(
+                session,
+                datasource,
+                batch_size=10,
+                flush_interval=3600,
+                extract=microblog.source.twitter.extract,
+            ) as writer:
+                writer.add('{"id":"fused-1","text":"parsed"}')
+                writer.add(
+                    '{"id":"fused-2","text":"raw"}',
+                    dedup_key="fused-2",
+                    message="given",
+                )
+                writer.add('{"id":"fused-1","text":"parsed"}')
+            raws = session.scalars(
+                sqlalchemy.select(microblog.model.RawSourceData)
+                .where(microblog.model.RawSourceData.dedup_key.like("fused-%"))
+                .order_by(microblog.model.RawSourceData.id)
+            ).all()
+            # The repeated payload is dropped, the others are linked right away
+            self.assertEqual(["fused-1", "fused-2"], [raw.dedup_key for raw in raws])
+            self.assertEqual(["parsed", "given"], [raw.entity.message for raw in raws])
+            self.assertEqual(
+                ["fused-1", "fused-2"], [raw.entity.dedup_key for raw in raws]
+            )
+
+    def test_fused_concurrent_duplicate(self):
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            with microblog.ingest.BufferedWriter(
+                session,
+                datasource,
+                batch_size=10,
+                flush_interval=3600,
+                extract=microblog.source.twitter.extract,
+            ) as writer:
+                writer.add('{"id":"fused-3","text":"buffered"}', dedup_key="fused-3")
+                writer.add('{"id":"fused-4","text":"new"}', dedup_key="fused-4")
+                # Another capture stores the same tweet before the flush
+                with microblog.db.get_session() as other:
+                    microblog.ingest.BufferedWriter.insert_raw(
+                        other,
+                        [
+                            {
+                                "datasource_id": datasource.id,
+                                "data": '{"id":"fused-3","text":"other"}',
+                                "timestamp": datetime.datetime.now(),
+                                "dedup_key": "fused-3",
+                            }
+                        ],
+                    )
+                    other.commit()
+            messages = session.scalars(
+                sqlalchemy.select(microblog.model.MessageEntity.dedup_key).where(
+                    microblog.model.MessageEntity.dedup_key.in_(["fused-3", "fused-4"])
+                )
+            ).all()
+            # The ignored payload leaves no message behind
+            self.assertEqual(["fused-4"], messages)
+            raw = session.scalars(
+                sqlalchemy.select(microblog.model.RawSourceData).where(
+                    microblog.model.RawSourceData.dedup_key == "fused-4"
+                )
+            ).one()
+            self.assertEqual("new", raw.entity.message)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test cases for metrics
+"""
+
+import os
+import tempfile
+import unittest
+import unittest.mock
+import microblog.metrics
+
+
+class Metrics(unittest.TestCase):
+    def setUp(self):
+        microblog.metrics.set_enabled(True)
+        self.registry = microblog.metrics.Registry()
+
+    def tearDown(self):
+        microblog.metrics.set_enabled(False)
+
+    def test_render(self):
+        counter = self.registry.counter("test_total", "Things counted")
+        counter.inc(endpoint="/a")
+        counter.inc(2, endpoint="/a")
+        counter.inc(endpoint='say "hi"')
+        histogram = self.registry.histogram("test_seconds", "Durations", (0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(
+            "# HELP test_seconds Durations\n"
+            "# TYPE test_seconds histogram\n"
+            'test_seconds_bucket{le="0.1"} 1\n'
+            'test_seconds_bucket{le="1.0"} 2\n'
+            'test_seconds_bucket{le="+Inf"} 3\n'
+            "test_seconds_count 3\n"
+            "test_seconds_sum 5.55\n"
+            "# HELP test_total Things counted\n"
+            "# TYPE test_total counter\n"
+            'test_total{endpoint="/a"} 3\n'
+            'test_total{endpoint="say \\"hi\\""} 1\n',
+            self.registry.render().decode(),
+        )
+
+    def test_disabled(self):
+        microblog.metrics.set_enabled(False)
+        counter = self.registry.counter("test_total", "Things counted")
+        histogram = self.registry.histogram("test_seconds", "Durations")
+        counter.inc()
+        with histogram.time(stage="test"):
+            pass
+        self.assertEqual({}, counter.values)
+        self.assertEqual({}, histogram.values)
+
+    def test_timer(self):
+        histogram = self.registry.histogram("test_seconds", "Durations")
+        with histogram.time(stage="test"):
+            pass
+        self.assertEqual(1, histogram.values[(("stage", "test"),)][-2])
+
+    def test_dumping(self):
+        microblog.metrics.CAPTURED.inc()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "microblog.prom")
+            with unittest.mock.patch.dict(
+                os.environ, {"MB_METRICS_PATH": path, "MB_METRICS_INTERVAL": "60"}
+            ):
+                with microblog.metrics.dumping():
+                    pass
+            with open(path, encoding="utf-8") as metrics_file:
+                self.assertIn("mb_capture_tweets_total ", metrics_file.read())
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test cases for schema migrations
+"""
+
+import contextlib
+import os
+import tempfile
+import unittest
+import sqlalchemy.event
+import microblog.db
+import microblog.migrations
+import microblog.model
+import microblog.source.twitter
+import microblog.transfer
+
+# Schema as created by create_all before any migration existed
+LEGACY_SCHEMA = [
+    "CREATE TABLE datasource (id INTEGER NOT NULL, name VARCHAR NOT NULL, "
+    "PRIMARY KEY (id))",
+    "CREATE TABLE messageentity (id INTEGER NOT NULL, "
+    "datasource_id INTEGER NOT NULL, message VARCHAR NOT NULL, PRIMARY KEY (id), "
+    "FOREIGN KEY(datasource_id) REFERENCES datasource (id))",
+    "CREATE TABLE rawsourcedata (id INTEGER NOT NULL, "
+    "datasource_id INTEGER NOT NULL, entity_id INTEGER, data VARCHAR NOT NULL, "
+    "timestamp DATETIME NOT NULL, PRIMARY KEY (id), "
+    "FOREIGN KEY(datasource_id) REFERENCES datasource (id), "
+    "FOREIGN KEY(entity_id) REFERENCES messageentity (id))",
+]
+
+
+class Migrations(unittest.TestCase):
+    @contextlib.contextmanager
+    def query_plans(self):
+        """
+        Collect the query plans of all SELECT statements issued meanwhile
+        """
+        engine = microblog.db.get_engine()
+        statements = []
+
+        def before_cursor_execute(*args):
+            if args[2].lstrip().startswith("SELECT"):
+                statements.append((args[2], args[3]))
+
+        plans = []
+        sqlalchemy.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            yield plans
+        finally:
+            sqlalchemy.event.remove(
+                engine, "before_cursor_execute", before_cursor_execute
+            )
+        with engine.connect() as connection:
+            for statement, parameters in statements:
+                rows = connection.exec_driver_sql(
+                    f"EXPLAIN QUERY PLAN {statement}", parameters
+                ).all()
+                plans.append(" / ".join(row[3] for row in rows))
+
+    def test_fresh_database(self):
+        with microblog.db.get_engine().connect() as connection:
+            self.assertEqual(
+                microblog.migrations.get_latest_version(),
+                microblog.migrations.get_version(connection),
+            )
+
+    def test_legacy_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            url = f"sqlite:///{os.path.join(directory, 'legacy.sqlite')}"
+            engine = sqlalchemy.create_engine(url)
+            with engine.begin() as connection:
+                for statement in LEGACY_SCHEMA:
+                    connection.exec_driver_sql(statement)
+            microblog.migrations.migrate(engine)
+            microblog.migrations.migrate(engine)
+            inspector = sqlalchemy.inspect(engine)
+            indexes = {
+                index["name"] for index in inspector.get_indexes("rawsourcedata")
+            }
+            self.assertIn("ix_rawsourcedata_pending", indexes)
+            with engine.connect() as connection:
+                self.assertEqual(
+                    microblog.migrations.get_latest_version(),
+                    microblog.migrations.get_version(connection),
+                )
+            engine.dispose()
+
+    def test_pending_raw_data_plan(self):
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            with self.query_plans() as plans:
+                datasource.get_raw_data()
+                microblog.transfer.read_pending(
+                    session, datasource.id, ("2022-01-01 00:00:00", 1), 20
+                )
+        self.assertEqual(2, len(plans))
+        for plan in plans:
+            self.assertIn("USING INDEX ix_rawsourcedata_pending", plan)
+            self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_message_page_plan(self):
+        with microblog.db.get_session() as session:
+            with self.query_plans() as plans:
+                microblog.model.MessageEntity.get_page(
+                    session, after_id=10, datasource_name="twitter"
+                )
+        self.assertEqual(1, len(plans))
+        self.assertIn("ix_messageentity_datasource_id_id", plans[0])
+        self.assertNotIn("TEMP B-TREE", plans[0])
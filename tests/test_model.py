@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test cases for data models
+"""
+
+import datetime
+import unittest
+import sqlalchemy
+import microblog.db
+import microblog.ingest
+import microblog.model
+import microblog.source.twitter
+import microblog.transfer
+
+
+class MessageEntity(unittest.TestCase):
+    def setUp(self):
+        with microblog.db.get_session() as session:
+            session.execute(sqlalchemy.delete(microblog.model.MessageEntity))
+            session.commit()
+
+    def add_messages(self, count):
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            session.execute(
+                sqlalchemy.insert(microblog.model.MessageEntity),
+                [
+                    {"datasource_id": datasource.id, "message": f"message{idx}"}
+                    for idx in range(count)
+                ],
+            )
+            session.commit()
+
+    def test_get_a_lot_empty(self):
+        with microblog.db.get_session() as session:
+            self.assertEqual([], microblog.model.MessageEntity.get_a_lot(session))
+
+    def test_get_a_lot_small_table(self):
+        self.add_messages(5)
+        with microblog.db.get_session() as session:
+            result = microblog.model.MessageEntity.get_a_lot(session)
+        self.assertEqual(
+            {f"message{idx}" for idx in range(5)}, {msg.message for msg in result}
+        )
+
+    def test_get_a_lot_distinct(self):
+        self.add_messages(1000)
+        with microblog.db.get_session() as session:
+            result = microblog.model.MessageEntity.get_a_lot(session)
+        self.assertGreaterEqual(len(result), 10)
+        self.assertLessEqual(len(result), 50)
+        self.assertEqual(len(result), len({msg.id for msg in result}))
+
+    def test_get_a_lot_sparse_ids(self):
+        self.add_messages(2000)
+        with microblog.db.get_session() as session:
+            session.execute(
+                sqlalchemy.delete(microblog.model.MessageEntity).where(
+                    microblog.model.MessageEntity.id % 100 != 0
+                )
+            )
+            session.commit()
+            result = microblog.model.MessageEntity.get_a_lot(session)
+        self.assertGreaterEqual(len(result), 10)
+        self.assertEqual(len(result), len({msg.id for msg in result}))
+
+    def add_texts(self, texts):
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            entities = [
+                microblog.model.MessageEntity(datasource, text, None) for text in texts
+            ]
+            session.add_all(entities)
+            session.commit()
+            return [entity.id for entity in entities]
+
+    def test_search(self):
+        ids = self.add_texts(
+            [
+                "the quick brown fox",
+                "fox fox fox jumps",
+                "a lazy dog",
+                'quoted "fox" and (brackets)',
+            ]
+        )
+        with microblog.db.get_session() as session:
+            search = microblog.model.MessageEntity.search
+            results = search(session, ["fox"])
+            # More occurrences in a shorter message rank better
+            self.assertEqual(ids[1], results[0].id)
+            self.assertEqual({ids[0], ids[1], ids[3]}, {row.id for row in results})
+            self.assertEqual(
+                [ids[0]], [row.id for row in search(session, ["fox", "quick"])]
+            )
+            # Query syntax in the terms is searched for like any other text
+            self.assertEqual(
+                [ids[3]], [row.id for row in search(session, ['"fox', "(brackets)"])]
+            )
+            pages = [
+                search(session, ["fox"], limit=2, offset=offset) for offset in (0, 2)
+            ]
+            self.assertEqual(results, pages[0] + pages[1])
+            self.assertEqual([], search(session, ["fox"], datasource_name="unknown"))
+            self.assertEqual([], search(session, []))
+            snippet = search(session, ["lazy"], snippet=True)[0].snippet
+            self.assertEqual("a <mark>lazy</mark> dog", snippet)
+
+    def test_search_index_sync(self):
+        ids = self.add_texts(["needle in a haystack", "another needle"])
+        with microblog.db.get_session() as session:
+            search = microblog.model.MessageEntity.search
+            entity = session.get(microblog.model.MessageEntity, ids[0])
+            entity.message = "only hay"
+            session.delete(session.get(microblog.model.MessageEntity, ids[1]))
+            session.commit()
+            self.assertEqual([], search(session, ["needle"]))
+            self.assertEqual([ids[0]], [row.id for row in search(session, ["hay"])])
+            microblog.model.MessageEntity.rebuild_search_index(session)
+            self.assertEqual([ids[0]], [row.id for row in search(session, ["hay"])])
+
+
+class Rollup(unittest.TestCase):
+    def snapshot(self, session, datasource):
+        rollups = session.execute(
+            sqlalchemy.select(
+                microblog.model.Rollup.granularity,
+                microblog.model.Rollup.bucket,
+                microblog.model.Rollup.captured,
+                microblog.model.Rollup.messages,
+            )
+            .where(microblog.model.Rollup.datasource_id == datasource.id)
+            .order_by(microblog.model.Rollup.granularity, microblog.model.Rollup.bucket)
+        ).all()
+        return rollups, microblog.model.DataSource.get_backlog(session)[datasource.name]
+
+    def test_incremental(self):
+        with microblog.db.get_session() as session:
+            datasource = microblog.model.DataSource("rollup")
+            session.add(datasource)
+            session.commit()
+            with microblog.ingest.BufferedWriter(session, datasource) as writer:
+                for idx in range(6):
+                    writer.add(
+                        f'{{"id":"r{idx % 5}","text":"rollup{idx % 5}"}}',
+                        datetime.datetime(2022, 8, 1, 13, idx // 2, 30),
+                    )
+            rollups, backlog = self.snapshot(session, datasource)
+            self.assertEqual(6, backlog)
+            self.assertIn(("hour", "2022-08-01 13:00:00", 6, 0), rollups)
+            self.assertIn(("minute", "2022-08-01 13:02:00", 2, 0), rollups)
+            # Half of it row by row, the rest within SQLite
+            microblog.transfer.serial_transfer(
+                session, datasource, microblog.source.twitter.extract, 3
+            )
+            microblog.transfer.sql_transfer(
+                session, datasource, microblog.source.twitter.SQL_MAPPING
+            )
+            rollups, backlog = self.snapshot(session, datasource)
+            self.assertEqual(0, backlog)
+            # The repeated tweet is no new message
+            self.assertIn(("day", "2022-08-01 00:00:00", 6, 5), rollups)
+            self.assertIn(("minute", "2022-08-01 13:02:00", 2, 1), rollups)
+            microblog.model.Rollup.rebuild(session)
+            session.commit()
+            self.assertEqual((rollups, backlog), self.snapshot(session, datasource))
+
+    def test_uncounted(self):
+        with microblog.db.get_session() as session:
+            datasource = microblog.model.DataSource("uncounted")
+            session.add(datasource)
+            session.commit()
+            # Raw data the writers don't know about, e.g. of a concurrent writer
+            session.add(microblog.model.RawSourceData(datasource, '{"text":"other"}'))
+            session.commit()
+            with microblog.ingest.BufferedWriter(session, datasource) as writer:
+                for _ in range(2):
+                    writer.add('{"id":"u1","text":"counted"}', dedup_key="u1")
+            rollups, backlog = self.snapshot(session, datasource)
+            self.assertEqual(1, backlog)
+            self.assertEqual({1}, {rollup.captured for rollup in rollups})
+            microblog.transfer.serial_transfer(
+                session, datasource, microblog.source.twitter.extract, 10
+            )
+            self.assertEqual(0, self.snapshot(session, datasource)[1])
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test cases for the raw data notifications
+"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+import microblog.notify
+import microblog.transfer
+
+
+class Notify(unittest.TestCase):
+    def test_socket_dir(self):
+        first = microblog.notify.get_socket_dir("sqlite:///a.sqlite")
+        self.assertNotEqual(first, microblog.notify.get_socket_dir("sqlite:///b"))
+        self.assertEqual(first, microblog.notify.get_socket_dir("sqlite:///a.sqlite"))
+        with mock.patch.dict(os.environ, {"MB_NOTIFY_DIR": "/tmp/mb"}):
+            self.assertEqual("/tmp/mb", microblog.notify.get_socket_dir("x"))
+
+    def test_notify(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch.dict(
+            os.environ, {"MB_NOTIFY_DIR": os.path.join(directory, "mb")}
+        ):
+            # Nobody listening yet
+            microblog.notify.notify("sqlite://")
+            with microblog.notify.Listener("sqlite://") as listener:
+                self.assertFalse(listener.wait(0))
+                for _ in range(3):
+                    microblog.notify.notify("sqlite://")
+                # All pending notifications are consumed at once
+                self.assertTrue(listener.wait(1))
+                self.assertFalse(listener.wait(0))
+            self.assertFalse(os.path.exists(listener.path))
+
+    def test_listeners(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch.dict(
+            os.environ, {"MB_NOTIFY_DIR": directory}
+        ):
+            with microblog.notify.Listener("sqlite://") as first:
+                with microblog.notify.Listener("sqlite://") as second:
+                    self.assertNotEqual(first.path, second.path)
+                    microblog.notify.notify("sqlite://")
+                    self.assertTrue(first.wait(1))
+                    self.assertTrue(second.wait(1))
+                # Closing one leaves the other listening
+                self.assertTrue(os.path.exists(first.path))
+                microblog.notify.notify("sqlite://")
+                self.assertTrue(first.wait(1))
+            # A socket nobody is bound to anymore is removed
+            stale = microblog.notify.Listener("sqlite://")
+            stale.socket.close()
+            stale.socket = None
+            microblog.notify.notify("sqlite://")
+            self.assertFalse(os.path.exists(stale.path))
+
+    def test_next_batch_size(self):
+        self.assertEqual(20, microblog.transfer.next_batch_size(10, 10, 10, 100))
+        self.assertEqual(100, microblog.transfer.next_batch_size(80, 80, 10, 100))
+        self.assertEqual(40, microblog.transfer.next_batch_size(80, 3, 10, 100))
+        self.assertEqual(10, microblog.transfer.next_batch_size(10, 0, 10, 100))
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test cases for the source registry
+"""
+
+import unittest
+import unittest.mock
+import microblog.registry
+import microblog.source.twitter
+
+
+class Registry(unittest.TestCase):
+    def test_builtin(self):
+        self.assertIn("twitter", microblog.registry.get_source_names())
+        self.assertIs(
+            microblog.source.twitter, microblog.registry.get_source("twitter")
+        )
+        with self.assertRaises(ValueError):
+            microblog.registry.get_source("unknown")
+
+    def test_entry_point(self):
+        entry_point = unittest.mock.Mock()
+        entry_point.name = "plugin"
+        entry_point.load.return_value = microblog.source.twitter
+        with unittest.mock.patch(
+            "importlib.metadata.entry_points", return_value=[entry_point]
+        ) as entry_points:
+            self.assertIn("plugin", microblog.registry.get_source_names())
+            self.assertIs(
+                microblog.source.twitter, microblog.registry.get_source("plugin")
+            )
+        entry_points.assert_called_with(group=microblog.registry.ENTRY_POINT_GROUP)
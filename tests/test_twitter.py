@@ -4,14 +4,36 @@
 Test cases for Twitter source
 """
 
+import itertools
+import json
+import os
 import unittest
+import unittest.mock
+import sqlalchemy
+import tweepy
 import microblog.db
+import microblog.dedup
 import microblog.source.twitter
+import microblog.source.twitter_stream
+import microblog.transfer
 
 
 class Twitter(unittest.TestCase):
+    tweet_ids = itertools.count()
+
     def test_transform(self):
-        pass
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            raws = [
+                microblog.model.RawSourceData(datasource, '{"id":"11","text":"one"}'),
+                microblog.model.RawSourceData(datasource, '{"text":"two"}'),
+            ]
+            entities = microblog.source.twitter.transform(raws)
+            self.assertEqual(["one", "two"], [cx.message for cx in entities])
+            self.assertEqual("11", entities[0].dedup_key)
+            self.assertEqual(
+                microblog.dedup.content_hash('{"text":"two"}'), entities[1].dedup_key
+            )
 
     def test_transfer(self):
         with microblog.db.get_session() as session:
@@ -49,5 +71,205 @@ class Twitter(unittest.TestCase):
                 result,
             )
 
+    def transferred(self, session, raw_ids):
+        raws = session.scalars(
+            sqlalchemy.select(microblog.model.RawSourceData)
+            .where(microblog.model.RawSourceData.id.in_(raw_ids))
+            .order_by(microblog.model.RawSourceData.id)
+        ).all()
+        return [(raw.entity_id, raw.entity.message) for raw in raws]
+
+    def add_raws(self, session, datasource, messages, tweet_ids=None):
+        if tweet_ids is None:
+            tweet_ids = [next(self.tweet_ids) for _ in messages]
+        raws = [
+            microblog.model.RawSourceData(
+                datasource, f'{{"id":"{tweet_id}","text":"{message}"}}'
+            )
+            for message, tweet_id in zip(messages, tweet_ids)
+        ]
+        session.add_all(raws)
+        session.commit()
+        return [raw.id for raw in raws]
+
+    def test_parallel_transfer(self):
+        messages = [f"message{idx}" for idx in range(10)]
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            serial_ids = self.add_raws(session, datasource, messages)
+        microblog.source.twitter.transfer()
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            parallel_ids = self.add_raws(session, datasource, messages)
+            microblog.transfer.parallel_transfer(
+                session,
+                datasource,
+                microblog.source.twitter.extract,
+                workers=2,
+                chunk_size=3,
+            )
+            serial = self.transferred(session, serial_ids)
+            parallel = self.transferred(session, parallel_ids)
+        self.assertEqual(messages, [message for _, message in serial])
+        self.assertEqual(messages, [message for _, message in parallel])
+        # Entity ids follow the raw data order, just like in the serial transfer
+        self.assertEqual(
+            [serial[-1][0] + 1 + idx for idx in range(len(messages))],
+            [entity_id for entity_id, _ in parallel],
+        )
+
+    def test_sql_transfer(self):
+        messages = [f"message{idx}" for idx in range(10)]
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            serial_ids = self.add_raws(session, datasource, messages)
+        microblog.source.twitter.transfer()
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            sql_ids = self.add_raws(session, datasource, messages)
+        microblog.source.twitter.transfer(chunk_size=4, sql=True)
+        with microblog.db.get_session() as session:
+            serial = self.transferred(session, serial_ids)
+            transferred = self.transferred(session, sql_ids)
+        self.assertEqual(messages, [message for _, message in transferred])
+        self.assertEqual(
+            [serial[-1][0] + 1 + idx for idx in range(len(messages))],
+            [entity_id for entity_id, _ in transferred],
+        )
+
+    def assert_deduplicated(self, run_transfer):
+        tweet_ids = [f"dedup-{run_transfer.__name__}-{idx}" for idx in range(4)]
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            first_ids = self.add_raws(
+                session, datasource, ["a", "b", "c"], tweet_ids[:3]
+            )
+            version = microblog.model.DataVersion.get(session)
+        run_transfer()
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            # Duplicates of stored messages and within the same batch
+            second_ids = self.add_raws(
+                session,
+                datasource,
+                ["a", "c", "d", "d"],
+                [tweet_ids[0], tweet_ids[2], tweet_ids[3], tweet_ids[3]],
+            )
+        run_transfer()
+        with microblog.db.get_session() as session:
+            first = self.transferred(session, first_ids)
+            second = self.transferred(session, second_ids)
+            # Both transfers committed new messages
+            self.assertLessEqual(version + 2, microblog.model.DataVersion.get(session))
+        self.assertEqual([first[0], first[2]], second[:2])
+        self.assertEqual(second[2], second[3])
+        self.assertNotIn(second[2][0], [entity_id for entity_id, _ in first])
+
+    def test_deduplicated_transfer(self):
+        def serial():
+            microblog.source.twitter.transfer()
+
+        def parallel():
+            microblog.source.twitter.transfer(workers=2)
+
+        def sql():
+            microblog.source.twitter.transfer(sql=True)
+
+        for run_transfer in (serial, parallel, sql):
+            with self.subTest(run_transfer.__name__):
+                self.assert_deduplicated(run_transfer)
+
+    def test_sql_transfer_content_hash(self):
+        data = '{"text":"no id"}'
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            raws = [microblog.model.RawSourceData(datasource, data) for _ in range(2)]
+            session.add_all(raws)
+            session.commit()
+            raw_ids = [raw.id for raw in raws]
+        microblog.source.twitter.transfer(sql=True)
+        with microblog.db.get_session() as session:
+            transferred = self.transferred(session, raw_ids)
+            entity = session.get(microblog.model.MessageEntity, transferred[0][0])
+            # Keyed just like extract() keys it, so both are one message
+            self.assertEqual(transferred[0], transferred[1])
+            self.assertEqual(microblog.dedup.content_hash(data), entity.dedup_key)
+
+    def test_transfer_without_message(self):
+        with microblog.db.get_session() as session:
+            datasource = microblog.source.twitter.get_datasource(session)
+            raw = microblog.model.RawSourceData(datasource, '{"id":"no text"}')
+            session.add(raw)
+            session.commit()
+            # Not mistaken for entity ids taken by a concurrent writer
+            attempts = []
+
+            def insert_raw(_session):
+                attempts.append(None)
+                return [(raw.id, None, "no text")]
+
+            with self.assertRaises(sqlalchemy.exc.IntegrityError):
+                microblog.transfer.write_entities(
+                    session, datasource.id, None, insert_raw=insert_raw
+                )
+            self.assertEqual(1, len(attempts))
+            with self.assertRaisesRegex(ValueError, str(raw.id)):
+                microblog.transfer.sql_transfer(
+                    session, datasource, microblog.source.twitter.SQL_MAPPING
+                )
+            self.assertIsNone(
+                session.get(microblog.model.RawSourceData, raw.id).entity_id
+            )
+            session.delete(raw)
+            session.commit()
+
+    @unittest.mock.patch.dict(os.environ, {"MB_MESSAGE_FRAGMENTS": "true"})
+    def test_fragments(self):
+        def serial():
+            microblog.source.twitter.transfer()
+
+        def parallel():
+            microblog.source.twitter.transfer(workers=2)
+
+        def sql():
+            microblog.source.twitter.transfer(sql=True)
+
+        for run_transfer in (serial, parallel, sql):
+            with self.subTest(run_transfer.__name__):
+                with microblog.db.get_session() as session:
+                    datasource = microblog.source.twitter.get_datasource(session)
+                    # Escaped within the raw JSON
+                    raw_ids = self.add_raws(
+                        session, datasource, ['\\"quoted\\" \\u00e4']
+                    )
+                run_transfer()
+                with microblog.db.get_session() as session:
+                    ((entity_id, _),) = self.transferred(session, raw_ids)
+                    entity = session.get(microblog.model.MessageEntity, entity_id)
+                    self.assertEqual(
+                        {
+                            "id": entity_id,
+                            "datasource_name": "twitter",
+                            "message": '"quoted" \u00e4',
+                        },
+                        json.loads(entity.fragment),
+                    )
+
     def test_capture(self):
-        pass
+        tweet_ids = [str(next(self.tweet_ids) + 1000000) for _ in range(3)]
+        tweets = [
+            tweepy.Tweet({"id": tweet_id, "text": f"capture {tweet_id}"})
+            for tweet_id in tweet_ids + tweet_ids[:1]
+        ]
+        client = microblog.source.twitter_stream.StreamingClient("token")
+        with microblog.db.get_session() as session:
+            client.mb_writer = microblog.source.twitter.get_writer(session)
+            for tweet in tweets:
+                client.on_tweet(tweet)
+            client.on_disconnect()
+            stored = session.scalars(
+                sqlalchemy.select(microblog.model.RawSourceData.dedup_key).where(
+                    microblog.model.RawSourceData.dedup_key.in_(tweet_ids)
+                )
+            ).all()
+        self.assertEqual(sorted(tweet_ids), sorted(stored))
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""
+Test cases for request and response validation
+"""
+
+import unittest
+import flask
+import microblog.schema
+import microblog.validation
+
+SCHEMA = {
+    "servers": [{"url": "/api"}],
+    "components": {
+        "schemas": {
+            "Item": {
+                "type": "object",
+                "required": ["id"],
+                "properties": {"id": {"type": "integer", "minimum": 1}},
+            }
+        }
+    },
+    "paths": {
+        "/items": {
+            "get": {
+                "parameters": [
+                    {
+                        "name": "limit",
+                        "in": "query",
+                        "schema": {"type": "integer", "maximum": 10},
+                    },
+                    {"name": "flag", "in": "query", "schema": {"type": "boolean"}},
+                    {
+                        "name": "q",
+                        "in": "query",
+                        "required": True,
+                        "schema": {"type": "string", "minLength": 1},
+                    },
+                ],
+                "responses": {
+                    "200": {
+                        "content": {
+                            "application/json": {
+                                "schema": {
+                                    "type": "array",
+                                    "items": {"$ref": "#/components/schemas/Item"},
+                                }
+                            }
+                        }
+                    }
+                },
+            }
+        }
+    },
+}
+
+
+def get_client(mode, sample_rate=None):
+    app = flask.Flask(__name__)
+    validate = microblog.validation.Validator(SCHEMA, mode, sample_rate)
+
+    @app.route("/api/items")
+    @validate
+    def items():
+        return flask.jsonify([{"id": flask.g.query.get("limit", 0)}])
+
+    return app.test_client()
+
+
+class Validation(unittest.TestCase):
+    def test_compile_schema(self):
+        validate = microblog.validation.compile_schema(
+            {"$ref": "#/components/schemas/Item"}, SCHEMA["components"]["schemas"]
+        )
+        validate({"id": 1})
+        for invalid in ({}, {"id": 0}, {"id": "1"}, {"id": True}, []):
+            with self.assertRaises(microblog.validation.ValidationError):
+                validate(invalid)
+        with self.assertRaises(ValueError):
+            microblog.validation.compile_schema({"pattern": "^a"}, {})
+
+    def test_parse_query(self):
+        client = get_client("request")
+        self.assertEqual(
+            200, client.get("/api/items?q=a&limit=3&flag=true").status_code
+        )
+        for query in ("limit=3", "q=", "q=a&limit=11", "q=a&limit=x", "q=a&flag=1"):
+            with self.subTest(query):
+                response = client.get(f"/api/items?{query}")
+                self.assertEqual(400, response.status_code)
+                self.assertEqual(400, response.json["code"])
+        # Checked without response validation as well
+        client = get_client("off")
+        self.assertEqual(400, client.get("/api/items?q=&limit=11").status_code)
+        self.assertEqual(400, client.get("/api/items?q=a&limit=x").status_code)
+
+    def test_modes(self):
+        # limit=0 makes an item with an invalid id
+        self.assertEqual(
+            500, get_client("full").get("/api/items?q=a&limit=0").status_code
+        )
+        self.assertEqual(
+            200, get_client("request").get("/api/items?q=a&limit=0").status_code
+        )
+        client = get_client("sampled", sample_rate=2)
+        with self.assertLogs(level="ERROR") as logs:
+            for _ in range(4):
+                self.assertEqual(200, client.get("/api/items?q=a&limit=0").status_code)
+        self.assertEqual(2, len(logs.records))
+
+    def test_schema(self):
+        # The API's own schema is a valid OpenAPI document and fully compilable
+        microblog.schema.get_spec()
+        validator = microblog.validation.Validator(mode="full")
+        self.assertIn("/openapi/v1/messages", validator.operations)